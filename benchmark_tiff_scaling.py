@@ -0,0 +1,714 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys, io, getopt, time, resource, multiprocessing, json, platform, shutil, tempfile, subprocess
+import numpy, tifffile, PIL
+from PIL import Image, TiffImagePlugin
+
+home_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert( 1, home_dir )
+import extract_tiff_scaling as ets
+
+def programInfo():
+    print("#########################################################")
+    print("# Benchmarks for extract_tiff_scaling.py                #")
+    print("#                                                       #")
+    print("# © 2023 Florian Kleiner                                #")
+    print("#   Bauhaus-Universität Weimar                          #")
+    print("#   F. A. Finger-Institut für Baustoffkunde             #")
+    print("#                                                       #")
+    print("#########################################################")
+    print()
+
+# Initial function to load the settings
+def getBaseSettings():
+    settings = {
+        "width"  : 6144,
+        "height" : 4096,
+        "modes"  : ['L', 'RGB', 'I;16'],
+        "benchmarks" : ['checks', 'import', 'metafree', 'profiles', 'metadata', 'files', 'directory'],
+        "sizes"      : [(1024, 768), (3072, 2048), (6144, 4096)], # image sizes of the synthetic files
+        "repeats"    : 3,    # repetitions of each file stage, the fastest run is reported
+        "workingDirectory" : "", # folder of the synthetic files, a temporary folder is used and removed if empty
+        "output_file"  : "", # save the results as json
+        "compare_file" : "", # compare the results with a previously saved json file
+    }
+    return settings
+
+#### process given command line arguments
+def processArguments():
+    settings = getBaseSettings()
+    argv = sys.argv[1:]
+    usage = sys.argv[0] + " [-h] [-x <width>] [-y <height>] [-m <modes>] [-b <benchmarks>] [-s <sizes>] [-n <repeats>] [-w <folder>] [-o <file.json>] [-c <file.json>]"
+    try:
+        opts, args = getopt.getopt(argv,"hx:y:m:b:s:n:w:o:c:",[])
+    except getopt.GetoptError:
+        print( usage )
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print( 'usage: ' + usage )
+            print( '-h,                  : show this help' )
+            print( '-x,                  : image width [{}]'.format(settings["width"]) )
+            print( '-y,                  : image height [{}]'.format(settings["height"]) )
+            print( '-m,                  : comma separated list of image modes [{}]'.format(','.join(settings["modes"])) )
+            print( '-b,                  : comma separated list of benchmarks [{}]'.format(','.join(settings["benchmarks"])) )
+            print( '-s,                  : comma separated sizes of the synthetic files [{}]'.format(','.join( '{}x{}'.format(*size) for size in settings["sizes"] )) )
+            print( '-n,                  : repetitions of each file stage [{}]'.format(settings["repeats"]) )
+            print( '-w,                  : keep the synthetic files in this folder [temporary folder]' )
+            print( '-o,                  : save the results to a json file' )
+            print( '-c,                  : compare the results with a json file of a previous run' )
+            print( '' )
+            sys.exit()
+        elif opt in ("-x"):
+            settings["width"] = int(arg)
+        elif opt in ("-y"):
+            settings["height"] = int(arg)
+        elif opt in ("-m"):
+            settings["modes"] = arg.split(',')
+        elif opt in ("-b"):
+            settings["benchmarks"] = arg.split(',')
+        elif opt in ("-s"):
+            settings["sizes"] = [ tuple( int(v) for v in size.split('x') ) for size in arg.split(',') ]
+        elif opt in ("-n"):
+            settings["repeats"] = max( 1, int(arg) )
+        elif opt in ("-w"):
+            settings["workingDirectory"] = arg
+        elif opt in ("-o"):
+            settings["output_file"] = arg
+        elif opt in ("-c"):
+            settings["compare_file"] = arg
+    return settings
+
+# peak resident memory of the current process in bytes (including the imported modules).
+# On Linux the peak of the parent process is inherited by new processes, so it is read from /proc and reset by reset_peak_rss.
+def get_peak_rss():
+    if os.path.isfile( '/proc/self/status' ):
+        with open( '/proc/self/status' ) as file:
+            for line in file:
+                if line.startswith( 'VmHWM:' ):
+                    return int( line.split()[1] )*1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+# set the peak resident memory to the current memory usage (Linux only)
+def reset_peak_rss():
+    try:
+        with open( '/proc/self/clear_refs', 'w' ) as file:
+            file.write( '5' )
+    except OSError:
+        pass
+
+def create_random_image( width, height, mode ):
+    rng = numpy.random.default_rng(0)
+    if mode == 'I;16':
+        return Image.fromarray( rng.integers(0, 65535, (height, width), dtype=numpy.uint16) )
+    bands = Image.getmodebands(mode)
+    shape = (height, width) if bands == 1 else (height, width, bands)
+    return Image.frombytes( mode, (width, height), rng.integers(0, 255, shape, dtype=numpy.uint8).tobytes() )
+
+# metadata removal as implemented up to 2023
+def legacy_metafree_image( img ):
+    if img.mode in ['L', 'P', 'RGB', 'RGBA', 'CMYK']:
+        metafree_img = Image.new(img.mode, img.size)
+        metafree_img.putdata( list(img.getdata()) )
+    else :
+        metafree_img = Image.fromarray(numpy.asarray(img))
+    return metafree_img
+
+metafree_functions = {
+    'putdata'    : legacy_metafree_image,
+    'frombuffer' : ets.get_metafree_image,
+}
+
+# runs target( *args, queue ) in a fresh process to get a clean peak memory reading and returns the result put into the queue
+def run_isolated( target, args ):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process( target=target, args=args + (queue,) )
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def measure_metafree_copy( method, width, height, mode, queue ):
+    img = create_random_image( width, height, mode )
+    img.load()
+    reset_peak_rss()
+    rss_before = get_peak_rss()
+    t = time.perf_counter()
+    metafree_img = metafree_functions[method]( img )
+    duration = time.perf_counter() - t
+    queue.put( { 'benchmark' : 'metafree', 'name' : method, 'mode' : mode, 'width' : width, 'height' : height,
+                 'seconds' : duration, 'peak_mb' : (get_peak_rss() - rss_before)/1024**2 } )
+
+def benchmark_metafree_copy( width, height, modes ):
+    results = []
+    for mode in modes:
+        for method in metafree_functions:
+            result = run_isolated( measure_metafree_copy, (method, width, height, mode) )
+            results.append( result )
+            print( " {:>5} {:>10}: {:8.3f} s, additional peak memory {:8.1f} MB".format(mode, method, result['seconds'], result['peak_mb']) )
+    return results
+
+# smooth structures with detector noise, compresses similar to SEM images (random noise does not compress at all)
+def create_reference_image( width, height, mode ):
+    rng = numpy.random.default_rng(0)
+    y, x = numpy.mgrid[0:height, 0:width].astype(numpy.float32)
+    structure = numpy.sin( x/37 ) * numpy.cos( y/53 ) + numpy.sin( ( x + y )/211 )
+    signal = ( structure - structure.min() ) / ( structure.max() - structure.min() )
+    signal = numpy.clip( signal + rng.normal( 0, 0.04, signal.shape ), 0, 1 )
+    if mode == 'I;16':
+        return Image.fromarray( ( signal*65535 ).astype(numpy.uint16) )
+    img = Image.fromarray( ( signal*255 ).astype(numpy.uint8) )
+    return img if mode == 'L' else img.convert( mode )
+
+# output profiles compared in benchmark_output_profiles: ( label, profile name, options )
+benchmark_profiles = [
+    ( 'Pillow (up to 2023)',  None,      None ),
+    ( 'none',                 'none',    {} ),
+    ( 'deflate:1',            'fast',    {} ),
+    ( 'deflate:6 (default)',  'default', { 'workers' : 1 } ),
+    ( 'deflate:6, threads',   'default', {} ),
+    ( 'deflate:6, predictor', 'default', { 'predictor' : True } ),
+    ( 'deflate:6, tile 512',  'default', { 'tile' : 512 } ),
+    ( 'deflate:9, predictor', 'small',   {} ),
+    ( 'lzw',                  'default', { 'codec' : 'lzw', 'level' : None } ),
+    ( 'zstd:5, predictor',    'zstd',    {} ),
+    ( 'lerc',                 'default', { 'codec' : 'lerc', 'level' : 0.0 } ),
+]
+
+# encoding time and size of the TIFF and the preview for each output profile.
+# Codecs requiring a missing package (imagecodecs) are skipped.
+def benchmark_output_profiles( width, height, modes ):
+    results = []
+    tiffinfo = ets.setImageJScaling( { 'x' : 2.5, 'y' : 2.5, 'unit' : 'nm', 'editor' : 'benchmark' } )
+    for mode in modes:
+        img = create_reference_image( width, height, mode )
+        raw_size = len( img.tobytes() )
+        for label, name, options in benchmark_profiles:
+            try:
+                profile = ets.get_output_profile( name, options ) if name is not None else None
+            except ValueError as e:
+                print( " {:>5} {:>22}: skipped, {}".format(mode, label, e) )
+                continue
+            buffer = io.BytesIO()
+            t = time.perf_counter()
+            if profile is None:
+                img.save( buffer, format='TIFF', compression='tiff_deflate', tiffinfo = tiffinfo )
+            else:
+                ets.write_tiff( img, buffer, tiffinfo, profile )
+            duration = time.perf_counter() - t
+            result = { 'benchmark' : 'profiles', 'name' : label, 'mode' : mode, 'width' : width, 'height' : height,
+                       'seconds' : duration, 'ratio' : buffer.tell() / raw_size, 'mb_per_s' : raw_size / duration / 1024**2 }
+            results.append( result )
+            print( " {:>5} {:>22}: {:8.3f} s, {:7.1f} MB/s, {:5.1f} % of the raw size".format(mode, label, duration, result['mb_per_s'], result['ratio']*100) )
+        preview = ets.get_scalebar_renderer().render( img, { 'x' : 2.5, 'y' : 2.5, 'unit' : 'nm', 'editor' : 'benchmark' } )
+        for preview_format in ets.preview_formats:
+            buffer = io.BytesIO()
+            t = time.perf_counter()
+            preview.save( buffer, format=ets.preview_formats[preview_format][0], quality=80 )
+            duration = time.perf_counter() - t
+            print( " {:>5} {:>22}: {:8.3f} s, {:7.1f} MB/s, {:5.1f} % of the raw size".format(mode, 'preview ' + preview_format + ':80', duration, raw_size / duration / 1024**2, buffer.tell() / raw_size * 100) )
+    return results
+
+### synthetic test files
+# FEI / thermoScientific images contain ResolutionY rows of image data and the databar below.
+# The metadata is saved in tag 34680 or, by the FIB process, in tag 34682.
+def get_fei_metadata( width, content_height, pixel_size=2.5e-09 ):
+    return ( "[User]\r\nDate=01/01/2023\r\nTime=12:00:00 PM\r\n[System]\r\nType=DualBeam\r\n"
+             "[Scan]\r\nPixelWidth={0}\r\nPixelHeight={0}\r\n"
+             "[Image]\r\nResolutionX={1}\r\nResolutionY={2}\r\n" ).format(pixel_size, width, content_height)
+
+def get_databar_height( height ):
+    return max( 1, height // 12 )
+
+def write_fei_tiff( file_path, width, height, mode, tag=34680 ):
+    pixels = numpy.asarray( create_reference_image( width, height + get_databar_height( height ), mode ) )
+    tifffile.imwrite( file_path, pixels, extratags=[ ( tag, 's', 0, get_fei_metadata( width, height ), True ) ], metadata=None )
+
+def write_fib_tiff( file_path, width, height, mode ):
+    write_fei_tiff( file_path, width, height, mode, tag=34682 )
+
+def write_aztec_tiff( file_path, width, height, mode ):
+    description = '<?xml version="1.0"?><ImageData><PixelWidth_um>0,0125</PixelWidth_um><PixelHeight_um>0,0125</PixelHeight_um></ImageData>'
+    tifffile.imwrite( file_path, numpy.asarray( create_reference_image( width, height, mode ) ), description=description, metadata=None )
+
+def write_imagej_tiff( file_path, width, height, mode ):
+    tifffile.imwrite( file_path, numpy.asarray( create_reference_image( width, height, mode ) ), imagej=True,
+                      resolution=( 1/0.05, 1/0.05 ), metadata={ 'unit' : '\\u00B5m' } )
+
+# format : ( writer, image modes )
+synthetic_formats = {
+    'fei'    : ( write_fei_tiff,    ['L', 'I;16'] ),
+    'fib'    : ( write_fib_tiff,    ['L'] ),
+    'aztec'  : ( write_aztec_tiff,  ['RGB'] ),
+    'imagej' : ( write_imagej_tiff, ['L', 'I;16', 'RGB'] ),
+}
+
+# writes every format, mode and size into directory and returns a description of each file
+def create_benchmark_files( directory, sizes ):
+    files = []
+    for file_format, ( writer, modes ) in synthetic_formats.items():
+        for mode in modes:
+            for width, height in sizes:
+                filename = '{}_{}_{}x{}.tif'.format(file_format, mode.replace(';', ''), width, height)
+                if not os.path.isfile( os.path.join( directory, filename ) ):
+                    writer( os.path.join( directory, filename ), width, height, mode )
+                files.append( { 'format' : file_format, 'mode' : mode, 'width' : width, 'height' : height, 'filename' : filename,
+                                'bytes' : os.path.getsize( os.path.join( directory, filename ) ) } )
+    return files
+
+### single file stages
+benchmark_output_folder = 'benchmark_output'
+benchmark_stages = {
+    'metadata_probe'               : lambda directory, filename: ets.metadata_probe( filename, directory ),
+    'getImageJScaling'             : lambda directory, filename: ets.getImageJScaling( filename, directory ),
+    'getFEIScaling'                : lambda directory, filename: ets.getFEIScaling( filename, directory ),
+    'getContentHeightFromMetaData' : lambda directory, filename: ets.getContentHeightFromMetaData( os.path.join( directory, filename ) ),
+    'save_scaling_in_image'        : lambda directory, filename: ets.save_scaling_in_image( directory, filename, True, benchmark_output_folder, verbose=False ),
+}
+
+def measure_file_stage( stage, directory, filename, repeats, queue ):
+    reset_peak_rss()
+    rss_before = get_peak_rss()
+    durations = []
+    for _ in range( repeats ):
+        t = time.perf_counter()
+        benchmark_stages[stage]( directory, filename )
+        durations.append( time.perf_counter() - t )
+    queue.put( { 'seconds' : min( durations ), 'mean_seconds' : sum( durations ) / repeats, 'peak_mb' : (get_peak_rss() - rss_before)/1024**2,
+                 'peak_rss_mb' : get_peak_rss()/1024**2 } )
+
+# time, throughput and peak memory of each stage for every synthetic file
+def benchmark_file_stages( directory, files, repeats=3 ):
+    results = []
+    for file in files:
+        for stage in benchmark_stages:
+            result = run_isolated( measure_file_stage, (stage, directory, file['filename'], repeats) )
+            result.update( { 'benchmark' : 'files', 'name' : stage, 'format' : file['format'], 'mode' : file['mode'],
+                             'width' : file['width'], 'height' : file['height'], 'mb_per_s' : file['bytes'] / max( result['seconds'], 1e-9 ) / 1024**2 } )
+            results.append( result )
+            print( " {:>6} {:>5} {:>9}  {:>28}: {:8.4f} s, {:8.1f} MB/s, additional peak memory {:7.1f} MB (process {:6.1f} MB)".format(
+                file['format'], file['mode'], '{}x{}'.format(file['width'], file['height']), stage, result['seconds'], result['mb_per_s'], result['peak_mb'], result['peak_rss_mb']) )
+    return results
+
+### metadata backends
+# detection result of a probe, has to be identical for all backends
+def get_probe_result( directory, filename, backend ):
+    probe = ets.metadata_probe( filename, directory, header_only=True, backend=backend )
+    return { 'scaling' : ets.autodetectScaling( probe ), 'contentHeight' : probe.contentHeight, 'width' : probe.width,
+             'height' : probe.height, 'page_count' : probe.page_count, 'tag' : probe.tag, 'fei_metadata' : probe.fei_metadata,
+             'fib_metadata' : probe.fib_metadata, 'backend' : probe.backend }
+
+# returns an error message for every backend detecting another result than tifffile
+def compare_metadata_backends( directory, filename, backends=None ):
+    errors = []
+    reference = get_probe_result( directory, filename, 'tifffile' )
+    for backend in backends or ets.metadata_backends:
+        result = get_probe_result( directory, filename, backend )
+        for key in reference:
+            if key != 'backend' and result[key] != reference[key]:
+                errors.append( '{}: {} of the {} backend differs from tifffile: {} != {}'.format(filename, key, backend, result[key], reference[key]) )
+    return errors
+
+# a small FEI stack, checks the page count of multi-page files
+# writes the frames as pages of a stack. Without photometric tifffile stores 3 frames as a single planar RGB page.
+def write_tiff_stack( file_path, frames, **options ):
+    tifffile.imwrite( file_path, numpy.stack( frames ), photometric='minisblack', **options )
+    with tifffile.TiffFile( file_path ) as tif:
+        assert len( tif.pages ) == len( frames ), '{} has {} pages instead of {}'.format(file_path, len( tif.pages ), len( frames ))
+
+def write_fei_stack( file_path, width, height, mode, pages=3 ):
+    pixels = numpy.asarray( create_reference_image( width, height + get_databar_height( height ), mode ) )
+    write_tiff_stack( file_path, [ pixels ]*pages, extratags=[ ( 34680, 's', 0, get_fei_metadata( width, height ), True ) ], metadata=None )
+
+# compares the scaling, content height, image size and page count detected by every metadata backend with tifffile
+# on every synthetic file and reports the time of a probe and the scaling detection per backend
+def benchmark_metadata_backends( directory, files, repeats=3 ):
+    results = []
+    files = files + [ { 'format' : 'fei stack', 'mode' : 'L', 'width' : 256, 'height' : 192, 'filename' : 'fei_stack.tif' } ]
+    write_fei_stack( os.path.join( directory, 'fei_stack.tif' ), 256, 192, 'L' )
+    mismatches = 0
+    for file in files:
+        errors = compare_metadata_backends( directory, file['filename'] )
+        for backend in ets.metadata_backends:
+            identical = not any( ' of the {} backend '.format(backend) in error for error in errors )
+            durations = []
+            for _ in range( repeats ):
+                t = time.perf_counter()
+                for _ in range( 20 ):
+                    get_probe_result( directory, file['filename'], backend )
+                durations.append( ( time.perf_counter() - t ) / 20 )
+            results.append( { 'benchmark' : 'metadata', 'name' : backend, 'format' : file['format'], 'mode' : file['mode'], 'width' : file['width'],
+                              'height' : file['height'], 'seconds' : min( durations ), 'identical' : identical } )
+            if not identical:
+                mismatches += 1
+                for error in errors:
+                    if ' of the {} backend '.format(backend) in error: print( "  {}".format(error) )
+            print( " {:>9} {:>5} {:>9}  {:>8}: {:8.1f} µs {}".format(file['format'], file['mode'], '{}x{}'.format(file['width'], file['height']), backend,
+                                                                  min( durations )*1e6, 'identical' if identical else 'DIFFERENT') )
+    os.remove( os.path.join( directory, 'fei_stack.tif' ) )
+    print( " {} of {} results identical to tifffile".format(len( results ) - mismatches, len( results )) )
+    return results, mismatches
+
+### directory modes
+def run_directory_mode( mode, file_list ):
+    task_args = { 'save_with_new_scalebar' : True, 'output_folder_name' : benchmark_output_folder, 'verbose' : False }
+    if mode == 'scan':
+        return ets.scan_scaling( file_list )
+    if mode == 'pipeline':
+        return ets.processing_pipeline( task_args, show_progress=False ).run( file_list )
+    return ets.process_file_list( file_list, 'save', task_args, backend=mode, show_progress=False )
+
+directory_modes = [ 'scan', 'serial', 'process', 'pipeline' ]
+
+def measure_directory_mode( mode, file_list, queue ):
+    reset_peak_rss()
+    rss_before = get_peak_rss()
+    t = time.perf_counter()
+    run_directory_mode( mode, file_list )
+    duration = time.perf_counter() - t
+    children_peak = resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss
+    children_peak = children_peak if sys.platform == 'darwin' else children_peak*1024
+    queue.put( { 'seconds' : duration, 'peak_mb' : (get_peak_rss() - rss_before)/1024**2, 'worker_peak_mb' : children_peak/1024**2 } )
+
+# processes all synthetic files at once using the directory modes of extract_tiff_scaling.py
+def benchmark_directory_modes( directory, files ):
+    results = []
+    file_list = [ ( directory, file['filename'] ) for file in files ]
+    total_bytes = sum( file['bytes'] for file in files )
+    for mode in directory_modes:
+        result = run_isolated( measure_directory_mode, (mode, file_list) )
+        result.update( { 'benchmark' : 'directory', 'name' : mode, 'files' : len( files ), 'bytes' : total_bytes,
+                         'files_per_s' : len( files ) / result['seconds'], 'mb_per_s' : total_bytes / result['seconds'] / 1024**2 } )
+        results.append( result )
+        print( " {:>9}: {:8.3f} s, {:7.1f} files/s, {:8.1f} MB/s, additional peak memory {:7.1f} MB (worker processes {:7.1f} MB)".format(
+            mode, result['seconds'], result['files_per_s'], result['mb_per_s'], result['peak_mb'], result['worker_peak_mb']) )
+    return results
+
+### import time and worker start
+# time of importing extract_tiff_scaling.py and detecting the scaling of a file without loading NumPy, tifffile and Pillow
+import_budget_ms = 50
+
+# code run in a fresh interpreter after importing extract_tiff_scaling as ets, '{}' is replaced by the path of a synthetic FEI file
+import_measurements = {
+    'module' : '',
+    'unit'   : "ets.unit().make_length_readable( 1234.5, 'nm' )",
+    'detect' : "ets.autodetectScaling( ets.metadata_probe( '{}', '' ) )",
+}
+heavy_modules = [ 'numpy', 'tifffile', 'PIL' ]
+
+# measures the import in a new interpreter. The compiled byte code is written by a first run,
+# since PYTHONDONTWRITEBYTECODE would add the compilation of the module to every measurement.
+def measure_import( code, repeats=5 ):
+    env = dict( os.environ )
+    env.pop( 'PYTHONDONTWRITEBYTECODE', None )
+    script = ( "import sys, time, json\nt = time.perf_counter()\nimport extract_tiff_scaling as ets\n{}\n"
+               "print( json.dumps( [ time.perf_counter() - t, [ m for m in {} if m in sys.modules ] ] ) )" ).format(code, heavy_modules)
+    runs = []
+    for _ in range( repeats + 1 ):
+        output = subprocess.run( [ sys.executable, '-c', script ], cwd=home_dir, env=env, capture_output=True, text=True, check=True ).stdout
+        runs.append( json.loads( output.strip().splitlines()[-1] ) )
+    return min( seconds for seconds, _ in runs[1:] ), runs[-1][1]
+
+def start_worker( contrast ):
+    ets.warm_up_worker( contrast )
+    return os.getpid()
+
+# time until a new process pool returned its first result, including the import of the heavy modules by the worker
+def measure_pool_start( start_method ):
+    ets.process_start_method = start_method
+    t = time.perf_counter()
+    with ets.get_process_pool( 1 ) as executor:
+        executor.submit( start_worker, 'exact' ).result()
+        duration = time.perf_counter() - t
+    ets.process_start_method = ''
+    return duration
+
+def benchmark_import( repeats=3 ):
+    results = []
+    directory = tempfile.mkdtemp( prefix='tiff_scaling_import_' )
+    file_path = os.path.join( directory, 'fei.tif' )
+    write_fei_tiff( file_path, 256, 192, 'L' )
+    for name, code in import_measurements.items():
+        seconds, loaded = measure_import( code.format(file_path.replace( '\\', '/' )), repeats )
+        result = { 'benchmark' : 'import', 'name' : name, 'seconds' : seconds, 'loaded_modules' : loaded }
+        result['within_budget'] = seconds*1000 <= import_budget_ms and len( loaded ) == 0
+        status = 'ok' if result['within_budget'] else 'over the budget of {} ms without {}'.format(import_budget_ms, ', '.join( heavy_modules ))
+        results.append( result )
+        print( " {:>18}: {:8.1f} ms, loaded {:<22} {}".format('import + ' + name if name != 'module' else 'import', seconds*1000, ', '.join( loaded ) or 'no heavy module', status) )
+    shutil.rmtree( directory, ignore_errors=True )
+    for start_method in multiprocessing.get_all_start_methods():
+        seconds = min( measure_pool_start( start_method ) for _ in range( repeats ) )
+        results.append( { 'benchmark' : 'import', 'name' : 'pool ' + start_method, 'seconds' : seconds } )
+        print( " {:>18}: {:8.1f} ms until the first result of a new worker".format('pool ' + start_method, seconds*1000) )
+    return results
+
+### regression checks
+# Correctness checks of cases the synthetic benchmark files do not cover. Every check writes its source files to directory
+# and returns a list of errors. The script exits with status 1 if a check failed.
+
+imagej_tiffinfo = { 270 : 'ImageJ=FEI-SEM\nunit=nm', 282 : 0.4, 283 : 0.4 }
+
+# returns an error message if the pixels of any page of output_path differ from source_path (decoded by Pillow)
+def compare_saved_pixels( source_path, output_path ):
+    with Image.open( source_path ) as source, Image.open( output_path ) as output:
+        if getattr( source, 'n_frames', 1 ) != getattr( output, 'n_frames', 1 ):
+            return '{}: {} instead of {} pages'.format(output_path, getattr( output, 'n_frames', 1 ), getattr( source, 'n_frames', 1 ))
+        for frame in range( getattr( source, 'n_frames', 1 ) ):
+            source.seek( frame )
+            output.seek( frame )
+            if not numpy.array_equal( numpy.asarray( source ), numpy.asarray( output ) ):
+                return '{}: the pixels of page {} differ from the source'.format(output_path, frame)
+    return None
+
+# saves filename using save_scaling_in_image and compares the pixels of the output with the source
+def check_saved_image( directory, filename, **options ):
+    errors = []
+    result = ets.save_scaling_in_image( directory, filename, False, benchmark_output_folder, verbose=False, **options )
+    if not result[0]:
+        errors.append( '{}: save_scaling_in_image failed'.format(filename) )
+    error = compare_saved_pixels( os.path.join( directory, filename ), os.path.join( directory, benchmark_output_folder, filename ) )
+    if error is not None:
+        errors.append( error )
+    return errors
+
+# LZW is written by Pillow and ImageJ by default but decoded by tifffile only with imagecodecs
+def check_streamed_lzw( directory ):
+    create_reference_image( 512, 384, 'L' ).save( os.path.join( directory, 'stream_lzw.tif' ), compression='tiff_lzw', tiffinfo=imagej_tiffinfo )
+    return check_saved_image( directory, 'stream_lzw.tif', buffer_size=64*1024, verify='full' )
+
+def check_streamed_bilevel( directory ):
+    img = create_reference_image( 512, 384, 'L' ).point( lambda v: 255 if v > 127 else 0 ).convert( '1' )
+    img.save( os.path.join( directory, 'stream_bilevel.tif' ), tiffinfo=imagej_tiffinfo )
+    return check_saved_image( directory, 'stream_bilevel.tif', buffer_size=64*1024, verify='full' )
+
+# verify='full' re-reads the streamed output and compares it with the rows of the source
+def check_streamed_verification( directory ):
+    write_fei_tiff( os.path.join( directory, 'stream_verify.tif' ), 512, 384, 'I;16' )
+    return check_saved_image( directory, 'stream_verify.tif', buffer_size=64*1024, verify='full',
+                              profile=ets.get_output_profile( 'small', { 'pyramid' : 2, 'tile' : 128 } ) )
+
+# OpenCV rejects big-endian arrays, the exported arrays are returned in the byte order of the machine
+def check_big_endian_export( directory ):
+    errors = []
+    file_path = os.path.join( directory, 'big_endian.tif' )
+    pixels = numpy.asarray( create_reference_image( 256, 192 + get_databar_height( 192 ), 'I;16' ) )
+    tifffile.imwrite( file_path, pixels, byteorder='>', extratags=[ ( 34680, 's', 0, get_fei_metadata( 256, 192 ), True ) ], metadata=None )
+    arrays = [ array for array, _ in ets.iter_images_without_scalebar( [ file_path ], prefetch=0 ) ]
+    arrays.append( ets.get_image_without_scalebar( directory, 'big_endian.tif', to_opencv=True )[0] )
+    for array in arrays:
+        if not array.dtype.isnative:
+            errors.append( '{}: the array has the byte order {}'.format(file_path, array.dtype.byteorder) )
+        elif not numpy.array_equal( array, pixels[:192] ):
+            errors.append( '{}: the pixels differ from the source'.format(file_path) )
+    return errors
+
+# the image keeps its ImageJ description and the levels are saved as SubIFDs with the resolution divided by the reduction factor,
+# in memory and streamed. tifffile does not return the levels of ImageJ TIFFs as series levels.
+def check_pyramid_levels( directory ):
+    errors = []
+    write_imagej_tiff( os.path.join( directory, 'pyramid.tif' ), 512, 384, 'L' )
+    output_path = os.path.join( directory, benchmark_output_folder, 'pyramid.tif' )
+    for buffer_size in [ 0, 64*1024 ]:
+        errors += check_saved_image( directory, 'pyramid.tif', buffer_size=buffer_size, profile=ets.get_output_profile( 'default', { 'pyramid' : 2 } ) )
+        with tifffile.TiffFile( output_path ) as tif:
+            page = tif.pages[0]
+            if not tif.is_imagej:
+                errors.append( '{}: no ImageJ file (buffer {})'.format(output_path, buffer_size) )
+            levels = page.pages if page.subifds else []
+            if len( levels ) != 2:
+                errors.append( '{}: {} levels instead of 2 (buffer {})'.format(output_path, len( levels ), buffer_size) )
+            for level, level_page in enumerate( levels, 1 ):
+                resolution = level_page.get_resolution()
+                expected = tuple( value / 2**level for value in page.get_resolution() )
+                if level_page.shape != ( 384 >> level, 512 >> level ) or numpy.abs( numpy.subtract( resolution, expected ) ).max() > 1e-3:
+                    errors.append( '{}: level {} has the shape {} and resolution {} (buffer {})'.format(output_path, level, level_page.shape, resolution, buffer_size) )
+        if ets.autodetectScaling( 'pyramid.tif', os.path.dirname( output_path ) )['unit'] != 'µm':
+            errors.append( '{}: the unit is not detected as µm (buffer {})'.format(output_path, buffer_size) )
+    return errors
+
+# the ImageDescription is ASCII, µm has to be written as \u00B5m to be read by ImageJ and Pillow
+def check_micrometer_unit( directory ):
+    write_imagej_tiff( os.path.join( directory, 'micrometer.tif' ), 256, 192, 'L' )
+    errors = check_saved_image( directory, 'micrometer.tif' )
+    output_path = os.path.join( directory, benchmark_output_folder, 'micrometer.tif' )
+    with Image.open( output_path ) as img:
+        if not 'unit=\\u00B5m' in img.tag_v2.get( 270, '' ):
+            errors.append( '{}: description {!r} does not contain unit=\\u00B5m'.format(output_path, img.tag_v2.get( 270 )) )
+    if ets.autodetectScaling( 'micrometer.tif', os.path.dirname( output_path ) )['unit'] != 'µm':
+        errors.append( '{}: the unit is not detected as µm'.format(output_path) )
+    return errors
+
+# LZW stacks are written by ImageJ and Pillow by default, the pages are decoded by Pillow if imagecodecs is missing
+def check_lzw_stack( directory ):
+    frames = [ create_reference_image( 256, 192, 'L' ).rotate( 90*page ) for page in range( 3 ) ]
+    frames[0].save( os.path.join( directory, 'lzw_stack.tif' ), save_all=True, append_images=frames[1:], compression='tiff_lzw', tiffinfo=imagej_tiffinfo )
+    return ( check_saved_image( directory, 'lzw_stack.tif', verify='full' ) +
+             check_saved_image( directory, 'lzw_stack.tif', buffer_size=64*1024, verify='full' ) )
+
+# file names relative to the current directory, workingDirectory defaults to ''
+def check_relative_path( directory ):
+    write_fei_tiff( os.path.join( directory, 'relative.tif' ), 256, 192, 'L' )
+    errors = []
+    cwd = os.getcwd()
+    os.chdir( directory )
+    try:
+        scaling = ets.autodetectScaling( 'relative.tif' )
+        if scaling['editor'] != 'FEI-SEM':
+            errors.append( 'relative.tif: detected {} instead of the FEI scaling'.format(scaling) )
+        if ets.getContentHeightFromMetaData( 'relative.tif' ) != 192:
+            errors.append( 'relative.tif: content height {} instead of 192'.format(ets.getContentHeightFromMetaData( 'relative.tif' )) )
+    finally:
+        os.chdir( cwd )
+    return errors
+
+# files the struct metadata reader handles differently: BigTIFF, big-endian (MM) byte order, reduced IFDs in the main chain
+# (thumbnails) and files written by Pillow
+def write_metadata_edge_files( directory ):
+    fei = get_fei_metadata( 256, 192 )
+    pixels = numpy.asarray( create_reference_image( 256, 192 + get_databar_height( 192 ), 'I;16' ) )
+    files = {
+        'bigtiff.tif'    : lambda path: tifffile.imwrite( path, pixels, bigtiff=True, extratags=[ ( 34680, 's', 0, fei, True ) ], metadata=None ),
+        'bigendian.tif'  : lambda path: tifffile.imwrite( path, pixels, byteorder='>', resolution=( 4, 2 ), extratags=[ ( 34682, 's', 0, fei, True ) ], metadata=None ),
+        'bigendian_bigtiff_stack.tif' : lambda path: write_tiff_stack( path, [ pixels ]*3, byteorder='>', bigtiff=True,
+                                                                       extratags=[ ( 34680, 's', 0, fei, True ) ], metadata=None ),
+    }
+    def write_reduced( path ):
+        with tifffile.TiffWriter( path ) as out:
+            out.write( pixels, description='ImageJ=1.54f\nunit=\\u00B5m\n', resolution=( 20, 20 ), metadata=None )
+            out.write( pixels[::4, ::4], subfiletype=1, metadata=None )
+            out.write( pixels, metadata=None )
+    files['reduced.tif'] = write_reduced
+    def write_pillow( path ):
+        ifd = TiffImagePlugin.ImageFileDirectory_v2()
+        ifd[34680] = fei
+        ifd.tagtype[34680] = 2
+        create_reference_image( 256, 192, 'RGB' ).save( path, tiffinfo=ifd )
+    files['pillow_fei.tif'] = write_pillow
+    def write_pillow_stack( path ):
+        frames = [ create_reference_image( 256, 192, 'L' ) ]*3
+        frames[0].save( path, save_all=True, append_images=frames[1:], compression='tiff_lzw', tiffinfo=imagej_tiffinfo )
+    files['pillow_lzw_stack.tif'] = write_pillow_stack
+    for filename, writer in files.items():
+        writer( os.path.join( directory, filename ) )
+    return list( files )
+
+# every metadata backend has to detect the same result as tifffile, Pillow can not read big-endian BigTIFFs
+def check_metadata_backends( directory ):
+    errors = []
+    for filename in write_metadata_edge_files( directory ):
+        errors += compare_metadata_backends( directory, filename, [ 'struct' ] if filename.startswith( 'bigendian_bigtiff' ) else None )
+    return errors
+
+regression_checks = {
+    'streamed LZW source'     : check_streamed_lzw,
+    'streamed bilevel source' : check_streamed_bilevel,
+    'streamed verification'   : check_streamed_verification,
+    'micrometer unit'         : check_micrometer_unit,
+    'pyramid levels'          : check_pyramid_levels,
+    'big-endian export'       : check_big_endian_export,
+    'LZW stack'               : check_lzw_stack,
+    'relative path'           : check_relative_path,
+    'metadata backend parity' : check_metadata_backends,
+}
+
+# runs all regression checks and returns the number of failed checks
+def run_regression_checks():
+    failed = 0
+    directory = tempfile.mkdtemp( prefix='tiff_scaling_checks_' )
+    try:
+        for name, check in regression_checks.items():
+            try:
+                errors = check( directory )
+            except Exception as e:
+                errors = [ '{}: {}'.format(type(e).__name__, e) ]
+            print( " {:>28}: {}".format(name, 'ok' if len( errors ) == 0 else 'FAILED') )
+            for error in errors:
+                print( "   {}".format(error) )
+            failed += len( errors ) > 0
+    finally:
+        shutil.rmtree( directory, ignore_errors=True )
+    return failed
+
+### machine readable results
+# identifies a measurement across runs
+def get_result_key( result ):
+    return ( result['benchmark'], result['name'], result.get( 'format', '' ), result.get( 'mode', '' ), result.get( 'width', 0 ), result.get( 'height', 0 ), result.get( 'files', 0 ) )
+
+def get_environment():
+    return { 'python' : platform.python_version(), 'platform' : platform.platform(), 'cpu_count' : os.cpu_count(),
+             'pillow' : PIL.__version__, 'numpy' : numpy.__version__, 'tifffile' : tifffile.__version__,
+             'date' : time.strftime( '%Y-%m-%d %H:%M:%S' ) }
+
+def save_results( output_file, results, settings ):
+    with open( output_file, 'w', encoding='utf-8' ) as file:
+        json.dump( { 'environment' : get_environment(), 'settings' : { 'sizes' : settings['sizes'], 'repeats' : settings['repeats'] },
+                     'results' : results }, file, indent=1 )
+
+# prints the change of the duration of every measurement found in both runs
+def compare_results( results, compare_file, threshold=0.1 ):
+    with open( compare_file, 'r', encoding='utf-8' ) as file:
+        previous = json.load( file )
+    previous_results = { get_result_key( result ) : result for result in previous['results'] }
+    print( "comparison with {} ({}, Pillow {}, tifffile {}):".format(compare_file, previous['environment']['date'],
+                                                                     previous['environment']['pillow'], previous['environment']['tifffile']) )
+    for result in results:
+        old = previous_results.get( get_result_key( result ) )
+        if old is None: continue
+        change = result['seconds'] / max( old['seconds'], 1e-9 ) - 1
+        flag = 'slower' if change > threshold else 'faster' if change < -threshold else ''
+        print( " {:<70} {:8.4f} s -> {:8.4f} s {:+7.1f} % {}".format(' '.join( str(v) for v in get_result_key( result ) if v not in ['', 0] ),
+                                                                       old['seconds'], result['seconds'], change*100, flag) )
+
+### actual program start
+if __name__ == '__main__':
+    programInfo()
+    settings = processArguments()
+
+    results = []
+    failed_checks = 0
+    if 'checks' in settings["benchmarks"]:
+        print( "regression checks:" )
+        failed_checks += run_regression_checks()
+    if 'import' in settings["benchmarks"]:
+        print( "import time (fastest of {} runs, budget {} ms) and start of the worker processes:".format(settings["repeats"], import_budget_ms) )
+        results += benchmark_import( settings["repeats"] )
+    if 'metafree' in settings["benchmarks"]:
+        print( "metadata free copy of a {} x {} px image:".format(settings["width"], settings["height"]) )
+        results += benchmark_metafree_copy( settings["width"], settings["height"], settings["modes"] )
+    if 'profiles' in settings["benchmarks"]:
+        print( "output profiles of a {} x {} px reference image using {} CPU cores:".format(settings["width"], settings["height"], os.cpu_count()) )
+        results += benchmark_output_profiles( settings["width"], settings["height"], settings["modes"] )
+
+    if 'metadata' in settings["benchmarks"] or 'files' in settings["benchmarks"] or 'directory' in settings["benchmarks"]:
+        directory = settings["workingDirectory"] or tempfile.mkdtemp( prefix='tiff_scaling_benchmark_' )
+        os.makedirs( directory, exist_ok=True )
+        print( "creating synthetic files in {}".format(directory) )
+        files = create_benchmark_files( directory, settings["sizes"] )
+        if 'metadata' in settings["benchmarks"]:
+            print( "metadata backends, time of a probe and the scaling detection (fastest of {} runs):".format(settings["repeats"]) )
+            metadata_results, mismatches = benchmark_metadata_backends( directory, files, settings["repeats"] )
+            results += metadata_results
+            failed_checks += mismatches
+        if 'files' in settings["benchmarks"]:
+            print( "single file stages (fastest of {} runs):".format(settings["repeats"]) )
+            results += benchmark_file_stages( directory, files, settings["repeats"] )
+        if 'directory' in settings["benchmarks"]:
+            print( "directory modes using {} files ({:.1f} MB):".format(len(files), sum( f['bytes'] for f in files )/1024**2) )
+            results += benchmark_directory_modes( directory, files )
+        shutil.rmtree( os.path.join( directory, benchmark_output_folder ), ignore_errors=True )
+        for prefix in [ 'cut_', 'nsb_', 'thumb_' ]:
+            shutil.rmtree( os.path.join( directory, prefix + benchmark_output_folder ), ignore_errors=True )
+        if settings["workingDirectory"] == "":
+            shutil.rmtree( directory, ignore_errors=True )
+
+    if settings["output_file"] != "":
+        save_results( settings["output_file"], results, settings )
+        print( "saved {} results to {}".format(len(results), settings["output_file"]) )
+    if settings["compare_file"] != "":
+        compare_results( results, settings["compare_file"] )
+    if failed_checks > 0:
+        print( "{} check(s) failed".format(failed_checks) )
+        sys.exit(1)
@@ -1,10 +1,65 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import os, sys, getopt, tifffile, numpy, mmap
-from PIL import Image, ImageDraw, ImageFont
-Image.MAX_IMAGE_PIXELS = 1000000000 # prevent decompressionbomb warning for typical images
-from PIL.TiffTags import TAGS
+import os, sys, io, glob, time, traceback, csv, mmap, zlib, json, hashlib
+import threading, queue, select, struct, importlib
+
+# placeholder of a module imported on first use.
+# NumPy, tifffile and Pillow take about 150 ms to import, which dominates the start of every worker process
+# and of scripts only using the unit conversion or the metadata parsing of this module.
+# The placeholder replaces itself by the actual module in the globals of this module after the import.
+class lazy_module:
+    def __init__( self, name, alias, on_import=None ):
+        self.name      = name
+        self.alias     = alias
+        self.on_import = on_import
+
+    def load( self ):
+        module = importlib.import_module( self.name )
+        if self.on_import is not None:
+            self.on_import( module )
+        # 'import concurrent.futures' binds the top level package
+        if '.' in self.name and self.name.split('.')[0] == self.alias:
+            module = sys.modules[self.alias]
+        if globals().get( self.alias ) is self:
+            globals()[self.alias] = module
+        return module
+
+    def __getattr__( self, attr ):
+        return getattr( self.load(), attr )
+
+    def __repr__( self ):
+        return "<lazy module '{}'>".format(self.name)
+
+def set_max_image_pixels( module ):
+    module.MAX_IMAGE_PIXELS = 1000000000 # prevent decompressionbomb warning for typical images
+
+numpy      = lazy_module( 'numpy', 'numpy' )
+tifffile   = lazy_module( 'tifffile', 'tifffile' )
+Image      = lazy_module( 'PIL.Image', 'Image', on_import=set_max_image_pixels )
+ImageDraw  = lazy_module( 'PIL.ImageDraw', 'ImageDraw' )
+ImageFont  = lazy_module( 'PIL.ImageFont', 'ImageFont' )
+ImageSequence = lazy_module( 'PIL.ImageSequence', 'ImageSequence' )
+concurrent = lazy_module( 'concurrent.futures', 'concurrent' )
+
+# modules imported by the parent before forking the workers or by the forkserver, see get_process_pool()
+preload_module_names = [ 'numpy', 'tifffile', 'PIL.Image', 'PIL.ImageFont' ]
+
+# start method of the worker processes: fork, spawn, forkserver or '' for the default of the platform
+process_start_method = ''
+
+# import all modules loaded on first use
+def preload_modules():
+    for name, value in list( globals().items() ):
+        if isinstance( value, lazy_module ):
+            value.load()
+
+# the Pillow tag names are only loaded if requested, e.g. by 'from extract_tiff_scaling import TAGS'
+def __getattr__( name ):
+    if name == 'TAGS':
+        from PIL.TiffTags import TAGS
+        return TAGS
+    raise AttributeError( "module '{}' has no attribute '{}'".format(__name__, name) )
 
 home_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -28,42 +83,189 @@ def getBaseSettings():
         "home_dir"               : os.path.dirname(os.path.realpath(__file__)),
         "workingDirectory"       : "",
         "actionType"             : "d",  # directory = d or file = f
+        "inputPaths"             : [],   # files, directories or glob patterns. A dialog is shown if empty
+        "recursive"              : False,
         "outputDirectory"        : "extracted_scaling",
-        "save_with_new_scalebar" : True
+        "save_with_new_scalebar" : True,
+        "buffer_size"            : 0,    # streaming mode for huge images if > 0 (bytes)
+        "use_index"              : True, # skip unchanged files using the scaling index
+        "rebuild_index"          : False,
+        "processCount"           : 0,    # number of workers, 0 = number of CPU cores - 1
+        "backend"                : "process", # process, thread or serial
+        "chunk_size"             : 0,    # files per task submitted to a worker, 0 = 4 when saving images, 64 when scanning
+        "max_inflight_mb"        : 2048, # maximum size of the files being processed at the same time
+        "scan_output"            : "",   # only write the detected scaling of all files to this csv, json or parquet file
+        "contrast"               : "exact", # 16 bit to 8 bit conversion of the scalebar images
+        "verify"                 : "tags", # verification of the saved scaling: off, tags or full
+        "checksum"               : False,  # save a SHA-256 of the written pixels in the scaling index
+        "pipeline"               : False,  # overlap reading, transformation, encoding and writing of several files
+        "stage_workers"          : {},     # workers per pipeline stage, e.g. { 'read' : 4 }
+        "output_profile"         : "default", # codec, predictor, tiles and preview format of the outputs, see output_profiles
+        "output_options"         : {},     # settings overriding the output profile, e.g. { 'codec' : 'zstd', 'level' : 3 }
+        "timings"                : False,  # print the time spent in each stage at the end
+        "trace_file"             : "",     # save the spans of the stages of every file to this json lines file
+        "watch"                  : False,  # keep running and process new or changed images of the given directories
+        "watch_polling"          : False,  # scan the directories instead of using inotify, e.g. for network shares
+        "watch_interval"         : 2.0,    # seconds between two scans of the directories when polling
+        "watch_settle"           : 2.0,    # seconds size and modification time of a new file have to be unchanged
+        "start_method"           : "",     # start method of the worker processes: fork, spawn, forkserver or '' (default of the platform)
+        "metadata_backend"       : "struct" # reader of the tags used to detect the scaling: struct, tifffile or pillow
     }
     return settings
 
 #### process given command line arguments
 def processArguments():
+    import getopt
     settings = getBaseSettings()
     argv = sys.argv[1:]
-    usage = sys.argv[0] + " [-h] [-o] [-f] [-s] [-d]"
+    usage = sys.argv[0] + " [-h] [-o <name>] [-f] [-r] [-s] [-b <MB>] [-j <n>] [-d] [--threads] [--chunk-size <n>] [--max-inflight <MB>] [--rebuild-index] [--no-index] [--scan <file>] [--contrast <mode>] [--verify <mode>] [--checksum] [--pipeline [--stage-workers <r,t,e,w>]] [--profile <name>] [--compression <codec[:level]>] [--predictor] [--tile <px>] [--preview <format[:quality]>] [--encode-threads <n>] [--pyramid <levels>] [--thumbnail <px>] [--timings] [--trace <file.jsonl>] [--watch [--poll <s>] [--settle <s>]] [--start-method <method>] [--metadata <backend>] [path or glob ...]"
     try:
-        opts, args = getopt.getopt(argv,"hosd",[])
+        opts, args = getopt.gnu_getopt(argv,"ho:frsb:j:d",["threads", "chunk-size=", "max-inflight=", "rebuild-index", "no-index", "scan=", "contrast=", "verify=", "checksum", "pipeline", "stage-workers=", "profile=", "compression=", "predictor", "tile=", "preview=", "encode-threads=", "pyramid=", "thumbnail=", "timings", "trace=", "watch", "poll=", "settle=", "start-method=", "metadata="])
     except getopt.GetoptError:
         print( usage )
+        sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
             print( 'usage: ' + usage )
             print( '-h,                  : show this help' )
-            print( '-o,                  : setting output directory name [{}]'.format(settings["outputDirectory"]) )
-            print( '-f:,                  : process only a single file' )
+            print( '-o <name>            : setting output directory name [{}]'.format(settings["outputDirectory"]) )
+            print( '-f,                  : select a single file instead of a directory if no path is given' )
+            print( '-r,                  : search given directories recursively' )
             print( '-s                   : do not save images with a simplyfied scalebar' )
-            print( '-d                   : show debug output' )
+            print( '-b <MB>              : stream huge images using a buffer of the given size in MB' )
+            print( '-j <n>               : number of parallel workers [CPU cores - 1]' )
+            print( '-d                   : show debug output and process all files in this process' )
+            print( '--threads            : use threads instead of processes, e.g. for I/O bound runs' )
+            print( '--chunk-size <n>     : number of files submitted to a worker at once [4, 64 when scanning]' )
+            print( '--max-inflight <MB>  : maximum size of the files processed at the same time [{}]'.format(settings["max_inflight_mb"]) )
+            print( '--rebuild-index      : ignore and rebuild the scaling index of the directory' )
+            print( '--no-index           : process all files without using the scaling index' )
+            print( '--scan <file>        : only detect the scaling and save it to a csv, json or parquet file' )
+            print( '--contrast <mode>    : 16 bit to 8 bit conversion of scalebar images: exact, minmax, percentile[:low,high] or window:low,high [exact]' )
+            print( '--verify <mode>      : verify the saved images: off, tags (scaling tags only) or full (tags and pixels) [{}]'.format(settings["verify"]) )
+            print( '--checksum           : save a SHA-256 checksum of the written pixels in the scaling index' )
+            print( '--pipeline           : overlap reading, transformation, encoding and writing of several files' )
+            print( '--stage-workers <r,t,e,w> : workers of the read, transform, encode and write stage of the pipeline' )
+            print( '--profile <name>     : output profile: {} [{}]'.format(', '.join( output_profiles ), settings["output_profile"]) )
+            print( '--compression <codec[:level]> : compression of the TIFFs: none, deflate[:1-9], lzw, zstd[:level] or lerc[:max error]' )
+            print( '--predictor          : apply a horizontal predictor before the compression' )
+            print( '--tile <px>          : save tiled TIFFs using tiles of the given size (multiple of 16)' )
+            print( '--preview <format[:quality]> : format of the images with a simplified scalebar: jpeg or webp' )
+            print( '--encode-threads <n> : threads compressing a single image [CPU cores / parallel workers]' )
+            print( '--pyramid <levels>   : save the given number of reduced resolution levels in the TIFFs' )
+            print( '--thumbnail <px>     : save thumbnails of at most the given size with a scalebar' )
+            print( '--timings            : print the time spent in each stage (detection, encoding, ...) at the end' )
+            print( '--trace <file.jsonl> : save the duration and the bytes read / written of each stage of every file' )
+            print( '--watch              : keep running and process new or changed images of the given directories' )
+            print( '--poll <s>           : scan the watched directories every <s> seconds instead of using inotify (network shares)' )
+            print( '--settle <s>         : seconds the size of a new image has to be unchanged before it is processed [{}]'.format(settings["watch_settle"]) )
+            print( '--start-method <method> : start method of the worker processes: fork, spawn or forkserver [platform default]' )
+            print( '--metadata <backend> : reader of the tags used to detect the scaling: {} [{}]'.format(', '.join( metadata_backends ), settings["metadata_backend"]) )
             print( '' )
             sys.exit()
         elif opt in ("-o"):
             settings["outputDirectory"] = arg
             print( 'Changed output directory to {}'.format(settings["outputDirectory"]) )
         elif opt in ("-s"):
-            settings["save_with_new_scalebar"] = True
+            settings["save_with_new_scalebar"] = False
             print( 'Won\'t save images with a simplyfied scalebar.' )
         elif opt in ("-f"):
             settings["actionType"] = 'f'
             print( 'Single file processing.' )
+        elif opt in ("-r"):
+            settings["recursive"] = True
+            print( 'Searching directories recursively.' )
+        elif opt in ("-b"):
+            settings["buffer_size"] = int( float(arg)*1024**2 )
+            print( 'Streaming images using a buffer of {} MB.'.format(arg) )
+        elif opt in ("-j"):
+            settings["processCount"] = int(arg)
         elif opt in ("-d"):
             print( 'Show debugging output.' )
             settings["showDebuggingOutput"] = True
+            settings["backend"] = 'serial'
+        elif opt == "--threads":
+            if settings["backend"] != 'serial': settings["backend"] = 'thread'
+            print( 'Using threads instead of processes.' )
+        elif opt == "--chunk-size":
+            settings["chunk_size"] = max( 1, int(arg) )
+        elif opt == "--max-inflight":
+            settings["max_inflight_mb"] = float(arg)
+        elif opt == "--rebuild-index":
+            settings["rebuild_index"] = True
+            print( 'Rebuilding the scaling index.' )
+        elif opt == "--no-index":
+            settings["use_index"] = False
+            print( 'Processing all files without the scaling index.' )
+        elif opt == "--scan":
+            settings["scan_output"] = arg
+            print( 'Saving the detected scaling to {}.'.format(arg) )
+        elif opt == "--contrast":
+            try:
+                parse_contrast( arg )
+            except ValueError as e:
+                print( e )
+                sys.exit(2)
+            settings["contrast"] = arg
+            print( 'Converting 16 bit scalebar images using the contrast mode {}.'.format(arg) )
+        elif opt == "--verify":
+            if not arg in ['off', 'tags', 'full']:
+                print( 'unknown verification mode "{}", use off, tags or full'.format(arg) )
+                sys.exit(2)
+            settings["verify"] = arg
+        elif opt == "--checksum":
+            settings["checksum"] = True
+        elif opt == "--pipeline":
+            settings["pipeline"] = True
+            print( 'Using the staged processing pipeline.' )
+        elif opt == "--stage-workers":
+            settings["stage_workers"] = dict( zip( processing_pipeline.stage_names, [ max( 1, int(n) ) for n in arg.split(',') ] ) )
+        elif opt == "--profile":
+            settings["output_profile"] = arg
+        elif opt in ("--compression", "--preview"):
+            try:
+                settings["output_options"].update( parse_codec( arg ) if opt == "--compression" else parse_preview( arg ) )
+            except ValueError as e:
+                print( e )
+                sys.exit(2)
+        elif opt == "--predictor":
+            settings["output_options"]["predictor"] = True
+        elif opt == "--tile":
+            settings["output_options"]["tile"] = int(arg)
+        elif opt == "--encode-threads":
+            settings["output_options"]["workers"] = max( 1, int(arg) )
+        elif opt in ("--pyramid", "--thumbnail"):
+            settings["output_options"][opt[2:]] = int(arg)
+        elif opt == "--timings":
+            settings["timings"] = True
+        elif opt == "--trace":
+            settings["trace_file"] = arg
+            settings["timings"] = True
+            print( 'Saving the trace of all stages to {}.'.format(arg) )
+        elif opt == "--watch":
+            settings["watch"] = True
+        elif opt == "--poll":
+            settings["watch_polling"]  = True
+            settings["watch_interval"] = max( 0.1, float(arg) )
+        elif opt == "--settle":
+            settings["watch_settle"] = max( 0.0, float(arg) )
+        elif opt == "--start-method":
+            import multiprocessing
+            if not arg in multiprocessing.get_all_start_methods():
+                print( 'Unsupported start method {}, use one of: {}'.format(arg, ', '.join( multiprocessing.get_all_start_methods() )) )
+                sys.exit(2)
+            settings["start_method"] = arg
+        elif opt == "--metadata":
+            if not arg in metadata_backends:
+                print( 'Unknown metadata backend {}, use one of: {}'.format(arg, ', '.join( metadata_backends )) )
+                sys.exit(2)
+            settings["metadata_backend"] = arg
+    try:
+        get_output_profile( settings["output_profile"], settings["output_options"] )
+    except ValueError as e:
+        print( e )
+        sys.exit(2)
+    settings["inputPaths"] = args
     print( '' )
     return settings
 
@@ -74,20 +276,15 @@ class unit:
     unitArray          = [  'nm',  'µm',  'mm',  'cm',   'm' ]
     unitFactorArray    = [     1, 10**3, 10**6, 10**7, 10**9 ]
     unitFactorArrayInv = [ 10**9, 10**6, 10**3, 10**2,     1 ]
+    # precomputed lookup tables
+    unitPos            = { u : i for i, u in enumerate(unitArray) }
+    unitFactor         = dict( zip( unitArray, unitFactorArray ) )
 
     def convert_from_to_unit( self, value, from_unit, to_unit, squared=False):
         result = value
-        from_pos = -1
-        to_pos = -1
-
-        for i, u in enumerate(self.unitArray):
-            if u == from_unit:
-                from_pos = i
-            if u == to_unit:
-                to_pos = i
 
-        if from_pos >= 0 and to_pos >= 0:
-            f = self.unitFactorArray[from_pos] / self.unitFactorArray[to_pos]
+        if from_unit in self.unitFactor and to_unit in self.unitFactor:
+            f = self.unitFactor[from_unit] / self.unitFactor[to_unit]
             result = value*(f**2) if squared else value*f
         #print('{} {} -> {} {} '.format( value, from_unit, result, to_unit ) )
         return result
@@ -155,11 +352,335 @@ class unit:
 
         return self.unitFactorArrayInv[factorPos], self.unitArray[factorPos]
 
+    ### vectorized versions of the functions above for numpy arrays of values and units.
+    # Units may be a single unit or an array of the same shape as the values.
+    # The results are identical to the scalar functions applied to every element.
+
+    # returns the position in unitArray of every unit, -1 for invalid units
+    def get_unit_positions( self, units ):
+        units = numpy.asarray( units )
+        uniques, inverse = numpy.unique( units, return_inverse=True )
+        positions = numpy.array( [ self.unitPos.get( u, -1 ) for u in uniques ], dtype=numpy.int64 )
+        return positions[inverse].reshape( units.shape )
+
+    def convert_from_to_unit_array( self, values, from_units, to_units, squared=False ):
+        values   = numpy.asarray( values, dtype=numpy.float64 )
+        factors  = numpy.asarray( self.unitFactorArray, dtype=numpy.float64 )
+        from_pos = self.get_unit_positions( from_units )
+        to_pos   = self.get_unit_positions( to_units )
+        valid    = ( from_pos >= 0 ) & ( to_pos >= 0 )
+        f = numpy.where( valid, factors[from_pos] / factors[to_pos], 1.0 )
+        return values*(f**2) if squared else values*f
+
+    def convert_to_nm_array( self, values, units, squared=False ):
+        return self.convert_from_to_unit_array( values, units, 'nm', squared )
+
+    def make_length_readable_array( self, values, units, decimal = -1 ):
+        values    = numpy.asarray( values, dtype=numpy.float64 )
+        factors   = numpy.asarray( self.unitFactorArray, dtype=numpy.float64 )
+        valid     = numpy.broadcast_to( self.get_unit_positions( units ) >= 0, values.shape )
+        abs_value = numpy.where( valid, numpy.abs( self.convert_to_nm_array( values, units ) ), numpy.abs( values ) )
+        count     = numpy.where( valid, numpy.searchsorted( factors, abs_value*10, side='left' ), 0 )
+        f = numpy.where( count > 0, factors[count-1], 1.0 )
+        return_value = abs_value/f if decimal < 0 else numpy.round( abs_value/f, decimal )
+        return numpy.sign( values + ( values == 0 ) )*return_value, numpy.asarray( self.unitArray )[count-1]
+
+    def make_area_readable_array( self, values, units, decimal = 0 ):
+        units  = numpy.char.replace( numpy.asarray( units, dtype=str ), '²', '' )
+        values = numpy.asarray( values, dtype=numpy.float64 )
+        factors_squared = numpy.asarray( self.unitFactorArray, dtype=numpy.float64 )**2
+        valid  = numpy.broadcast_to( self.get_unit_positions( units ) >= 0, values.shape )
+        values = numpy.where( valid, self.convert_to_nm_array( values, units, True ), values )
+        count  = numpy.where( valid, numpy.searchsorted( factors_squared, values*(10**decimal), side='left' ), 0 )
+        f = numpy.where( count > 0, factors_squared[count-1], 1.0 )
+        return values/f, numpy.char.add( numpy.asarray( self.unitArray )[numpy.maximum( count-1, 0 )], '²' )
+
+    def autodetect_unit_array( self, values ):
+        values  = numpy.asarray( values, dtype=numpy.float64 )
+        above   = values[..., numpy.newaxis] * numpy.asarray( self.unitFactorArrayInv, dtype=numpy.float64 ) > 1
+        first   = numpy.argmax( above, axis=-1 )
+        factorPos = numpy.where( above.any( axis=-1 ) & ( first > 0 ), first - 1, 0 )
+        return numpy.asarray( self.unitFactorArrayInv )[factorPos], numpy.asarray( self.unitArray )[factorPos]
+
 
 def getEmptyScaling():
     return { 'x' : 1, 'y' : 1, 'unit' : 'px', 'editor':None}
 
-def setImageJScaling( scaling, verbose=False ):
+### metadata backends
+# The scaling is detected using a few tags of the first IFD. Each backend returns the width and height of the first page,
+# the number of pages which are not reduced images and the values of the requested tags of the first page.
+#   struct   reads only the IFD entries and the requested values using a few small reads, no image data and no
+#            other metadata are parsed. Requires no additional package. Files it can not parse are read by tifffile.
+#   tifffile parses all tags of all pages using tifffile
+#   pillow   parses all tags using Pillow
+metadata_backend = 'struct'
+
+# TIFF field type : ( struct format of a single value, size in bytes )
+tiff_field_types = {
+     1 : ( 'B', 1 ),  2 : ( 's', 1 ),  3 : ( 'H', 2 ),  4 : ( 'I', 4 ),  5 : ( 'II', 8 ), 6 : ( 'b', 1 ),
+     7 : ( 's', 1 ),  8 : ( 'h', 2 ),  9 : ( 'i', 4 ), 10 : ( 'ii', 8 ), 11 : ( 'f', 4 ), 12 : ( 'd', 8 ),
+    13 : ( 'I', 4 ), 16 : ( 'Q', 8 ), 17 : ( 'q', 8 ), 18 : ( 'Q', 8 ),
+}
+
+# ASCII tag values as returned by tifffile: trailing NULs and whitespace removed, UTF-8 or cp1252
+def decode_tiff_string( value ):
+    value = value.rstrip( b'\x00' )
+    try:
+        return value.decode( 'utf-8' ).strip()
+    except UnicodeDecodeError:
+        return value.decode( 'cp1252', 'replace' ).strip()
+
+# values of the FEI metadata text, converted to int, float or bool like tifffile does
+def convert_fei_value( value ):
+    for convert in [ int, float ]:
+        try:
+            return convert( value )
+        except ValueError:
+            pass
+    if value.lower() in [ 'true', 'false' ]:
+        return value.lower() == 'true'
+    return value
+
+# parse the FEI metadata text of tag 34680 / 34682 ( [Section] and key=value lines ) into { section : { key : value } }
+def parse_fei_metadata( data ):
+    if isinstance( data, bytes ):
+        data = data.split( b'\x00', 1 )[0]
+        try:
+            data = data.decode( 'utf-8' )
+        except UnicodeDecodeError:
+            data = data.decode( 'cp1252', 'replace' )
+    result  = {}
+    section = {}
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith( '[' ):
+            section = {}
+            result[line[1:-1]] = section
+            continue
+        key, separator, value = line.partition( '=' )
+        if separator != '':
+            section[key.strip()] = convert_fei_value( value.strip() )
+    return result
+
+# minimal reader of the IFDs of a TIFF or BigTIFF file. Reads the header, the entries of an IFD and the values of
+# requested tags using positioned reads (os.pread), nothing else of the file is touched.
+# file is a path or an open binary file (e.g. io.BytesIO). Raises ValueError if the file is no TIFF.
+class tiff_tag_reader:
+    def __init__( self, file ):
+        self.own_file = isinstance( file, ( str, bytes, os.PathLike ) )
+        self.file     = open( file, 'rb', 0 ) if self.own_file else file
+        try:
+            self.fd = self.file.fileno() if hasattr( os, 'pread' ) else None
+        except ( AttributeError, OSError, io.UnsupportedOperation ):
+            self.fd = None
+        try:
+            header = self.read( 0, 16 )
+            if header[:2] not in [ b'II', b'MM' ]:
+                raise ValueError( 'not a TIFF file' )
+            self.byteorder = '<' if header[:2] == b'II' else '>'
+            version = struct.unpack( self.byteorder + 'H', header[2:4] )[0]
+            if version == 42:
+                self.count_format, self.offset_format, self.entry_size = 'H', 'I', 12
+                self.first_ifd = struct.unpack( self.byteorder + 'I', header[4:8] )[0]
+            elif version == 43 and len( header ) == 16:
+                self.count_format, self.offset_format, self.entry_size = 'Q', 'Q', 20
+                self.first_ifd = struct.unpack( self.byteorder + 'Q', header[8:16] )[0]
+            else:
+                raise ValueError( 'not a TIFF file (version {})'.format(version) )
+        except Exception:
+            self.close()
+            raise
+        self.offset_size = struct.calcsize( self.offset_format )
+
+    def read( self, offset, size ):
+        if self.fd is not None:
+            data = os.pread( self.fd, size, offset )
+        else:
+            self.file.seek( offset )
+            data = self.file.read( size )
+        if len( data ) < size:
+            raise ValueError( 'TIFF file is truncated at {}'.format(offset) )
+        return data
+
+    # returns the entries { code : ( type, count, value or offset bytes ) } of the IFD at offset and the offset of the next IFD
+    def read_ifd( self, offset ):
+        count_size = struct.calcsize( self.count_format )
+        count = struct.unpack( self.byteorder + self.count_format, self.read( offset, count_size ) )[0]
+        if count > 65535:
+            raise ValueError( 'invalid IFD at {}'.format(offset) )
+        data = self.read( offset + count_size, count*self.entry_size + self.offset_size )
+        entry_format = self.byteorder + 'HH' + self.count_format.replace( 'H', 'I' ) + '{}s'.format(self.offset_size)
+        entries = {}
+        for pos in range( 0, count*self.entry_size, self.entry_size ):
+            code, field_type, value_count, value = struct.unpack( entry_format, data[pos:pos+self.entry_size] )
+            entries.setdefault( code, ( field_type, value_count, value ) )
+        return entries, struct.unpack( self.byteorder + self.offset_format, data[-self.offset_size:] )[0]
+
+    # offsets of all IFDs of the main chain (pages), stops at an offset already visited
+    def iter_ifds( self ):
+        offset, visited = self.first_ifd, set()
+        while offset != 0 and not offset in visited:
+            visited.add( offset )
+            entries, next_offset = self.read_ifd( offset )
+            yield entries
+            offset = next_offset
+
+    # value of an IFD entry: str for ASCII, bytes for BYTE / UNDEFINED or if raw is set,
+    # a single number or a tuple of numbers ( numerator, denominator, ... for rationals )
+    def get_value( self, entry, raw=False ):
+        field_type, count, value = entry
+        if not field_type in tiff_field_types:
+            raise ValueError( 'unknown TIFF field type {}'.format(field_type) )
+        value_format, value_size = tiff_field_types[field_type]
+        size = count*value_size
+        if size > self.offset_size:
+            value = self.read( struct.unpack( self.byteorder + self.offset_format, value )[0], size )
+        else:
+            value = value[:size]
+        if field_type in [ 1, 2, 7 ] or raw:
+            return decode_tiff_string( value ) if field_type == 2 and not raw else value
+        values = struct.unpack( self.byteorder + value_format*count, value )
+        return values[0] if len( values ) == 1 else values
+
+    def close( self ):
+        if self.own_file:
+            self.file.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+# 254: NewSubfileType, bit 0 is set for reduced images (thumbnails, pyramid levels in the main chain)
+def is_reduced_ifd( reader, entries ):
+    return 254 in entries and reader.get_value( entries[254] ) & 1 == 1
+
+def read_metadata_struct( file, codes ):
+    with tiff_tag_reader( file ) as reader:
+        ifds = reader.iter_ifds()
+        entries = next( ifds, None )
+        if entries is None:
+            raise ValueError( 'TIFF file without IFD' )
+        if not ( 256 in entries and 257 in entries ):
+            raise ValueError( 'first IFD without image size' )
+        tags = { code : reader.get_value( entries[code], raw=code in [ 34680, 34682 ] ) for code in codes if code in entries }
+        reduced = [ is_reduced_ifd( reader, entries ) ] + [ is_reduced_ifd( reader, next_entries ) for next_entries in ifds ]
+        page_count = reduced.count( False ) if len( reduced ) > 1 else 1
+        return reader.get_value( entries[256] ), reader.get_value( entries[257] ), page_count, tags
+
+def read_metadata_tifffile( file, codes ):
+    with tifffile.TiffFile( file ) as tif:
+        page = tif.pages[0]
+        page_count = len( get_stack_pages( tif ) ) if len( tif.pages ) > 1 else 1
+        tags = { code : page.tags.get( code ).value for code in codes if code in page.tags }
+        return page.imagewidth, page.imagelength, page_count, tags
+
+def read_metadata_pillow( file, codes ):
+    with Image.open( file ) as img:
+        tags = {}
+        for code in codes:
+            if code in img.tag_v2:
+                value = img.tag[code]
+                if code in [ 34680, 34682 ] and isinstance( value[0], str ):
+                    value = ( value[0].encode( 'latin-1', 'replace' ), )
+                elif isinstance( value[0], str ):
+                    value = ( decode_tiff_string( value[0].encode( 'latin-1', 'replace' ) ), )
+                tags[code] = value[0] if len( value ) == 1 else value
+        width, height = img.size
+        page_count = 1
+        if getattr( img, 'n_frames', 1 ) > 1:
+            page_count = 0
+            for frame in range( img.n_frames ):
+                img.seek( frame )
+                if not img.tag_v2.get( 254, 0 ) & 1:
+                    page_count += 1
+        return width, height, page_count, tags
+
+metadata_backends = {
+    'struct'   : read_metadata_struct,
+    'tifffile' : read_metadata_tifffile,
+    'pillow'   : read_metadata_pillow,
+}
+
+# compact record of all metadata required to detect the scaling of a TIFF.
+# The file header is parsed only once. getImageJScaling, getFEIScaling, autodetectScaling
+# and getContentHeightFromMetaData accept the probe in place of (filename, workingDirectory).
+# If header_only is set, the file is never scanned for the content height beyond the parsed tags.
+# An open file or an in-memory buffer can be probed using file_handle.
+class metadata_probe:
+    scaling_tags = [ 270, 282, 283 ] # ImageDescription, XResolution, YResolution
+    fei_tags     = [ 34680, 34682 ]  # FEI metadata, 34682 is written by the FIB process
+
+    # backend: see metadata_backends, metadata_backend is used if None
+    def __init__( self, filename, workingDirectory, verbose=False, header_only=False, file_handle=None, backend=None ):
+        self.filename         = filename
+        self.workingDirectory = workingDirectory
+        self.file_path        = os.path.join( workingDirectory, filename )
+        self.header_only      = header_only or file_handle is not None
+        self.tag              = {} # same layout as PIL's img.tag: { code : (value,) }
+        self.fei_metadata     = None
+        self.fib_metadata     = None # tag 34682 of images created by the FIB process
+        self.width            = 0    # image width of the first page
+        self.height           = 0    # image height of the first page including the databar
+        self.page_count       = 1    # number of pages of stacks and multi-page files, thumbnails are not counted
+        self._contentHeight   = None
+
+        self.backend          = backend or metadata_backend
+
+        file = self.file_path if file_handle is None else file_handle
+        with trace_span( 'probe' ):
+            try:
+                self.width, self.height, self.page_count, tags = metadata_backends[self.backend]( file, self.scaling_tags + self.fei_tags )
+            except ( ValueError, struct.error ):
+                if self.backend != 'struct':
+                    raise
+                # unusual files (e.g. broken IFDs), tifffile reports a helpful error if it can not read them either
+                if file_handle is not None: file_handle.seek( 0 )
+                self.backend = 'tifffile'
+                self.width, self.height, self.page_count, tags = read_metadata_tifffile( file, self.scaling_tags + self.fei_tags )
+        for code in self.scaling_tags:
+            if code in tags:
+                self.tag[code] = ( tags[code], )
+        # same as tifffile's fei_metadata: the content of both FEI tags, parsed into dictionaries
+        for code in self.fei_tags:
+            if code in tags:
+                data = tags[code] if isinstance( tags[code], dict ) else parse_fei_metadata( tags[code] ) if isinstance( tags[code], ( str, bytes ) ) else None
+                if self.fei_metadata is None: self.fei_metadata = {}
+                if data is not None: self.fei_metadata.update( data )
+                if code == 34682: self.fib_metadata = data
+        if verbose: print( '  probed metadata of {} ({})'.format(filename, self.backend) )
+
+    # height of the image without the FEI databar, 0 if unknown
+    @property
+    def contentHeight( self ):
+        if self._contentHeight is None:
+            self._contentHeight = 0
+            for data in [ self.fei_metadata, self.fib_metadata ]:
+                if isinstance( data, dict ) and 'Image' in data and 'ResolutionY' in data['Image']:
+                    self._contentHeight = float( data['Image']['ResolutionY'] )
+                    break
+            else:
+                description = self.tag.get( 270, ( '', ) )[0]
+                if isinstance( description, str ) and 'ResolutionY' in description:
+                    self._contentHeight = findContentHeight( description.encode( 'utf-8', 'replace' ) )
+                if self._contentHeight == 0 and not self.header_only:
+                    self._contentHeight = scanContentHeight( self.file_path )
+        return self._contentHeight
+
+    # height of the FEI databar below the image content, 0 if there is none
+    @property
+    def databarHeight( self ):
+        contentHeight = self.contentHeight
+        return self.height - contentHeight if 0 < contentHeight < self.height else 0
+
+def get_metadata_probe( filename, workingDirectory='', verbose=False ):
+    if isinstance( filename, metadata_probe ):
+        return filename
+    return metadata_probe( filename, workingDirectory, verbose )
+
+# slices > 1 adds the number of images and the slice distance (scaling['z'] or the pixel width) of a stack
+def setImageJScaling( scaling, verbose=False, slices=0 ):
     if verbose: print('  set ImageJ scaling...', scaling)
     info = {}
     info[282] = round(1/scaling['x'], 6)
@@ -168,113 +689,122 @@ def setImageJScaling( scaling, verbose=False ):
         scaling['editor'] = 'FA.FIB.Toolbox'
     if scaling['editor'] == None: scaling['editor'] = '-'
     info[270] = "ImageJ={}\nunit={}".format(scaling['editor'], scaling['unit'])
+    if slices > 1:
+        info[270] = "ImageJ={}\nimages={}\nslices={}\nunit={}\nspacing={}\nloop=false".format(scaling['editor'], slices, slices, scaling['unit'], round( scaling.get( 'z', scaling['x'] ), 6 ))
     return info
 
-def getImageJScaling( filename, workingDirectory, verbose = False ):
+# the ImageDescription is an ASCII tag. Other characters are written as \uXXXX like ImageJ does, e.g. unit=\u00B5m
+def encode_imagej_description( description ):
+    return ''.join( c if ord( c ) < 128 else '\\u{:04X}'.format(ord( c )) for c in description ).encode( 'ascii' )
+
+def getImageJScaling( filename, workingDirectory='', verbose = False ):
     UC = unit()
     scaling = getEmptyScaling()
-    with Image.open( workingDirectory + os.sep + filename ) as img:
-        if ( 282 in img.tag ) and ( 283 in img.tag ):
-            if verbose: print( 'tag[282]: {}'.format(img.tag[282]) ) #x
-            if verbose: print( 'tag[283]: {}'.format(img.tag[283]) ) #y
-            x_tag = img.tag[282][0]
-            y_tag = img.tag[283][0]
-            #if verbose: print('image tags: ', x_tag, y_tag)
-            scaling['x'] = int( x_tag[1] )/ int( x_tag[0] )
-            scaling['y'] = int( y_tag[1] )/ int( y_tag[0] )
-        if 270 in img.tag:
-            if img.tag[270][0].find('PixelWidth_um') > -1:
-                pixel_size = get_eds_image_scaling( img, verbose )
-                scaling['x'] = pixel_size
-                scaling['y'] = pixel_size
-                scaling['unit'] = 'nm'
-                scaling['editor'] = 'EDS image by Aztec'
-                if verbose:
-                    print( '  Image is an ' + scaling['editor'] )
-                    print( '  {} x {} {}/px'.format(round( scaling['x'], 4), round( scaling['y'], 4), scaling['unit']) )
-            else:
-                # getimagej definitions
-                IJSettingString = img.tag[270][0].split('\n')
-                #print( IJSettingString )
-                IJSettingsArray = {}
-                for val in IJSettingString:
-                    if ( val != '' ):
-                        setting = val.split('=')
-                        if (len(setting) > 1 ):
-                            IJSettingsArray[setting[0]] = setting[1]
-                if ( 'ImageJ' in IJSettingsArray ):
-                    if ( 'FA.FIB.Toolbox' in IJSettingsArray['ImageJ'] ):
-                        if verbose: print( '  Image edited using F.A. Finger Institute Toolbox' )
-                        scaling['editor'] = 'F.A. FIB Toolbox'
-                    if ( 'FEI-SEM' in IJSettingsArray['ImageJ'] ):
-                        if verbose: print( '  Image edited using F.A. Finger Institute Toolbox using Metadata from a FEI / thermoScientific device' )
-                        scaling['editor'] = 'F.A. FIB Toolbox'
-                    if ( 'EDS image by Aztec' in IJSettingsArray['ImageJ'] ):
-                        if verbose: print( '  Image edited using F.A. Finger Institute Toolbox using Metadata from Aztec / Oxford' )
-                        scaling['editor'] = 'F.A. FIB Toolbox'
-                    else:
-                        if verbose: print( '  Image edited using {}'.format(IJSettingsArray['ImageJ']) )
-                        scaling['editor'] = IJSettingsArray['ImageJ']
-                if ( 'unit' in IJSettingsArray ):
-                    scaling['unit'] = IJSettingsArray['unit']
-                    if scaling['unit'] == "\\u00B5m": scaling['unit'] = 'µm'
-                    # images < 1 nm/px were recognized falsely in previeous versions and no valid unit was assigned.
-                    if not scaling['unit'] in UC.unitArray and scaling['x'] < 1 and scaling['x'] > 0 :
-                        if verbose: print('scale given but unit {} seems wrong'.format(scaling['unit']))
-                        factor, scaling['unit'] = UC.autodetect_unit(scaling['x'])
-                        scaling['x'] *= factor
-                        scaling['y'] *= factor
-                    if verbose: print( '  {} x {} {}/px'.format(round( scaling['x'], 4), round( scaling['y'], 4), scaling['unit']) )
-                elif verbose:
-                    print( '  unitless scaling: {} x {}'.format(round( scaling['x'], 4), round( scaling['y'], 4)) )
+    img = get_metadata_probe( filename, workingDirectory, verbose )
+    if ( 282 in img.tag ) and ( 283 in img.tag ):
+        if verbose: print( 'tag[282]: {}'.format(img.tag[282]) ) #x
+        if verbose: print( 'tag[283]: {}'.format(img.tag[283]) ) #y
+        x_tag = img.tag[282][0]
+        y_tag = img.tag[283][0]
+        #if verbose: print('image tags: ', x_tag, y_tag)
+        scaling['x'] = int( x_tag[1] )/ int( x_tag[0] )
+        scaling['y'] = int( y_tag[1] )/ int( y_tag[0] )
+    if 270 in img.tag:
+        if img.tag[270][0].find('PixelWidth_um') > -1:
+            pixel_size = get_eds_image_scaling( img, verbose )
+            scaling['x'] = pixel_size
+            scaling['y'] = pixel_size
+            scaling['unit'] = 'nm'
+            scaling['editor'] = 'EDS image by Aztec'
+            if verbose:
+                print( '  Image is an ' + scaling['editor'] )
+                print( '  {} x {} {}/px'.format(round( scaling['x'], 4), round( scaling['y'], 4), scaling['unit']) )
+        else:
+            # getimagej definitions
+            IJSettingString = img.tag[270][0].split('\n')
+            #print( IJSettingString )
+            IJSettingsArray = {}
+            for val in IJSettingString:
+                if ( val != '' ):
+                    setting = val.split('=')
+                    if (len(setting) > 1 ):
+                        IJSettingsArray[setting[0]] = setting[1]
+            if ( 'ImageJ' in IJSettingsArray ):
+                if ( 'FA.FIB.Toolbox' in IJSettingsArray['ImageJ'] ):
+                    if verbose: print( '  Image edited using F.A. Finger Institute Toolbox' )
+                    scaling['editor'] = 'F.A. FIB Toolbox'
+                if ( 'FEI-SEM' in IJSettingsArray['ImageJ'] ):
+                    if verbose: print( '  Image edited using F.A. Finger Institute Toolbox using Metadata from a FEI / thermoScientific device' )
+                    scaling['editor'] = 'F.A. FIB Toolbox'
+                if ( 'EDS image by Aztec' in IJSettingsArray['ImageJ'] ):
+                    if verbose: print( '  Image edited using F.A. Finger Institute Toolbox using Metadata from Aztec / Oxford' )
+                    scaling['editor'] = 'F.A. FIB Toolbox'
+                else:
+                    if verbose: print( '  Image edited using {}'.format(IJSettingsArray['ImageJ']) )
+                    scaling['editor'] = IJSettingsArray['ImageJ']
+            if ( 'spacing' in IJSettingsArray ):
+                scaling['z'] = float( IJSettingsArray['spacing'] )
+            if ( 'unit' in IJSettingsArray ):
+                scaling['unit'] = IJSettingsArray['unit']
+                if scaling['unit'] == "\\u00B5m": scaling['unit'] = 'µm'
+                # images < 1 nm/px were recognized falsely in previeous versions and no valid unit was assigned.
+                if not scaling['unit'] in UC.unitArray and scaling['x'] < 1 and scaling['x'] > 0 :
+                    if verbose: print('scale given but unit {} seems wrong'.format(scaling['unit']))
+                    factor, scaling['unit'] = UC.autodetect_unit(scaling['x'])
+                    scaling['x'] *= factor
+                    scaling['y'] *= factor
+                    if 'z' in scaling: scaling['z'] *= factor
+                if verbose: print( '  {} x {} {}/px'.format(round( scaling['x'], 4), round( scaling['y'], 4), scaling['unit']) )
+            elif verbose:
+                print( '  unitless scaling: {} x {}'.format(round( scaling['x'], 4), round( scaling['y'], 4)) )
     if verbose: print()
     return scaling
 
-def isFEIImage( filename, workingDirectory, verbose = False ):
-    with tifffile.TiffFile( workingDirectory + os.sep + filename ) as tif:
-        if ( tif.fei_metadata != None ):
-            return True
-        else:
-            if verbose: print('  no FEI / thermoScientific-Image')
+def isFEIImage( filename, workingDirectory='', verbose = False ):
+    probe = get_metadata_probe( filename, workingDirectory )
+    if ( probe.fei_metadata != None ):
+        return True
+    else:
+        if verbose: print('  no FEI / thermoScientific-Image')
     return False
 
-def getFEIScaling( filename, workingDirectory, verbose=False, save_scaled_image=False ):
+def getFEIScaling( filename, workingDirectory='', verbose=False, save_scaled_image=False ):
     scaling = getEmptyScaling()
     UC = unit()
-    with tifffile.TiffFile( workingDirectory + os.sep + filename ) as tif:
-        # extract infos from metadata
-        if ( tif.fei_metadata != None and tif.fei_metadata != {}):
-            if verbose: print( 'SEM image saved by an FEI / thermoScientific device' )
-            data = tif.fei_metadata
-        elif (34682 in tif.pages[0].tags._dict): # this only happened for some images created in the FIB process....
-            if verbose: print( 'SEM image saved by an FEI / thermoScientific device - probably created by FIB process' )
-            data = tif.pages[0].tags.get(34682).value
+    probe = get_metadata_probe( filename, workingDirectory )
+    # extract infos from metadata
+    if ( probe.fei_metadata != None and probe.fei_metadata != {}):
+        if verbose: print( 'SEM image saved by an FEI / thermoScientific device' )
+        data = probe.fei_metadata
+    elif ( probe.fib_metadata != None ): # this only happened for some images created in the FIB process....
+        if verbose: print( 'SEM image saved by an FEI / thermoScientific device - probably created by FIB process' )
+        data = probe.fib_metadata
+    else:
+        if verbose: print('  no FEI / thermoScientific-Image')
+        data = None
+
+    if data != None:
+        scaling['editor'] = 'FEI-SEM'
+        if 'Scan' in data.keys():
+            scaling['x'] = float( data['Scan']['PixelWidth'] )
+            scaling['y'] = float( data['Scan']['PixelHeight'] )
+
+            factor, scaling['unit'] = UC.autodetect_unit(scaling['x'])
+            scaling['x'] *= factor
+            scaling['y'] *= factor
         else:
-            if verbose: print('  no FEI / thermoScientific-Image')
-            data = None
-
-        if data != None:
-            scaling['editor'] = 'FEI-SEM'
-            if 'Scan' in data.keys():
-                scaling['x'] = float( data['Scan']['PixelWidth'] )
-                scaling['y'] = float( data['Scan']['PixelHeight'] )
-
-                factor, scaling['unit'] = UC.autodetect_unit(scaling['x'])
-                scaling['x'] *= factor
-                scaling['y'] *= factor
+            if not "navcam" in probe.filename.lower():
+                print( "   Image without scaling found. Assuming it is a NavCam image" )
             else:
-                if not "navcam" in filename.lower():
-                    print( "   Image without scaling found. Assuming it is a NavCam image" )
-                else:
-                    print( "   NavCam Image found. Set standard scaling.")
-                scaling['unit'] = 'mm'
-                scaling['x']    = 0.053191 # 470 px for 25mm
-                scaling['y']    = 0.053191
+                print( "   NavCam Image found. Set standard scaling.")
+            scaling['unit'] = 'mm'
+            scaling['x']    = 0.053191 # 470 px for 25mm
+            scaling['y']    = 0.053191
 
-            if save_scaled_image:
-                with Image.open( workingDirectory + os.sep + filename ) as img:
-                    filename_scaled = workingDirectory + os.sep + 'Scaled_' + filename if verbose else workingDirectory + os.sep + filename
-                    img.save( filename_scaled, tiffinfo = setImageJScaling( scaling ) )
+        if save_scaled_image:
+            with Image.open( probe.file_path ) as img:
+                filename_scaled = os.path.join( probe.workingDirectory, 'Scaled_' + probe.filename ) if verbose else probe.file_path
+                img.save( filename_scaled, tiffinfo = setImageJScaling( scaling ) )
 
     return scaling
 
@@ -284,104 +814,549 @@ def get_eds_image_scaling( img, verbose=False ):
     if verbose: print('eds', pixel_size_data)
     return float( pixel_size_data[0].replace(',','.') )*1000 # nm
 
-def autodetectScaling( filename, workingDirectory, verbose = False ):
-    scaling = getImageJScaling( filename, workingDirectory, verbose=verbose )
-    if scaling['editor'] == None:
-        if verbose: print('trying to detect FEI scaling')
-        scaling = getFEIScaling( filename, workingDirectory, save_scaled_image=False, verbose=verbose )
-    if scaling['editor'] == None:
-        if verbose: print( '{} was not saved using ImageJ or a SEM by FEI / thermoScientific'.format(filename) )
+def autodetectScaling( filename, workingDirectory='', verbose = False ):
+    with trace_span( 'detect' ):
+        probe = get_metadata_probe( filename, workingDirectory )
+        with trace_span( 'detect.imagej' ):
+            scaling = getImageJScaling( probe, verbose=verbose )
+        if scaling['editor'] == None:
+            if verbose: print('trying to detect FEI scaling')
+            with trace_span( 'detect.fei' ):
+                scaling = getFEIScaling( probe, save_scaled_image=False, verbose=verbose )
+        if scaling['editor'] == None:
+            if verbose: print( '{} was not saved using ImageJ or a SEM by FEI / thermoScientific'.format(probe.filename) )
     return scaling
 
-def getContentHeightFromMetaData( file_path, verbose=False ):
+# search the FEI metadata text in a buffer (bytes or mmap) for the original image height, starting at position start
+def findContentHeight( data, start=0 ):
     contentHeight = 0
-    with open(file_path, 'rb', 0) as file, \
-        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as s:
-        ## get original image height
-        if s.find(b'ResolutionY') != -1:
-            file.seek(s.find(b'ResolutionY'))
-            tempLine = str( file.readline() ).split("=",1)[1]
-            contentHeight = float( tempLine.split("\\",1)[0] )
+    pos = data.find(b'ResolutionY', start)
+    if pos != -1:
+        end = data.find(b'\n', pos)
+        tempLine = data[pos:end if end != -1 else len(data)]
+        try:
+            contentHeight = float( tempLine.split(b"=",1)[1].strip() )
+        except ( IndexError, ValueError ):
+            contentHeight = 0
+    return contentHeight
+
+# the FEI metadata text is written behind the image data, so only the end of a file is searched if the tags contain no height
+content_height_scan_bytes = 1024**2
+
+# search the last max_bytes of a file for the FEI metadata text, max_bytes <= 0 searches the whole file
+def scanContentHeight( file_path, max_bytes=None ):
+    if max_bytes is None:
+        max_bytes = content_height_scan_bytes
+    with open(file_path, 'rb', 0) as file:
+        size = os.fstat( file.fileno() ).st_size
+        if size == 0:
+            return 0
+        if 0 < max_bytes < size:
+            file.seek( size - max_bytes )
+            return findContentHeight( file.read( max_bytes ) )
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as s:
+            return findContentHeight( s )
+
+# original image height stored in the metadata of a tifffile page (FEI tags 34680 / 34682 or the image description), 0 if unknown
+def get_page_content_height( page ):
+    for code in [ 34680, 34682, 270 ]:
+        tag = page.tags.get( code )
+        if tag is None:
+            continue
+        value = tag.value
+        if isinstance( value, dict ):
+            if 'Image' in value and 'ResolutionY' in value['Image']:
+                return float( value['Image']['ResolutionY'] )
+        elif isinstance( value, ( str, bytes ) ):
+            contentHeight = findContentHeight( value.encode( 'utf-8', 'replace' ) if isinstance( value, str ) else value )
+            if contentHeight > 0:
+                return contentHeight
+    return 0
+
+# image height, content height and databar height of every page of a (multi-page) TIFF.
+# Pages without own FEI metadata use the content height of the previous page if their image height is the same, e.g. in stacks.
+def get_page_content_heights( filename, workingDirectory='' ):
+    file_path = os.path.join( workingDirectory, filename )
+    with tifffile.TiffFile( file_path ) as tif:
+        return get_content_heights_of_pages( tif.pages, file_path )
+
+# see get_page_content_heights, pages is a list of tifffile pages of the file file_path
+def get_content_heights_of_pages( pages, file_path ):
+    heights = []
+    previous = None
+    for index, page in enumerate( pages ):
+        height = page.imagelength
+        contentHeight = get_page_content_height( page )
+        if contentHeight == 0 and previous is not None and previous['height'] == height:
+            contentHeight = previous['contentHeight']
+        heights.append( { 'page' : index, 'height' : height, 'contentHeight' : contentHeight,
+                          'databarHeight' : height - contentHeight if 0 < contentHeight < height else 0 } )
+        previous = heights[-1]
+    if heights and heights[0]['contentHeight'] == 0:
+        # the metadata text may be stored outside of the tags
+        contentHeight = scanContentHeight( file_path )
+        for page in heights:
+            if page['height'] == heights[0]['height'] and 0 < contentHeight:
+                page['contentHeight'] = contentHeight
+                page['databarHeight'] = page['height'] - contentHeight if contentHeight < page['height'] else 0
+    return heights
+
+# file_path may also be a metadata_probe. The height is read from the tags, only the end of the file is searched otherwise.
+def getContentHeightFromMetaData( file_path, verbose=False ):
+    if isinstance( file_path, metadata_probe ):
+        contentHeight = file_path.contentHeight
+    else:
+        contentHeight = metadata_probe( file_path, '' ).contentHeight
     if ( contentHeight > 0 ):
         if verbose: print( "  detected content height: {} px".format(contentHeight) )# + str( height ) + '|' + str(contentHeight))
     else:
         if verbose: print( "  content height not detected" )
     return contentHeight
 
-def save_scalebar_image( pil_img, path, scaling, as_tiff = False, as_jpg = True ):
-    UC = unit()
-    w, h = pil_img.size
-    tiffinfo = setImageJScaling( scaling )
-
-    scale_width_dict = {800:500.0, 400:250.0, 200:100.0, 80:50.0, 40:25.0, 20:10.0, 8:5.0, 4:2.5}
-    _, readable_unit = UC.make_length_readable( w * scaling['x']/10, scaling['unit'])
-    if readable_unit != scaling['unit']:
-        scaling['x'] = UC.convert_from_to_unit( scaling['x'], scaling['unit'], readable_unit )
-        scaling['y'] = UC.convert_from_to_unit( scaling['y'], scaling['unit'], readable_unit )
-        scaling['unit'] = readable_unit
-
-    scaledImageWidth = w * scaling['x']
-
-    scaleWidth = 1
-    for i in scale_width_dict:
-        if scaledImageWidth > i:
-            scaleWidth = scale_width_dict[i]
-            break
-        #else:
-            #<break
-
-    scaleHeight = round( 0.004 * h )
-    scaleHeight = scaleHeight if scaleHeight > 1 else 1
-    fontSize = 6 * scaleHeight
-    pad_right = round(0.015 * w)
-    pad_bottom = round(0.01 * w)+2*scaleHeight+fontSize
-
-    # convert 16 bit images to 8 bit images.
-    # the font was somehow not displayed in 16 bit
-    # Since the scalebar is mainly used for publications, which are displayed in 8-bit anyway, this seems to be an okay workaround...
-    if pil_img.mode == 'I;16':
-        pil_img = Image.fromarray((numpy.array(pil_img)/65535*255).astype(numpy.uint8))
-
-    draw = ImageDraw.Draw(pil_img)
-
-    if pil_img.mode == 'L':
-        fill_color = 255
-    elif pil_img.mode == 'I;16':
-        fill_color = 0
+### 16 bit to 8 bit conversion
+# The conversion uses a lookup table of 65536 entries instead of float64 math on the whole image.
+# contrast:
+#   'exact'                 v/65535*255, bit exact to the previous conversion (default)
+#   'minmax'                stretch the min and max value of the image to 0..255
+#   'percentile[:low,high]' stretch the given percentiles [0.5,99.5] to 0..255, e.g. for 12 bit detectors
+#   'window:low,high'       stretch a fixed window of values to 0..255
+def parse_contrast( contrast ):
+    mode, _, params = contrast.partition(':')
+    if not mode in ['exact', 'minmax', 'percentile', 'window']:
+        raise ValueError( 'unknown contrast mode "{}"'.format(contrast) )
+    params = [ float(p) for p in params.split(',') ] if params != '' else []
+    if mode == 'percentile' and len(params) == 0: params = [0.5, 99.5]
+    if mode in ['percentile', 'window'] and len(params) != 2:
+        raise ValueError( 'contrast "{}" requires two values, e.g. {}:0,4095'.format(contrast, mode) )
+    return mode, params
+
+# histogram of all 16 bit values, computed in a single pass over chunks of rows
+def get_16bit_histogram( array, chunk_rows=256 ):
+    histogram = numpy.zeros( 65536, dtype=numpy.int64 )
+    for y in range( 0, array.shape[0], chunk_rows ):
+        histogram += numpy.bincount( array[y:y+chunk_rows].ravel(), minlength=65536 )
+    return histogram
+
+def get_16bit_lut( low=None, high=None ):
+    if low is None:
+        return ( numpy.arange( 65536 )/65535*255 ).astype( numpy.uint8 )
+    low, high = int(round(low)), int(round(high))
+    if high <= low: high = low + 1
+    values = numpy.clip( numpy.arange( 65536, dtype=numpy.int64 ) - low, 0, high - low )
+    return ( ( values*255 + (high - low)//2 ) // ( high - low ) ).astype( numpy.uint8 )
+
+def convert_16bit_to_8bit( array, contrast='exact', chunk_rows=256, out=None ):
+    array = numpy.asarray( array )
+    if array.dtype != numpy.uint16:
+        array = array.astype( numpy.uint16 )
+    mode, params = parse_contrast( contrast )
+    if mode == 'exact':
+        lut = get_16bit_lut()
+    elif mode == 'window':
+        lut = get_16bit_lut( params[0], params[1] )
     else:
-        fill_color = (255,255,255)
-
-    line_from = (round(w-(scaleWidth/scaling['x'] + pad_right)), h-pad_bottom)
-    line_to   = (w-pad_right, h-pad_bottom)
-    draw.line([line_from, line_to], fill=fill_color, width=scaleHeight)
-
-    font_path = home_dir + os.sep + "LinotypeSyntaxCom-Regular.ttf"
-    if not os.path.isfile(font_path):
-        font_path = home_dir + os.sep + "RobotoMono-VariableFont_wght.ttf"
-    fnt = ImageFont.truetype(font_path, fontSize)
+        histogram = get_16bit_histogram( array, chunk_rows )
+        if mode == 'minmax':
+            used = numpy.flatnonzero( histogram )
+            low, high = ( used[0], used[-1] ) if len(used) > 0 else ( 0, 65535 )
+        else:
+            cumulative = numpy.cumsum( histogram )
+            low  = numpy.searchsorted( cumulative, cumulative[-1]*params[0]/100, side='left' )
+            high = numpy.searchsorted( cumulative, cumulative[-1]*params[1]/100, side='left' )
+        lut = get_16bit_lut( low, high )
+
+    if out is None:
+        out = numpy.empty( array.shape, dtype=numpy.uint8 )
+    for y in range( 0, array.shape[0], chunk_rows ):
+        numpy.take( lut, array[y:y+chunk_rows], out=out[y:y+chunk_rows] )
+    return out
+
+### scalebar rendering
+# Renders the simplified scalebar for publications. Fonts, label masks and layouts are cached,
+# so rendering many images of the same geometry only costs the compositing into the pixel buffer.
+class scalebar_renderer:
+    scale_width_dict = {800:500.0, 400:250.0, 200:100.0, 80:50.0, 40:25.0, 20:10.0, 8:5.0, 4:2.5}
 
-    scaling_text = "{:.0f} {}".format(scaleWidth, readable_unit)
-    tw, _ = draw.textsize(scaling_text, font=fnt)
+    def __init__( self, font_path=None, contrast='exact' ):
+        parse_contrast( contrast )
+        self.contrast = contrast # conversion of 16 bit images, see convert_16bit_to_8bit()
+        if font_path is None:
+            font_path = home_dir + os.sep + "LinotypeSyntaxCom-Regular.ttf"
+            if not os.path.isfile(font_path):
+                font_path = home_dir + os.sep + "RobotoMono-VariableFont_wght.ttf"
+        self.font_path = font_path
+        self.fonts     = {} # size : font
+        self.masks     = {} # (text, size) : (mask, offset, width)
+        self.layouts   = {} # (w, h, x, unit) : layout
+
+    def get_font( self, size ):
+        if not size in self.fonts:
+            self.fonts[size] = ImageFont.truetype( self.font_path, size )
+        return self.fonts[size]
+
+    # returns the rasterized label as uint8 mask, its offset to the text origin and the text width
+    def get_label_mask( self, text, size ):
+        key = ( text, size )
+        if not key in self.masks:
+            font = self.get_font( size )
+            mask, offset = font.getmask2( text, 'L' )
+            mask = numpy.asarray( Image.frombytes( 'L', mask.size, bytes(mask) ) ) if mask.size[0]*mask.size[1] > 0 else numpy.zeros( (0, 0), dtype=numpy.uint8 )
+            self.masks[key] = ( mask, offset, font.getlength( text ) )
+        return self.masks[key]
+
+    def get_layout( self, w, h, scaling ):
+        key = ( w, h, scaling['x'], scaling['unit'] )
+        if not key in self.layouts:
+            UC = unit()
+            x = scaling['x']
+            _, readable_unit = UC.make_length_readable( w * x/10, scaling['unit'])
+            if readable_unit != scaling['unit']:
+                x = UC.convert_from_to_unit( x, scaling['unit'], readable_unit )
+
+            scaledImageWidth = w * x
+            scaleWidth = 1
+            for i in self.scale_width_dict:
+                if scaledImageWidth > i:
+                    scaleWidth = self.scale_width_dict[i]
+                    break
 
-    draw.text((round(w-((scaleWidth/scaling['x'])/2 + pad_right)-tw/2), h-pad_bottom+scaleHeight*2), scaling_text, font=fnt, fill=fill_color)
-    if as_tiff: pil_img.save(path, "tiff", compression='tiff_deflate', tiffinfo = tiffinfo)
-    if as_jpg:  pil_img.save(path+'.jpg')
+            scaleHeight = round( 0.004 * h )
+            scaleHeight = scaleHeight if scaleHeight > 1 else 1
+            fontSize = 6 * scaleHeight
+            pad_right = round(0.015 * w)
+            pad_bottom = round(0.01 * w)+2*scaleHeight+fontSize
+
+            text = "{:.0f} {}".format(scaleWidth, readable_unit)
+            mask, offset, tw = self.get_label_mask( text, fontSize )
+            line_y = h-pad_bottom
+            self.layouts[key] = {
+                'text'  : text,
+                'mask'  : mask,
+                # same pixels as ImageDraw.line() from (x0, line_y) to (x1, line_y)
+                'bar'   : ( line_y - (scaleHeight-1)//2, line_y + scaleHeight//2 + 1, round(w-(scaleWidth/x + pad_right)), w-pad_right + 1 ),
+                'label' : ( line_y+scaleHeight*2 + offset[1], round(w-((scaleWidth/x)/2 + pad_right)-tw/2) + offset[0] ),
+            }
+        return self.layouts[key]
+
+    # draws the scalebar into a uint8 array (h x w or h x w x channels) in place
+    def render_array( self, array, scaling, fill_color=255 ):
+        h, w = array.shape[:2]
+        layout = self.get_layout( w, h, scaling )
+
+        y0, y1, x0, x1 = layout['bar']
+        array[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)] = fill_color
+
+        # blend the label like ImageDraw.text(): (background*(255-mask) + ink*mask)/255
+        mask = layout['mask']
+        y0, x0 = layout['label']
+        y1, x1 = min( y0 + mask.shape[0], h ), min( x0 + mask.shape[1], w )
+        if y1 > max(y0, 0) and x1 > max(x0, 0):
+            mask = mask[max(0, -y0):y1-y0, max(0, -x0):x1-x0].astype( numpy.uint32 )
+            region = array[max(y0, 0):y1, max(x0, 0):x1]
+            if region.ndim == 3: mask = mask[..., numpy.newaxis]
+            tmp = region*(255 - mask) + numpy.asarray( fill_color, dtype=numpy.uint32 )*mask + 128
+            region[...] = ( ( tmp >> 8 ) + tmp ) >> 8
+        return array
+
+    # returns a new 8 bit image (L or RGB) with the scalebar
+    def render( self, pil_img, scaling ):
+        # convert 16 bit images to 8 bit images.
+        # the font was somehow not displayed in 16 bit
+        # Since the scalebar is mainly used for publications, which are displayed in 8-bit anyway, this seems to be an okay workaround...
+        if pil_img.mode.startswith('I;16'):
+            array = convert_16bit_to_8bit( numpy.asarray(pil_img), self.contrast )
+        elif pil_img.mode in ['L', 'RGB']:
+            array = numpy.array(pil_img)
+        else:
+            array = numpy.array(pil_img.convert('RGB'))
+        fill_color = 255 if array.ndim == 2 else (255,255,255)
+        return Image.fromarray( self.render_array( array, scaling, fill_color ) )
+
+    # render many images, images of the same size share the cached layout
+    def render_batch( self, pil_imgs, scaling ):
+        return [ self.render( pil_img, scaling ) for pil_img in pil_imgs ]
+
+# each process keeps one renderer per contrast mode to reuse the loaded fonts
+scalebar_renderers = {}
+def get_scalebar_renderer( contrast='exact' ):
+    if not contrast in scalebar_renderers:
+        scalebar_renderers[contrast] = scalebar_renderer( contrast=contrast )
+    return scalebar_renderers[contrast]
+
+### output profiles
+# codec:           'none', 'deflate', 'lzw', 'zstd' or 'lerc' (lzw, zstd and lerc require imagecodecs)
+# level:           compression level (deflate 1-9, zstd 1-22) or the maximum error of lerc, None = default of the codec
+# predictor:       horizontal differencing of integer images before the compression
+# tile:            tile size in px (multiple of 16), 0 = strips
+# preview:         format of the image with the simplified scalebar: 'jpeg' or 'webp'
+# preview_quality: quality of the preview (1-100)
+# workers:         threads compressing the strips / tiles of a single image, 0 = all CPU cores (shared by the files processed in parallel)
+# pyramid:         number of reduced resolution levels saved as tiled SubIFDs of the TIFFs, 0 = no pyramid
+# thumbnail:       save thumbnails of at most this size in px with a scalebar to thumb_<output folder>, 0 = no thumbnails
+output_codecs      = { 'none' : None, 'deflate' : 'zlib', 'lzw' : 'lzw', 'zstd' : 'zstd', 'lerc' : 'lerc' }
+preview_formats    = { 'jpeg' : ( 'JPEG', '.jpg' ), 'webp' : ( 'WEBP', '.webp' ) }
+output_profiles    = {
+    'default' : { 'codec' : 'deflate', 'level' : 6, 'predictor' : False, 'tile' : 0, 'preview' : 'jpeg', 'preview_quality' : 75, 'workers' : 0 , 'pyramid' : 0, 'thumbnail' : 0 },
+    'fast'    : { 'codec' : 'deflate', 'level' : 1, 'predictor' : False, 'tile' : 0, 'preview' : 'jpeg', 'preview_quality' : 75, 'workers' : 0 , 'pyramid' : 0, 'thumbnail' : 0 },
+    'small'   : { 'codec' : 'deflate', 'level' : 9, 'predictor' : True,  'tile' : 0, 'preview' : 'webp', 'preview_quality' : 80, 'workers' : 0 , 'pyramid' : 0, 'thumbnail' : 0 },
+    'none'    : { 'codec' : 'none',    'level' : None, 'predictor' : False, 'tile' : 0, 'preview' : 'jpeg', 'preview_quality' : 75, 'workers' : 0 , 'pyramid' : 0, 'thumbnail' : 0 },
+    'zstd'    : { 'codec' : 'zstd',    'level' : 5, 'predictor' : True,  'tile' : 0, 'preview' : 'jpeg', 'preview_quality' : 75, 'workers' : 0 , 'pyramid' : 0, 'thumbnail' : 0 },
+}
+
+# 'deflate:9' -> { 'codec' : 'deflate', 'level' : 9 }
+def parse_codec( spec ):
+    codec, _, level = spec.partition( ':' )
+    if not codec in output_codecs:
+        raise ValueError( 'unknown codec "{}", use {}'.format(codec, ', '.join( output_codecs )) )
+    try:
+        return { 'codec' : codec, 'level' : ( float( level ) if codec == 'lerc' else int( level ) ) if level != '' else None }
+    except ValueError:
+        raise ValueError( 'invalid level "{}" of the codec {}'.format(level, codec) )
+
+# 'webp:90' -> { 'preview' : 'webp', 'preview_quality' : 90 }
+def parse_preview( spec ):
+    preview, _, quality = spec.partition( ':' )
+    if not preview in preview_formats:
+        raise ValueError( 'unknown preview format "{}", use {}'.format(preview, ', '.join( preview_formats )) )
+    options = { 'preview' : preview }
+    if quality != '':
+        options['preview_quality'] = int( quality )
+    return options
+
+# returns a copy of the named profile updated by the given options, raises a ValueError for invalid settings
+def get_output_profile( name='default', options=None ):
+    if not name in output_profiles:
+        raise ValueError( 'unknown output profile "{}", use {}'.format(name, ', '.join( output_profiles )) )
+    profile = dict( output_profiles[name] )
+    if options is not None:
+        profile.update( options )
+    if not profile['codec'] in output_codecs:
+        raise ValueError( 'unknown codec "{}", use {}'.format(profile['codec'], ', '.join( output_codecs )) )
+    if profile['codec'] in [ 'lzw', 'zstd', 'lerc' ]:
+        try:
+            import imagecodecs
+        except ImportError:
+            raise ValueError( 'the codec {} requires the imagecodecs package'.format(profile['codec']) )
+    if profile['tile'] % 16 != 0 or profile['tile'] < 0:
+        raise ValueError( 'the tile size has to be a multiple of 16, not {}'.format(profile['tile']) )
+    if not profile['preview'] in preview_formats or not 1 <= profile['preview_quality'] <= 100:
+        raise ValueError( 'invalid preview {}:{}'.format(profile['preview'], profile['preview_quality']) )
+    if profile['pyramid'] < 0 or profile['thumbnail'] < 0:
+        raise ValueError( 'the number of pyramid levels and the thumbnail size cannot be negative' )
+    return profile
+
+# tifffile arguments for the compression of data with the given dtype
+def get_tiff_compression( profile, dtype ):
+    codec = profile['codec']
+    options = { 'compression' : output_codecs[codec], 'compressionargs' : None, 'predictor' : None, 'tile' : None,
+                'maxworkers' : profile['workers'] or os.cpu_count() }
+    if profile['level'] is not None and codec in [ 'deflate', 'zstd', 'lerc' ]:
+        options['compressionargs'] = { 'level' : profile['level'] }
+    if profile['predictor'] and codec in [ 'deflate', 'lzw', 'zstd' ] and dtype.kind in 'ui':
+        options['predictor'] = True
+    if profile['tile'] > 0:
+        options['tile'] = ( profile['tile'], profile['tile'] )
+    return options
+
+### image pyramids and thumbnails
+# The reduced levels are built in a single pass over the rows of the image. Every level halves the previous level
+# by averaging 2 x 2 pixels, so the full resolution image is reduced only once. The pixel size of level n is 2^n times
+# the pixel size of the image, the last row or column of odd sized levels is dropped.
+
+# halves the width and height of an array, palette and bilevel images are subsampled instead of averaged
+def reduce_array( data, average=True ):
+    data = data[:data.shape[0] // 2 * 2, :data.shape[1] // 2 * 2]
+    if not average:
+        return data[::2, ::2].copy()
+    if data.dtype.kind == 'f':
+        return ( data[0::2, 0::2] + data[1::2, 0::2] + data[0::2, 1::2] + data[1::2, 1::2] ) / 4
+    sum_type = numpy.int64 if data.dtype.kind == 'i' else numpy.uint32
+    total = data[0::2, 0::2].astype( sum_type ) + data[1::2, 0::2] + data[0::2, 1::2] + data[1::2, 1::2]
+    return ( ( total + 2 ) // 4 ).astype( data.dtype )
+
+# number of reduced levels of an image, limited to max_levels
+def get_pyramid_level_count( width, height, max_levels ):
+    levels = 0
+    while levels < max_levels and min( width, height ) >> ( levels + 1 ) > 0:
+        levels += 1
+    return levels
+
+# first level with a width and height of at most max_size px
+def get_thumbnail_level( width, height, max_size ):
+    level = 0
+    while max( width, height ) >> level > max_size:
+        level += 1
+    return level
+
+# scaling of the pixels of a reduced level
+def get_level_scaling( scaling, level ):
+    level_scaling = dict( scaling )
+    level_scaling['x'] *= 2**level
+    level_scaling['y'] *= 2**level
+    return level_scaling
+
+# Collects the reduced levels of an image given as blocks of rows (e.g. while it is streamed).
+# An odd row is kept until the next block arrives, so the blocks may have any height.
+class pyramid_builder:
+    # level_count: number of reduced levels
+    # keep:        levels stored in levels, None = all
+    # average:     see reduce_array
+    def __init__( self, level_count, keep=None, average=True ):
+        self.level_count = level_count
+        self.average     = average
+        self.pending     = [ None ] * level_count # odd row of the input of each level
+        self.rows        = { level : [] for level in ( range( 1, level_count + 1 ) if keep is None else keep ) if 0 < level <= level_count }
+
+    # add rows of the image (level 0). The rows are copied, so the buffer of the block may be reused afterwards.
+    def add( self, block, level=0 ):
+        if level >= self.level_count:
+            return
+        if self.pending[level] is not None:
+            block = numpy.concatenate( ( self.pending[level], block ) )
+            self.pending[level] = None
+        if len( block ) % 2 == 1:
+            self.pending[level] = block[-1:].copy()
+            block = block[:-1]
+        if len( block ) == 0:
+            return
+        reduced = reduce_array( block, self.average )
+        if level + 1 in self.rows:
+            self.rows[level + 1].append( reduced )
+        self.add( reduced, level + 1 )
+
+    # returns { level : array }
+    @property
+    def levels( self ):
+        return { level : numpy.concatenate( rows ) for level, rows in self.rows.items() if len( rows ) > 0 }
+
+# passes the row blocks through and adds them to the pyramid builder
+def iter_pyramid_rows( blocks, builder ):
+    for block in blocks:
+        builder.add( block )
+        yield block
+
+# write the reduced levels as SubIFDs of the image written before (subifds=len( levels )).
+# Levels are always tiled, the resolution tags are divided by the reduction factor of each level.
+# The levels have no ImageJ description, so their resolution is written without unit (the unit of the ImageJ description of the image).
+def write_pyramid_levels( out, levels, tiffinfo, profile, **options ):
+    for level in sorted( levels ):
+        data = levels[level]
+        factor = 2**level
+        out.write( data, subfiletype=1, resolution=( tiffinfo[282] / factor, tiffinfo[283] / factor ), resolutionunit='NONE',
+                   description=None, metadata=None, **options,
+                   **get_tiff_compression( dict( profile, tile=profile['tile'] or 256 ), data.dtype ) )
+
+# render the scalebar on the array of a reduced level, scaling is the scaling of the full resolution image
+def render_thumbnail( data, scaling, level, contrast='exact', mode=None, palette=None ):
+    if mode is None or mode == '1':
+        thumbnail = Image.fromarray( numpy.ascontiguousarray( data, dtype=data.dtype.newbyteorder( '=' ) ) )
+    else:
+        thumbnail = Image.frombuffer( mode, ( data.shape[1], data.shape[0] ), data.tobytes(), 'raw', mode, 0, 1 )
+    if palette is not None:
+        thumbnail.putpalette( palette )
+    return get_scalebar_renderer( contrast ).render( thumbnail, get_level_scaling( scaling, level ) )
+
+# reduce a PIL image to at most max_size px and render the scalebar at this resolution
+def get_thumbnail_image( pil_img, scaling, max_size, contrast='exact' ):
+    data  = numpy.asarray( pil_img )
+    level = get_thumbnail_level( pil_img.size[0], pil_img.size[1], max_size )
+    if level > 0:
+        builder = pyramid_builder( level, keep=[ level ], average=not pil_img.mode in [ '1', 'P' ] )
+        builder.add( data )
+        data = builder.levels[level]
+    return render_thumbnail( data, scaling, level, contrast, pil_img.mode, pil_img.getpalette() if pil_img.mode == 'P' else None )
+
+# save a thumbnail of at most profile['thumbnail'] px with a scalebar in the preview format, the extension is appended to path
+def save_thumbnail( pil_img, path, scaling, contrast='exact', profile=None ):
+    if profile is None:
+        profile = output_profiles['default']
+    with trace_span( 'thumbnail' ) as span:
+        os.makedirs( os.path.dirname( path ), exist_ok=True )
+        thumbnail_img = get_thumbnail_image( pil_img, scaling, profile['thumbnail'], contrast )
+        span.add_bytes( written=os.path.getsize( save_preview( thumbnail_img, path, profile ) ) )
+
+# PIL modes written by tifffile, all other modes are saved by Pillow using deflate
+tiff_photometric = { '1' : 'minisblack', 'L' : 'minisblack', 'LA' : 'minisblack', 'I' : 'minisblack', 'F' : 'minisblack',
+                     'I;16' : 'minisblack', 'I;16L' : 'minisblack', 'I;16B' : 'minisblack',
+                     'RGB' : 'rgb', 'RGBA' : 'rgb', 'CMYK' : 'separated', 'P' : 'palette' }
+
+# encode a PIL image as TIFF using the output profile, output is a path or a file handle.
+# The strips or tiles are compressed by profile['workers'] threads.
+def write_tiff( pil_img, output, tiffinfo, profile=None ):
+    if profile is None:
+        profile = output_profiles['default']
+    if not pil_img.mode in tiff_photometric:
+        pil_img.save( output, format='TIFF', compression='tiff_deflate', tiffinfo = tiffinfo )
+        return
+    data = numpy.asarray( pil_img )
+    colormap = None
+    if pil_img.mode == 'P':
+        palette = numpy.array( pil_img.getpalette(), dtype=numpy.uint16 ).reshape( -1, 3 )
+        colormap = numpy.zeros( ( 3, 256 ), dtype=numpy.uint16 )
+        colormap[:, :len( palette )] = palette.T * 257
+    levels = {}
+    level_count = get_pyramid_level_count( pil_img.size[0], pil_img.size[1], profile['pyramid'] )
+    if level_count > 0:
+        with trace_span( 'pyramid' ):
+            builder = pyramid_builder( level_count, average=not pil_img.mode in [ '1', 'P' ] )
+            builder.add( data )
+            levels = builder.levels
+    options = { 'photometric' : tiff_photometric[pil_img.mode], 'colormap' : colormap,
+                'extrasamples' : ( 'unassalpha', ) if pil_img.mode in [ 'LA', 'RGBA' ] else None }
+    with tifffile.TiffWriter( output, bigtiff = ( data.nbytes + sum( level.nbytes for level in levels.values() ) > 2**32 - 2**25 ) ) as out:
+        out.write( data, resolution=( tiffinfo[282], tiffinfo[283] ), description=encode_imagej_description( tiffinfo[270] ), metadata=None,
+                   subifds=len( levels ) or None, **options, **get_tiff_compression( profile, data.dtype ) )
+        write_pyramid_levels( out, levels, tiffinfo, profile, **options )
+
+# decode a TIFF written by write_tiff into a numpy array
+def read_tiff_pixels( file_handle, mode ):
+    if mode in tiff_photometric:
+        return tifffile.imread( file_handle )
+    with Image.open( file_handle ) as img:
+        return numpy.asarray( img )
+
+# save a PIL image as preview in the format of the output profile, the extension is appended to the returned path
+def save_preview( pil_img, path, profile=None ):
+    if profile is None:
+        profile = output_profiles['default']
+    file_format, extension = preview_formats[profile['preview']]
+    pil_img.save( path + extension, format=file_format, quality=profile['preview_quality'] )
+    return path + extension
+
+def save_scalebar_image( pil_img, path, scaling, as_tiff = False, as_jpg = True, renderer = None, contrast='exact', profile=None ):
+    tiffinfo = setImageJScaling( scaling )
+    if renderer is None:
+        renderer = get_scalebar_renderer( contrast )
+    with trace_span( 'scalebar' ):
+        pil_img = renderer.render( pil_img, scaling )
+
+    if as_tiff: write_tiff( pil_img, path, tiffinfo, profile )
+    if as_jpg:
+        with trace_span( 'preview' ) as span:
+            span.add_bytes( written=os.path.getsize( save_preview( pil_img, path, profile ) ) )
+
+# copy the pixel data of a PIL image into a new image without any metadata.
+# The raw buffer is handed over to the new image instead of creating a python object per pixel,
+# which works for all modes (L, P, RGB, RGBA, CMYK, I;16, ...).
+def get_metafree_image( img ):
+    metafree_img = Image.frombuffer( img.mode, img.size, img.tobytes(), 'raw', img.mode, 0, 1 )
+    if img.mode in ['P', 'PA'] and img.getpalette() != None:
+        metafree_img.putpalette( img.getpalette() )
+    return metafree_img
 
 # open a grayscale FEI-Image without the standard scalebar
 def get_image_without_scalebar(base_dir, filename, to_opencv=False, verbose=False ):
-    file_path = base_dir + os.sep + filename
-    scaling = autodetectScaling( filename, base_dir, verbose )
-    contentHeight = getContentHeightFromMetaData( file_path, verbose=False )
-    with Image.open( file_path ) as img:
+    probe = metadata_probe( filename, base_dir )
+    scaling = autodetectScaling( probe, verbose=verbose )
+    contentHeight = getContentHeightFromMetaData( probe, verbose=False )
+    if to_opencv:
+        # the array is read without an intermediate PIL image
+        return get_native_array( get_image_array( probe, contentHeight, all_pages=False ) ), scaling
+    with Image.open( probe.file_path ) as img:
         width, height = img.size
         #tiffinfo = setImageJScaling( scaling )
 
-        if img.mode in ['L', 'P', 'RGB', 'RGBA', 'CMYK']:
-            # somehow this does not work with 16 bit greyscale images...
-            metafree_img = Image.new(img.mode, img.size)
-            metafree_img.putdata( list(img.getdata()) )
-        else :
-            metafree_img = Image.fromarray(numpy.asarray(img))
+        metafree_img = get_metafree_image( img )
 
         if contentHeight > 0:
             metafree_img = metafree_img.crop((0, 0, width, contentHeight))
@@ -390,168 +1365,1594 @@ def get_image_without_scalebar(base_dir, filename, to_opencv=False, verbose=Fals
             metafree_img = numpy.array(metafree_img)
     return metafree_img, scaling
 
-def save_scaling_in_image( base_dir, filename, save_with_new_scalebar, output_folder_name, verbose=True ):
+### batch export as numpy arrays
+# Analysis scripts usually only need the pixels without the databar and the scaling. The pixels are read by tifffile
+# without intermediate PIL images. Uncompressed images are memory mapped and cropped as view, so no pixel data is copied.
+
+# returns the pixels of the file as numpy array cropped to contentHeight (0 = not cropped), in the byte order of the file.
+# readonly:  memory mapped data is mapped read only instead of copy-on-write and decoded arrays are not writeable
+# all_pages: stacks are returned with the pages as first axis, otherwise only the first page is returned
+def get_image_array( probe, contentHeight=0, readonly=False, all_pages=True ):
+    mmap_mode = 'r' if readonly else 'c'
+    try:
+        with tifffile.TiffFile( probe.file_path ) as tif:
+            pages = get_stack_pages( tif ) if all_pages else [ tif.pages[0] ]
+            frames = list( iter_stack_frames( pages, mmap_mode ) )
+    except ValueError:
+        # codecs not supported by tifffile without imagecodecs (e.g. JPEG) are decoded by Pillow
+        with Image.open( probe.file_path ) as img:
+            frames = [ numpy.asarray( img ) if readonly else numpy.array( img ) ]
+    frames = [ frame[:int( contentHeight )] if 0 < contentHeight < len( frame ) else frame for frame in frames ]
+    if len( frames ) > 1:
+        data = numpy.stack( frames )
+    else:
+        data = frames[0]
+    if readonly and data.flags.writeable:
+        data.flags.writeable = False
+    return data
+
+# returns the array in the byte order of the machine, e.g. for OpenCV which rejects big-endian arrays (>u2).
+# Arrays already in this byte order (memory mapped views of little-endian files) are not copied.
+def get_native_array( data ):
+    native = data.astype( data.dtype.newbyteorder( '=' ), copy=False )
+    if not data.flags.writeable and native.flags.writeable:
+        native.flags.writeable = False
+    return native
+
+# ask the OS to read the file in the background, e.g. before it is memory mapped
+def prefetch_file( file_path ):
+    if hasattr( os, 'posix_fadvise' ):
+        fd = os.open( file_path, os.O_RDONLY )
+        try:
+            os.posix_fadvise( fd, 0, 0, os.POSIX_FADV_WILLNEED )
+        finally:
+            os.close( fd )
+
+# yields ( array, scaling ) of every file without the databar in the byte order of the machine, e.g. for a segmentation of whole directories:
+#   for array, scaling in iter_images_without_scalebar( glob.glob( '/folder/*.tif' ) ):
+# file_list: file paths or ( directory, filename ) tuples
+# prefetch:  number of files loaded by background threads ahead of the consumer, 0 = load in the calling thread
+# readonly:  see get_image_array
+# crop:      remove the FEI databar
+def iter_images_without_scalebar( file_list, prefetch=2, readonly=False, crop=True, verbose=False ):
+    def load( entry ):
+        directory, filename = os.path.split( os.path.abspath( entry ) ) if isinstance( entry, str ) else entry
+        probe = metadata_probe( filename, directory )
+        scaling = autodetectScaling( probe, verbose=verbose )
+        if prefetch > 0: prefetch_file( probe.file_path )
+        return get_native_array( get_image_array( probe, getContentHeightFromMetaData( probe ) if crop else 0, readonly ) ), scaling
+
+    if prefetch <= 0:
+        for entry in file_list:
+            yield load( entry )
+        return
+    with concurrent.futures.ThreadPoolExecutor( max_workers=prefetch ) as executor:
+        futures = []
+        for entry in file_list:
+            futures.append( executor.submit( load, entry ) )
+            if len( futures ) > prefetch:
+                yield futures.pop( 0 ).result()
+        for future in futures:
+            yield future.result()
+
+### streaming export of large images
+# The source is read block by block (memory mapped if uncompressed) and written strip by strip,
+# so the memory usage is bounded by buffer_size instead of growing with the image size.
+
+# True if tifffile decodes the pixels of the page without imagecodecs and in the same way as Pillow (libtiff).
+# The first segment is decoded, since tifffile only reports a missing codec (e.g. LZW or JPEG) when it is used.
+# libtiff ignores the predictor of codecs other than LZW, deflate and zstd, tifffile does not.
+def can_decode_page( page ):
+    if page.predictor != 1 and not page.compression in [ 5, 8, 32946, 50000 ]:
+        return False
+    if page.compression == 1:
+        return True
+    try:
+        next( page.segments( maxworkers=1 ), None )
+    except ( KeyError, ValueError, ImportError ):
+        return False
+    return True
+
+# True if the first page can be read block by block. Other images (e.g. bilevel or LZW compressed) are processed in memory using Pillow.
+def can_stream_image( probe ):
+    with tifffile.TiffFile( probe.file_path ) as tif:
+        page = tif.pages[0]
+        return page.bitspersample % 8 == 0 and can_decode_page( page )
+
+# yields blocks of rows of the first page, stops reading after max_rows
+def iter_image_rows( page, max_rows, buffer_size ):
+    row_bytes = page.imagewidth * page.samplesperpixel * page.dtype.itemsize
+    block_rows = max( 1, buffer_size // row_bytes )
+    samples = page.samplesperpixel
+
+    if ( page.compression == 1 and page.is_contiguous and page.bitspersample % 8 == 0
+        and ( samples == 1 or page.planarconfig == 1 ) ):
+        data = numpy.memmap( page.parent.filehandle.path, mode='r', offset=page.dataoffsets[0],
+                             dtype=page.dtype.newbyteorder( page.parent.byteorder ), shape=page.shape )
+        for y in range( 0, max_rows, block_rows ):
+            yield data[y:min( y+block_rows, max_rows )]
+        del data
+    elif samples == 1 or page.planarconfig == 1:
+        chunk_height = page.tilelength if page.is_tiled else page.rowsperstrip
+        block = None
+        for segment, indices, _ in page.segments( maxworkers=1, buffersize=buffer_size ):
+            y, x = indices[-3], indices[-2]
+            if y >= max_rows: break
+            if block is None:
+                block = numpy.zeros( (chunk_height, page.imagewidth, samples), dtype=segment.dtype )
+            rows = min( segment.shape[1], page.imagelength - y )
+            cols = min( segment.shape[2], page.imagewidth - x )
+            block[:rows, x:x+cols] = segment[0, :rows, :cols]
+            if x + cols >= page.imagewidth:
+                rows = min( rows, max_rows - y )
+                yield block[:rows, :, 0] if samples == 1 else block[:rows]
+    else:
+        # planar RGB images are decoded completely
+        data = page.asarray()
+        if data.shape[0] == samples: data = numpy.moveaxis( data, 0, -1 )
+        for y in range( 0, max_rows, block_rows ):
+            yield data[y:min( y+block_rows, max_rows )]
+
+# returns the tifffile compression and a function encoding the bytes of a strip.
+# lerc is not supported for streamed strips, deflate is used instead.
+def get_strip_encoder( profile ):
+    codec, level = profile['codec'], profile['level']
+    if codec == 'none':
+        return None, bytes
+    if codec == 'lzw':
+        import imagecodecs
+        return 'lzw', imagecodecs.lzw_encode
+    if codec == 'zstd':
+        import imagecodecs
+        return 'zstd', lambda data: imagecodecs.zstd_encode( data, level )
+    return 'zlib', lambda data: zlib.compress( data, level if codec == 'deflate' and level is not None else 6 )
+
+# regroups the row blocks into strips encoded by encode( bytes ), the raw pixel data is added to hasher if given.
+# predictor: horizontal differencing of the rows before the encoding
+# workers:   number of threads encoding strips in parallel, at most 2*workers strips are held in memory
+def iter_encoded_strips( blocks, rowsperstrip, encode, predictor=False, hasher=None, workers=1 ):
+    row_layout = {}
+    # the blocks may share a buffer, so the rows are copied into bytes immediately
+    def iter_strips():
+        pending = []
+        pending_rows = 0
+        for block in blocks:
+            block = block.astype( block.dtype.newbyteorder('<'), copy=False )
+            row_layout['dtype'], row_layout['shape'] = block.dtype, block.shape[1:]
+            pos = 0
+            while pos < len( block ):
+                take = min( rowsperstrip - pending_rows, len( block ) - pos )
+                pending.append( block[pos:pos+take].tobytes() )
+                if hasher is not None: hasher.update( pending[-1] )
+                pending_rows += take
+                pos += take
+                if pending_rows == rowsperstrip:
+                    yield b''.join( pending )
+                    pending = []
+                    pending_rows = 0
+        if pending_rows > 0:
+            yield b''.join( pending )
+
+    def encode_strip( data ):
+        if predictor:
+            rows = numpy.frombuffer( data, dtype=row_layout['dtype'] ).reshape( ( -1, ) + row_layout['shape'] )
+            strip = rows.copy()
+            strip[:, 1:] -= rows[:, :-1]
+            data = strip.tobytes()
+        return encode( data )
+
+    if workers <= 1:
+        for strip in iter_strips():
+            yield encode_strip( strip )
+        return
+    with concurrent.futures.ThreadPoolExecutor( max_workers=workers ) as executor:
+        futures = []
+        for strip in iter_strips():
+            futures.append( executor.submit( encode_strip, strip ) )
+            if len( futures ) >= 2*workers:
+                yield futures.pop( 0 ).result()
+        for future in futures:
+            yield future.result()
+
+# The reduced levels of the pyramid (profile['pyramid']) and the thumbnail_level are built while the rows are written and returned
+# as { level : array }. Pass the returned levels to save the cut image, they are cropped to its height.
+# The levels are held in memory in addition to buffer_size, up to a third of the size of the image.
+def save_image_streamed( probe, output_path, tiffinfo, contentHeight=0, buffer_size=64*1024**2, verbose=False, hasher=None, profile=None, levels=None, thumbnail_level=0 ):
+    if profile is None:
+        profile = output_profiles['default']
+    with tifffile.TiffFile( probe.file_path ) as tif:
+        page = tif.pages[0]
+        height = int( contentHeight ) if 0 < contentHeight < page.imagelength else page.imagelength
+        shape = ( height, page.imagewidth ) if page.samplesperpixel == 1 else ( height, page.imagewidth, page.samplesperpixel )
+        row_bytes = page.imagewidth * page.samplesperpixel * page.dtype.itemsize
+        rowsperstrip = max( 1, min( 2**16 // row_bytes, height ) )
+        if verbose: print( '  streaming {} rows to {} using a buffer of {:.1f} MB'.format(height, output_path, buffer_size/1024**2) )
+
+        compression, encode = get_strip_encoder( profile )
+        predictor = profile['predictor'] and compression is not None and page.dtype.kind in 'ui'
+        blocks = iter_image_rows( page, height, buffer_size )
+        level_count = get_pyramid_level_count( page.imagewidth, height, profile['pyramid'] )
+        builder = None
+        if levels is None and max( level_count, thumbnail_level ) > 0:
+            builder = pyramid_builder( max( level_count, thumbnail_level ), keep=list( range( 1, level_count + 1 ) ) + [ thumbnail_level ],
+                                       average=page.photometric != 3 )
+            blocks = iter_pyramid_rows( blocks, builder )
+        strips = iter_encoded_strips( blocks, rowsperstrip, encode, predictor, hasher, profile['workers'] or os.cpu_count() )
+        options = { 'photometric' : page.photometric, 'planarconfig' : 'contig' if page.samplesperpixel > 1 else None,
+                    'extrasamples' : page.extrasamples if len( page.extrasamples ) > 0 else None,
+                    'colormap' : page.colormap if page.photometric == 3 else None }
+        with tifffile.TiffWriter( output_path, bigtiff = ( height*row_bytes*( 4 if level_count > 0 else 3 )//3 > 2**32 - 2**25 ) ) as out:
+            out.write( data=strips, shape=shape, dtype=page.dtype, rowsperstrip=rowsperstrip, compression=compression,
+                       predictor=True if predictor else None, subifds=level_count or None,
+                       resolution=( tiffinfo[282], tiffinfo[283] ), description=encode_imagej_description( tiffinfo[270] ), metadata=None, **options )
+            if builder is not None:
+                levels = builder.levels
+            if level_count > 0:
+                with trace_span( 'pyramid' ):
+                    write_pyramid_levels( out, { level : levels[level][:height >> level] for level in range( 1, level_count + 1 ) }, tiffinfo, profile, **options )
+    return levels or {}
+
+# SHA-256 of the rows of the first page, read block by block like the streamed source (see iter_encoded_strips)
+def get_streamed_checksum( file_path, buffer_size=64*1024**2 ):
+    hasher = hashlib.sha256()
+    with tifffile.TiffFile( file_path ) as tif:
+        page = tif.pages[0]
+        for block in iter_image_rows( page, page.imagelength, buffer_size ):
+            hasher.update( block.astype( block.dtype.newbyteorder('<'), copy=False ).tobytes() )
+    return hasher.hexdigest()
+
+# check if the scaling detected in the saved image matches the scaling (1 % tolerance)
+def check_saved_scaling( scaling, set_scaling, filename, verbose=False ):
+    UC = unit()
+    if (    set_scaling['x']*1.01 > UC.convert_from_to_unit( scaling['x'], scaling['unit'], set_scaling['unit'])
+        and set_scaling['x']      < UC.convert_from_to_unit( scaling['x'], scaling['unit'], set_scaling['unit'])*1.01):
+        if verbose: print( "    {:.2f} {}/px".format(scaling['x'], scaling['unit']) )
+        return True
+    elif verbose:
+        print( "    Saving '{}' with the new scaling caused major deviations. Detected: {:.2f} {}/px, Saved: {:.2f} {}/px)".format(filename, scaling['x'], scaling['unit'], set_scaling['x'], set_scaling['unit']) )
+    return False
+
+# SHA-256 of the pixel values, 16 bit data is hashed little endian independent of the byte order in the file
+def get_pixel_checksum( pil_img ):
+    hasher = hashlib.sha256()
+    update_pixel_hash( hasher, numpy.asarray( pil_img ) )
+    return hasher.hexdigest()
+
+def update_pixel_hash( hasher, pixels ):
+    if pixels.dtype == bool: # PIL stores True as 255
+        pixels = pixels.astype( numpy.uint8 )
+    hasher.update( pixels.astype( pixels.dtype.newbyteorder('<'), copy=False ).tobytes() )
+
+# encode the image as TIFF in memory and verify the result before it is written to output_path
+# verify:   'off'  no verification
+#           'tags' detect the scaling from the IFD of the encoded buffer
+#           'full' additionally decode the buffer and compare the pixels with the source image
+# checksum: returns the SHA-256 of the pixel data if True, otherwise None
+def save_verified_tiff( pil_img, output_path, tiffinfo, scaling, verify='tags', checksum=False, verbose=False, profile=None ):
+    buffer, result, pixel_hash = encode_verified_tiff( pil_img, output_path, tiffinfo, scaling, verify, checksum, verbose, profile )
+    with trace_span( 'write' ) as span, open( output_path, 'wb' ) as file:
+        span.add_bytes( written=file.write( buffer.getbuffer() ) )
+    return result, pixel_hash
+
+# returns the encoded buffer, the verification result and the checksum (see save_verified_tiff)
+def encode_verified_tiff( pil_img, output_path, tiffinfo, scaling, verify='tags', checksum=False, verbose=False, profile=None ):
+    buffer = io.BytesIO()
+    with trace_span( 'encode' ):
+        write_tiff( pil_img, buffer, tiffinfo, profile )
+
+    result = True
+    filename = os.path.basename( output_path )
+    if verify != 'off':
+        with trace_span( 'verify' ):
+            buffer.seek(0)
+            set_scaling = autodetectScaling( metadata_probe( filename, os.path.dirname( output_path ), file_handle=buffer ) )
+            result = check_saved_scaling( scaling, set_scaling, filename, verbose )
+
+    pixel_hash = None
+    if checksum or verify == 'full':
+        with trace_span( 'checksum' ):
+            pixel_hash = get_pixel_checksum( pil_img )
+    if verify == 'full':
+        with trace_span( 'verify.pixels' ):
+            buffer.seek(0)
+            if get_pixel_checksum( read_tiff_pixels( buffer, pil_img.mode ) ) != pixel_hash:
+                print( "    the pixels saved in '{}' differ from the source image".format(filename) )
+                result = False
+    return buffer, result, pixel_hash if checksum else None
+
+### stacks and multi-page files
+# FIB-SEM slice series are saved as stacks of hundreds of pages. The pages are decoded, cropped and encoded by a thread pool
+# and written in their order to a multi-page TIFF (BigTIFF if required), so only a few frames are held in memory at once.
+
+# pages of the image, reduced resolution images (thumbnails) are skipped
+def get_stack_pages( tif ):
+    return [ page for page in tif.pages if not page.is_reduced ]
+
+# decode a single page, uncompressed pages are memory mapped using mmap_mode ('r' read only or 'c' copy-on-write)
+def read_stack_page( page, mmap_mode='r' ):
+    samples = page.samplesperpixel
+    if ( page.compression == 1 and page.is_contiguous and page.bitspersample % 8 == 0
+        and ( samples == 1 or page.planarconfig == 1 ) ):
+        return numpy.memmap( page.parent.filehandle.path, mode=mmap_mode, offset=page.dataoffsets[0],
+                             dtype=page.dtype.newbyteorder( page.parent.byteorder ), shape=page.shape )
+    data = page.asarray( maxworkers=1 )
+    if samples > 1 and data.shape[0] == samples: data = numpy.moveaxis( data, 0, -1 )
+    return data
+
+# decode the given pages in their order. Pages tifffile can not decode (see can_decode_page, e.g. LZW stacks written by
+# ImageJ or Pillow) are decoded by Pillow, which reads the pages one after another.
+def iter_stack_frames( pages, mmap_mode='r' ):
+    if len( pages ) == 0 or can_decode_page( pages[0] ):
+        for page in pages:
+            yield read_stack_page( page, mmap_mode )
+        return
+    pages = { page.index : page for page in pages }
+    with Image.open( next( iter( pages.values() ) ).parent.filehandle.path ) as img:
+        for index, frame in enumerate( ImageSequence.Iterator( img ) ):
+            if index in pages:
+                yield numpy.array( frame )
+
+# decode a page and encode it cropped to each of the given heights (0 = not cropped).
+# frame: the pixels of the page if they are already decoded (see iter_stack_frames)
+# Returns a list of ( frame, strips, rowsperstrip, predictor ), strips is None if the frame has to be encoded by tifffile.
+def encode_stack_page( page, heights, compression, encode, predictor=False, frame=None ):
+    if frame is None:
+        frame = read_stack_page( page )
+    encoded = []
+    for height in heights:
+        cropped = frame[:int( height )] if 0 < height < len( frame ) else frame
+        rowsperstrip = max( 1, min( 2**16 // max( 1, cropped[0].nbytes ), len( cropped ) ) )
+        use_predictor = predictor and compression is not None and cropped.dtype.kind in 'ui'
+        strips = None
+        if compression is not None and cropped.dtype != bool:
+            strips = list( iter_encoded_strips( [ cropped ], rowsperstrip, encode, use_predictor ) )
+        encoded.append( ( cropped, strips, rowsperstrip, use_predictor ) )
+    return encoded
+
+# write an encoded page (see encode_stack_page). Uncompressed pages of the same shape are stored contiguously as expected by ImageJ.
+def write_stack_page( out, encoded, page, tiffinfo, description, compression, contiguous=False ):
+    frame, strips, rowsperstrip, predictor = encoded
+    options = { 'photometric' : page.photometric, 'planarconfig' : 'contig' if page.samplesperpixel > 1 else None,
+                'extrasamples' : page.extrasamples if len( page.extrasamples ) > 0 else None,
+                'colormap' : page.colormap if page.photometric == 3 else None,
+                'resolution' : ( tiffinfo[282], tiffinfo[283] ), 'description' : description, 'metadata' : None }
+    if strips is not None:
+        out.write( data=iter( strips ), shape=frame.shape, dtype=frame.dtype.newbyteorder( '=' ), rowsperstrip=rowsperstrip,
+                   compression=compression, predictor=True if predictor else None, **options )
+    else:
+        out.write( frame, rowsperstrip=rowsperstrip, compression=compression, contiguous=contiguous and compression is None, **options )
+
+# SHA-256 of the pixels of all pages (see get_pixel_checksum)
+def get_stack_checksum( file_path ):
+    hasher = hashlib.sha256()
+    with tifffile.TiffFile( file_path ) as tif:
+        for frame in iter_stack_frames( get_stack_pages( tif ) ):
+            update_pixel_hash( hasher, frame )
+    return hasher.hexdigest()
+
+# save all pages of a stack with the given scaling to output_path.
+# cut_path:     additionally save the pages without the databar, if the content height of the first page is known
+# preview_path: save the first page with a simplified scalebar
+# thumbnail_path: save a thumbnail of the first page (see save_thumbnail)
+# hasher:       the pixels of all pages are added in their order
+# Returns the content height of the first page.
+def save_stack_scaled( probe, output_path, scaling, cut_path=None, preview_path=None, thumbnail_path=None, contrast='exact', verbose=False, hasher=None, profile=None ):
+    if profile is None:
+        profile = output_profiles['default']
+    compression, encode = get_strip_encoder( profile )
+    workers = profile['workers'] or os.cpu_count()
+    with tifffile.TiffFile( probe.file_path ) as tif:
+        tif.filehandle.set_lock( True ) # the pages are decoded in several threads
+        pages = get_stack_pages( tif )
+        heights = get_content_heights_of_pages( pages, probe.file_path )
+        contentHeight = heights[0]['contentHeight']
+        outputs = [ ( output_path, [ 0 ] * len( pages ) ) ]
+        if cut_path is not None and contentHeight > 0:
+            outputs.append( ( cut_path, [ h['contentHeight'] for h in heights ] ) )
+        if verbose: print( '  saving {} pages to {} using {} threads'.format(len( pages ), ', '.join( path for path, _ in outputs ), workers) )
+
+        writers = []
+        try:
+            for path, output_heights in outputs:
+                os.makedirs( os.path.dirname( path ), exist_ok=True )
+                # ImageJ only reads pages of the same size as stack
+                shapes = { ( int( h ) if 0 < h < page.imagelength else page.imagelength, ) + page.shape[1:] for h, page in zip( output_heights, pages ) }
+                uniform = len( shapes ) == 1 and len( { page.dtype for page in pages } ) == 1
+                tiffinfo = setImageJScaling( dict( scaling ), slices=len( pages ) if uniform else 0 )
+                bigtiff = sum( page.nbytes for page in pages ) > 2**32 - 2**25
+                writers.append( ( tifffile.TiffWriter( path, bigtiff=bigtiff ), tiffinfo, uniform ) )
+
+            def write_page( index, encoded ):
+                for ( out, tiffinfo, uniform ), page_output in zip( writers, encoded ):
+                    description = encode_imagej_description( tiffinfo[270] ) if index == 0 or not uniform else None
+                    write_stack_page( out, page_output, pages[index], tiffinfo, description, compression, uniform )
+                if hasher is not None:
+                    update_pixel_hash( hasher, encoded[0][0] )
+                if index == 0 and ( preview_path is not None or thumbnail_path is not None ):
+                    frame = encoded[-1][0]
+                    first_page = Image.fromarray( numpy.ascontiguousarray( frame, dtype=frame.dtype.newbyteorder( '=' ) ) )
+                    if preview_path is not None:
+                        os.makedirs( os.path.dirname( preview_path ), exist_ok=True )
+                        save_scalebar_image( first_page, preview_path, scaling, contrast=contrast, profile=profile )
+                    if thumbnail_path is not None:
+                        save_thumbnail( first_page, thumbnail_path, scaling, contrast, profile )
+
+            # pages tifffile can not decode are decoded by Pillow in this thread and only encoded by the pool
+            frames = None if can_decode_page( pages[0] ) else iter_stack_frames( pages )
+            with concurrent.futures.ThreadPoolExecutor( max_workers=workers ) as executor:
+                futures = []
+                for index, page in enumerate( pages ):
+                    page_heights = [ output_heights[index] for _, output_heights in outputs ]
+                    frame = next( frames ) if frames is not None else None
+                    futures.append( executor.submit( encode_stack_page, page, page_heights, compression, encode, profile['predictor'], frame ) )
+                    # at most 2*workers pages are held in memory
+                    if len( futures ) >= 2*workers:
+                        write_page( index - len( futures ) + 1, futures.pop( 0 ).result() )
+                for offset, future in enumerate( futures ):
+                    write_page( len( pages ) - len( futures ) + offset, future.result() )
+        finally:
+            for out, _, _ in writers:
+                out.close()
+    return contentHeight
+
+# buffer_size > 0 enables the streaming mode for very large images. No image with a simplified scalebar is saved in this mode.
+# In streaming mode the written file is read again block by block for the full verification.
+# profile: output profile (see get_output_profile), None = default profile
+def save_scaling_in_image( base_dir, filename, save_with_new_scalebar, output_folder_name, verbose=True, buffer_size=0, contrast='exact', verify='tags', checksum=False, profile=None ):
     result = False
-    scaling = autodetectScaling( filename, base_dir, verbose )
+    contentHeight = None
+    pixel_hash = None
+    if profile is None:
+        profile = output_profiles['default']
+    probe = metadata_probe( filename, base_dir )
+    scaling = autodetectScaling( probe, verbose=verbose )
     if scaling['editor'] != None:
-        file_path = base_dir + os.sep + filename
+        file_path = probe.file_path
 
-        of          = base_dir + os.sep + output_folder_name
-        of_cut      = base_dir + os.sep + 'cut_' + output_folder_name
-        of_scalebar = base_dir + os.sep + 'nsb_' + output_folder_name
+        of          = os.path.join( base_dir, output_folder_name )
+        of_cut      = os.path.join( base_dir, 'cut_' + output_folder_name )
+        of_scalebar = os.path.join( base_dir, 'nsb_' + output_folder_name )
+        of_thumb    = os.path.join( base_dir, 'thumb_' + output_folder_name )
+        with_thumbnail = save_with_new_scalebar and profile['thumbnail'] > 0
 
         if ( output_folder_name != '' ):
             if not os.path.exists(of):
                 os.makedirs(of)
 
-        with Image.open( file_path ) as img:
-            width, height = img.size
-            tiffinfo = setImageJScaling( scaling )
-
-            # create a new image to remove metadata
-            if img.mode in ['L', 'P', 'RGB', 'RGBA', 'CMYK']:
-                # somehow this does not work with 16 bit greyscale images...
-                metafree_img = Image.new(img.mode, img.size)
-                metafree_img.putdata( list(img.getdata()) )
-            else :
-                metafree_img = Image.fromarray(numpy.asarray(img))
-            metafree_img.save( of + filename, compression='tiff_deflate', tiffinfo = tiffinfo )#, resolution=UC.convert_from_to_unit(scale['x'],scale['unit'], 'cm'), resolution_unit=3 )#
+        tiffinfo = setImageJScaling( scaling )
+        stream = buffer_size > 0 and probe.page_count == 1 and can_stream_image( probe )
+        if buffer_size > 0 and probe.page_count == 1 and not stream and verbose:
+            print( "    '{}' can not be streamed (bilevel image or codec not supported by tifffile), processing it in memory".format(filename) )
+        if probe.page_count > 1:
+            hasher = hashlib.sha256() if checksum or verify == 'full' else None
+            with trace_span( 'stack' ) as span:
+                contentHeight = save_stack_scaled( probe, os.path.join( of, filename ), scaling,
+                                                   cut_path=os.path.join( of_cut, filename ) if save_with_new_scalebar else None,
+                                                   preview_path=os.path.join( of_scalebar, filename ) if save_with_new_scalebar else None,
+                                                   thumbnail_path=os.path.join( of_thumb, filename ) if with_thumbnail else None,
+                                                   contrast=contrast, verbose=verbose, hasher=hasher, profile=profile )
+                span.add_bytes( read=os.path.getsize( file_path ), written=os.path.getsize( os.path.join( of, filename ) ) )
+            result = True
+            if verify != 'off':
+                with trace_span( 'verify' ):
+                    result = check_saved_scaling( scaling, autodetectScaling( metadata_probe( filename, of, header_only=True ) ), filename, verbose )
+            if verify == 'full':
+                with trace_span( 'verify.pixels' ):
+                    if get_stack_checksum( os.path.join( of, filename ) ) != hasher.hexdigest():
+                        print( "    the pixels saved in '{}' differ from the source image".format(filename) )
+                        result = False
+            if checksum: pixel_hash = hasher.hexdigest()
+        elif stream:
+            hasher = hashlib.sha256() if checksum or verify == 'full' else None
+            thumbnail_level = get_thumbnail_level( probe.width, probe.height, profile['thumbnail'] ) if with_thumbnail else 0
+            with trace_span( 'stream' ) as span:
+                levels = save_image_streamed( probe, os.path.join( of, filename ), tiffinfo, buffer_size=buffer_size, verbose=verbose, hasher=hasher, profile=profile, thumbnail_level=thumbnail_level )
+                span.add_bytes( read=os.path.getsize( file_path ), written=os.path.getsize( os.path.join( of, filename ) ) )
+            result = True
+            if verify != 'off':
+                with trace_span( 'verify' ):
+                    result = check_saved_scaling( scaling, autodetectScaling( metadata_probe( filename, of, header_only=True ) ), filename, verbose )
+            if verify == 'full':
+                with trace_span( 'verify.pixels' ):
+                    if get_streamed_checksum( os.path.join( of, filename ), buffer_size ) != hasher.hexdigest():
+                        print( "    the pixels saved in '{}' differ from the source image".format(filename) )
+                        result = False
+            if checksum: pixel_hash = hasher.hexdigest()
 
-
-            # check if scalebar is detected without an error
-            set_scaling = autodetectScaling( filename, of )
-
-            UC = unit()
-            if (    set_scaling['x']*1.01 > UC.convert_from_to_unit( scaling['x'], scaling['unit'], set_scaling['unit'])
-                and set_scaling['x']      < UC.convert_from_to_unit( scaling['x'], scaling['unit'], set_scaling['unit'])*1.01):
-                if verbose: print( "    {:.2f} {}/px".format(scaling['x'], scaling['unit']) )
-                result = True
-            elif verbose:
-                print( "    Saving '{}' with the new scaling caused major deviations. Detected: {:.2f} {}/px, Saved: {:.2f} {}/px)".format(filename, scaling['x'], scaling['unit'], set_scaling['x'], set_scaling['unit']) )
-
-            # cut old scalebar and add simplified scalebar for publications
             if save_with_new_scalebar:
-                if not os.path.exists(base_dir + os.sep + 'nsb_' + output_folder_name):
-                    os.makedirs(base_dir + os.sep + 'nsb_' + output_folder_name)
-
-                contentHeight = getContentHeightFromMetaData( file_path, verbose=False )
+                with trace_span( 'content_height' ):
+                    contentHeight = getContentHeightFromMetaData( probe, verbose=False )
                 if contentHeight > 0:
                     if not os.path.exists(of_cut):
                         os.makedirs(of_cut)
-
-                    metafree_img = metafree_img.crop((0, 0, width, contentHeight))
-                    metafree_img.save( of_cut + filename, compression='tiff_deflate', tiffinfo = tiffinfo )
-
-                save_scalebar_image(metafree_img, path=of_scalebar + filename, scaling=scaling)
+                    with trace_span( 'stream.cut' ) as span:
+                        save_image_streamed( probe, os.path.join( of_cut, filename ), tiffinfo, contentHeight, buffer_size=buffer_size, verbose=verbose, profile=profile, levels=levels )
+                        span.add_bytes( written=os.path.getsize( os.path.join( of_cut, filename ) ) )
+                if thumbnail_level > 0:
+                    # the thumbnail is a reduced level of the streamed image
+                    thumbnail = levels[thumbnail_level]
+                    if contentHeight > 0: thumbnail = thumbnail[:int( contentHeight ) >> thumbnail_level]
+                    with trace_span( 'thumbnail' ) as span:
+                        os.makedirs( of_thumb, exist_ok=True )
+                        thumbnail_img = render_thumbnail( thumbnail, scaling, thumbnail_level, contrast )
+                        span.add_bytes( written=os.path.getsize( save_preview( thumbnail_img, os.path.join( of_thumb, filename ), profile ) ) )
+                if verbose: print( "    no image with a simplified scalebar is saved in streaming mode" )
+        else:
+            with Image.open( file_path ) as img:
+                width, height = img.size
+
+                # create a new image to remove metadata
+                with trace_span( 'metafree' ) as span:
+                    metafree_img = get_metafree_image( img )
+                    span.add_bytes( read=os.path.getsize( file_path ) )
+                result, pixel_hash = save_verified_tiff( metafree_img, os.path.join( of, filename ), tiffinfo, scaling, verify, checksum, verbose, profile )
+
+                # cut old scalebar and add simplified scalebar for publications
+                if save_with_new_scalebar:
+                    if not os.path.exists(of_scalebar):
+                        os.makedirs(of_scalebar)
+
+                    with trace_span( 'content_height' ):
+                        contentHeight = getContentHeightFromMetaData( probe, verbose=False )
+                    if contentHeight > 0:
+                        if not os.path.exists(of_cut):
+                            os.makedirs(of_cut)
+
+                        with trace_span( 'crop' ):
+                            metafree_img = metafree_img.crop((0, 0, width, contentHeight))
+                        with trace_span( 'cut' ) as span:
+                            write_tiff( metafree_img, os.path.join( of_cut, filename ), tiffinfo, profile )
+                            span.add_bytes( written=os.path.getsize( os.path.join( of_cut, filename ) ) )
+
+                    save_scalebar_image(metafree_img, path=os.path.join( of_scalebar, filename ), scaling=scaling, contrast=contrast, profile=profile)
+                    if with_thumbnail:
+                        save_thumbnail( metafree_img, os.path.join( of_thumb, filename ), scaling, contrast, profile )
     else:
         if verbose: print( "    no scaling information found in '{}'".format(filename) )
 
-    return [result, scaling, filename]
-
-# helper function for the multi file processing
-result_list = {}
-def log_result(result):
-    global result_list
-    if result[0]:
-        result_list[result[2]] = result[1]
+    return [result, scaling, filename, contentHeight, pixel_hash]
+
+### persistent scaling index
+# Stores the detected scaling and content height of every processed file in the working directory.
+# An entry is valid as long as size, modification time and a hash of the file header are unchanged.
+# The output settings (see get_output_settings) of every output folder are stored, so changed settings create the outputs again.
+class scaling_index:
+    index_filename    = '.tiff_scaling_index.json'
+    index_version     = 2
+    header_hash_bytes = 64*1024
+
+    def __init__( self, workingDirectory, rebuild=False, verbose=False ):
+        self.workingDirectory = workingDirectory
+        self.index_path       = os.path.join( workingDirectory, self.index_filename )
+        self.entries          = {}
+        self.verbose          = verbose
+        if not rebuild:
+            self.entries = load_scaling_index( workingDirectory )
+        if verbose: print( '  loaded {} entries from the scaling index'.format(len(self.entries)) )
+
+    def get_file_identity( self, filename ):
+        file_path = os.path.join( self.workingDirectory, filename )
+        stat = os.stat( file_path )
+        with open( file_path, 'rb' ) as file:
+            header_hash = hashlib.sha1( file.read( self.header_hash_bytes ) ).hexdigest()
+        return { 'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns, 'header_hash' : header_hash }
+
+    # returns the entry of an unchanged file or None
+    def lookup( self, filename ):
+        entry = self.entries.get( filename )
+        if entry is None:
+            return None
+        file_path = os.path.join( self.workingDirectory, filename )
+        try:
+            stat = os.stat( file_path )
+        except OSError:
+            return None
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        if entry['header_hash'] != self.get_file_identity( filename )['header_hash']:
+            return None
+        return entry
+
+    # True if the file is unchanged and has no scaling (nothing is written) or the output in output_folder_name
+    # was written using the same output_settings and still exists
+    def is_up_to_date( self, filename, output_folder_name, output_settings=None ):
+        output_folder_name = output_folder_name.rstrip( os.sep )
+        entry = self.lookup( filename )
+        if entry is None:
+            return False
+        if entry['scaling']['editor'] == None:
+            return True
+        if entry['outputs'].get( output_folder_name ) != ( output_settings or {} ):
+            return False
+        return os.path.isfile( os.path.join( self.workingDirectory, output_folder_name, filename ) )
+
+    # output_folder_name and checksum are only passed for successfully written and verified outputs
+    def update( self, filename, scaling, contentHeight=None, output_folder_name=None, checksum=None, output_settings=None ):
+        entry = self.lookup( filename )
+        if entry is None:
+            entry = self.get_file_identity( filename )
+            entry['outputs'] = {}
+        entry['scaling'] = dict( scaling )
+        if contentHeight != None:
+            entry['contentHeight'] = contentHeight
+        if checksum != None:
+            entry['checksum'] = checksum
+        if output_folder_name != None:
+            entry['outputs'][output_folder_name.rstrip( os.sep )] = output_settings or {}
+        self.entries[filename] = entry
+
+    def invalidate( self, filename=None ):
+        if filename is None:
+            self.entries = {}
+        else:
+            self.entries.pop( filename, None )
+
+    def save( self ):
+        temp_path = self.index_path + '.tmp'
+        with open( temp_path, 'w', encoding='utf-8' ) as file:
+            json.dump( { 'version' : self.index_version, 'entries' : self.entries }, file, ensure_ascii=False )
+        os.replace( temp_path, self.index_path )
+        if self.verbose: print( '  saved {} entries to the scaling index'.format(len(self.entries)) )
+
+# query the scaling index of a directory without touching the TIFFs
+# returns { filename : { 'scaling' : {...}, 'contentHeight' : ..., ... } }
+def load_scaling_index( workingDirectory ):
+    index_path = os.path.join( workingDirectory, scaling_index.index_filename )
+    if not os.path.isfile( index_path ):
+        return {}
+    try:
+        with open( index_path, 'r', encoding='utf-8' ) as file:
+            data = json.load( file )
+    except ( OSError, ValueError ):
+        print( '  the scaling index {} is damaged and will be rebuilt'.format(index_path) )
+        return {}
+    if data.get( 'version' ) != scaling_index.index_version:
+        return {}
+    return data['entries']
+
+### instrumentation
+# Spans measure the duration and the bytes read / written of the stages of a file.
+# A trace is collected per thread between start_trace() and stop_trace(), so files processed
+# in parallel threads or worker processes do not mix. The spans are returned with the file result.
+# Without a running trace, trace_span() returns a shared span doing nothing.
+class trace_thread_state( threading.local ):
+    spans = None # list of spans while a trace is running in this thread
+
+trace_state = trace_thread_state()
+
+class trace_span_timer:
+    __slots__ = [ 'spans', 'stage', 'bytes_read', 'bytes_written', 'start', 'wall_start' ]
+
+    def __init__( self, spans, stage ):
+        self.spans         = spans
+        self.stage         = stage
+        self.bytes_read    = 0
+        self.bytes_written = 0
+
+    def __enter__( self ):
+        self.wall_start = time.time()
+        self.start      = time.perf_counter()
+        return self
+
+    def __exit__( self, *exc_info ):
+        self.spans.append( { 'stage' : self.stage, 'start' : self.wall_start, 'seconds' : time.perf_counter() - self.start,
+                             'bytes_read' : self.bytes_read, 'bytes_written' : self.bytes_written } )
+        return False
+
+    def add_bytes( self, read=0, written=0 ):
+        self.bytes_read    += read
+        self.bytes_written += written
+
+class disabled_trace_span:
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc_info ):
+        return False
+
+    def add_bytes( self, read=0, written=0 ):
+        pass
+
+no_trace_span = disabled_trace_span()
+
+# with trace_span( 'encode' ) as span: ... span.add_bytes( written=n )
+def trace_span( stage ):
+    spans = trace_state.spans
+    if spans is None:
+        return no_trace_span
+    return trace_span_timer( spans, stage )
+
+def start_trace():
+    trace_state.spans = []
+
+# returns the spans collected since start_trace() and stops tracing in this thread
+def stop_trace():
+    spans = trace_state.spans
+    trace_state.spans = None
+    return spans if spans is not None else []
+
+# appends one json line per span of a file result to an open trace file
+def write_trace( trace_file, file_result ):
+    for span in file_result.get( 'trace' ) or []:
+        line = dict( span )
+        line['file_path'] = file_result['file_path']
+        line['worker']    = file_result.get( 'worker' )
+        trace_file.write( json.dumps( line ) + '\n' )
+
+# sums the spans of all files per stage
+class trace_summary:
+    def __init__( self ):
+        self.stages        = {}
+        self.files         = 0
+        self.seconds       = 0.0
+
+    def add( self, file_result ):
+        self.files   += 1
+        self.seconds += file_result.get( 'seconds', 0 )
+        for span in file_result.get( 'trace' ) or []:
+            stage = self.stages.setdefault( span['stage'], { 'count' : 0, 'seconds' : 0.0, 'max_seconds' : 0.0, 'bytes_read' : 0, 'bytes_written' : 0 } )
+            stage['count']         += 1
+            stage['seconds']       += span['seconds']
+            stage['max_seconds']    = max( stage['max_seconds'], span['seconds'] )
+            stage['bytes_read']    += span['bytes_read']
+            stage['bytes_written'] += span['bytes_written']
+
+    # nested stages (e.g. detect.imagej within detect) are included in the time of the outer stage
+    def print_summary( self ):
+        print( ' time per stage of {} files ({:.2f} s processing time, summed over all workers):'.format(self.files, self.seconds) )
+        print( "  {:<22} {:>6} {:>10} {:>10} {:>10} {:>7} {:>10} {:>10}".format('stage', 'count', 'total s', 'mean ms', 'max ms', 'share', 'read MB', 'written MB') )
+        for name, stage in sorted( self.stages.items(), key=lambda item: item[1]['seconds'], reverse=True ):
+            print( "  {:<22} {:>6} {:>10.3f} {:>10.2f} {:>10.2f} {:>6.1f}% {:>10.1f} {:>10.1f}".format(
+                name, stage['count'], stage['seconds'], stage['seconds']/stage['count']*1000, stage['max_seconds']*1000,
+                stage['seconds']/max( self.seconds, 1e-9 )*100, stage['bytes_read']/1024**2, stage['bytes_written']/1024**2 ) )
+
+### multi file processing
+
+# returns the structured result of a single file. Errors are caught and returned instead of being lost in a worker.
+# trace: add the spans of the stages to the result (see trace_span)
+def process_file( directory, filename, task='save', task_args={}, trace=False ):
+    file_path = directory + os.sep + filename
+    file_result = { 'file_path' : file_path, 'directory' : directory, 'filename' : filename, 'success' : False,
+                    'scaling' : None, 'contentHeight' : None, 'checksum' : None, 'error' : None, 'seconds' : 0, 'bytes' : 0 }
+    start = time.perf_counter()
+    if trace:
+        start_trace()
+        file_result['worker'] = '{}/{}'.format(os.getpid(), threading.current_thread().name)
+    try:
+        file_result['bytes'] = os.path.getsize( file_path )
+        if task == 'save':
+            result = save_scaling_in_image( directory, filename, **task_args )
+            file_result['success']       = result[0]
+            file_result['scaling']       = result[1]
+            file_result['contentHeight'] = result[3]
+            file_result['checksum']      = result[4]
+        else: # metadata only
+            probe = metadata_probe( filename, directory, header_only=task_args.get( 'header_only', True ) )
+            file_result['scaling']       = autodetectScaling( probe )
+            file_result['contentHeight'] = getContentHeightFromMetaData( probe )
+            file_result['success']       = file_result['scaling']['editor'] != None
+    except Exception as e:
+        file_result['error'] = '{}: {}'.format( type(e).__name__, e )
+        if task_args.get( 'verbose' ): traceback.print_exc()
+    file_result['seconds'] = time.perf_counter() - start
+    if trace:
+        file_result['trace'] = stop_trace()
+    return file_result
+
+def process_file_chunk( chunk, task='save', task_args={}, trace=False ):
+    return [ process_file( directory, filename, task, task_args, trace ) for directory, filename in chunk ]
+
+# split the file list into chunks, the largest files first.
+# A chunk is closed if it contains chunk_size files or its files are larger than max_chunk_bytes.
+def get_file_chunks( file_list, chunk_size=4, max_chunk_bytes=0 ):
+    sizes = {}
+    for directory, filename in file_list:
+        try:
+            sizes[(directory, filename)] = os.path.getsize( directory + os.sep + filename )
+        except OSError:
+            sizes[(directory, filename)] = 0
+    chunks = []
+    chunk, chunk_bytes = [], 0
+    for item in sorted( file_list, key=lambda item: sizes[item], reverse=True ):
+        chunk.append( item )
+        chunk_bytes += sizes[item]
+        if len( chunk ) >= chunk_size or ( max_chunk_bytes > 0 and chunk_bytes >= max_chunk_bytes ):
+            chunks.append( ( chunk, chunk_bytes ) )
+            chunk, chunk_bytes = [], 0
+    if len( chunk ) > 0:
+        chunks.append( ( chunk, chunk_bytes ) )
+    return chunks
+
+# The ETA is estimated from the number of finished files, since failed files take time without adding processed bytes.
+def print_progress( done_files, total_files, done_bytes, start ):
+    duration = max( time.perf_counter() - start, 1e-6 )
+    byte_rate = done_bytes / duration
+    eta = duration / done_files * ( total_files - done_files ) if done_files > 0 else 0
+    print( "  {} / {} files, {:.1f} files/s, {:.1f} MB/s, ETA {:.0f}:{:02.0f}".format(
+        done_files, total_files, done_files/duration, byte_rate/1024**2, eta//60, eta%60 ) )
+
+# initializer of every worker process. Spawned workers do not inherit the module settings of the parent.
+def init_process_worker( backend, initializer=None, initargs=() ):
+    global metadata_backend
+    metadata_backend = backend
+    if initializer is not None:
+        initializer( *initargs )
+
+# returns a process pool using the process_start_method.
+# fork:       the heavy modules are imported once by the parent and inherited by the workers
+# forkserver: the server imports this module and the heavy modules once, every worker is forked from the server
+# spawn:      every worker imports this module, the heavy modules are imported on first use
+def get_process_pool( max_workers, initializer=None, initargs=() ):
+    import multiprocessing
+    context = multiprocessing.get_context( process_start_method or None )
+    start_method = context.get_start_method()
+    if start_method == 'fork':
+        preload_modules()
+    elif start_method == 'forkserver':
+        context.set_forkserver_preload( [ '__main__' if __name__ == '__main__' else __name__ ] + preload_module_names )
+    return concurrent.futures.ProcessPoolExecutor( max_workers=max_workers, mp_context=context, initializer=init_process_worker,
+                                                   initargs=( metadata_backend, initializer, initargs ) )
+
+# process a list of ( directory, filename ) using a bounded pool of workers.
+# backend:            'process' for CPU bound work, 'thread' for I/O bound metadata only runs, 'serial' for debugging
+# max_inflight_bytes: no more chunks are submitted while the files being processed are larger (at least one chunk runs)
+# on_result:          called in the calling thread for every structured file result
+# trace:              add the spans of the stages of each file to its result
+# returns the list of all file results
+def process_file_list( file_list, task='save', task_args={}, process_count=0, backend='process', chunk_size=4,
+                       max_inflight_bytes=2*1024**3, on_result=None, show_progress=True, trace=False ):
+    if process_count < 1:
+        process_count = max( 1, os.cpu_count() - 1 )
+    chunks = get_file_chunks( file_list, chunk_size, max_inflight_bytes // process_count )
+    results = []
+    done_bytes = 0
+    start = time.perf_counter()
+
+    def handle_results( file_results ):
+        nonlocal done_bytes
+        for file_result in file_results:
+            results.append( file_result )
+            done_bytes += file_result['bytes']
+            if file_result['error'] != None:
+                print( "  failed to process '{}': {}".format(file_result['file_path'], file_result['error']) )
+            if on_result is not None:
+                on_result( file_result )
+        if show_progress:
+            print_progress( len(results), len(file_list), done_bytes, start )
+
+    if backend == 'serial':
+        for chunk, _ in chunks:
+            handle_results( process_file_chunk( chunk, task, task_args, trace ) )
+        return results
+
+    task_args = get_parallel_task_args( task_args, min( process_count, len( file_list ) ) )
+    executor = concurrent.futures.ThreadPoolExecutor( max_workers=process_count ) if backend == 'thread' else get_process_pool( process_count )
+    with executor:
+        inflight = {}
+        inflight_bytes = 0
+        pending = list( chunks )
+        while len( pending ) > 0 or len( inflight ) > 0:
+            # backpressure: limit the number of chunks and the size of the files in flight
+            while ( len( pending ) > 0 and len( inflight ) < 2*process_count
+                    and ( len( inflight ) == 0 or inflight_bytes + pending[0][1] <= max_inflight_bytes ) ):
+                chunk, chunk_bytes = pending.pop( 0 )
+                inflight[executor.submit( process_file_chunk, chunk, task, task_args, trace )] = ( chunk, chunk_bytes )
+                inflight_bytes += chunk_bytes
+            done, _ = concurrent.futures.wait( inflight, return_when=concurrent.futures.FIRST_COMPLETED )
+            for future in done:
+                chunk, chunk_bytes = inflight.pop( future )
+                inflight_bytes -= chunk_bytes
+                try:
+                    file_results = future.result()
+                except Exception as e: # e.g. a crashed worker process
+                    file_results = [ { 'file_path' : d + os.sep + f, 'directory' : d, 'filename' : f, 'success' : False, 'scaling' : None,
+                                       'contentHeight' : None, 'checksum' : None, 'error' : '{}: {}'.format( type(e).__name__, e ), 'seconds' : 0, 'bytes' : 0 } for d, f in chunk ]
+                handle_results( file_results )
+    return results
+
+# arguments of save_scaling_in_image given by the settings (see getBaseSettings)
+def get_task_args( settings ):
+    return { 'save_with_new_scalebar' : settings['save_with_new_scalebar'], 'output_folder_name' : settings['outputDirectory'],
+             'verbose' : settings['showDebuggingOutput'], 'buffer_size' : settings['buffer_size'], 'contrast' : settings['contrast'],
+             'verify' : settings['verify'], 'checksum' : settings['checksum'],
+             'profile' : get_output_profile( settings['output_profile'], settings['output_options'] ) }
+
+# the settings of task_args changing the written outputs, stored in the scaling index (the encoding threads do not change them)
+def get_output_settings( task_args ):
+    profile = task_args.get( 'profile' ) or output_profiles['default']
+    return { 'save_with_new_scalebar' : task_args.get( 'save_with_new_scalebar', False ), 'contrast' : task_args.get( 'contrast', 'exact' ),
+             'streamed' : task_args.get( 'buffer_size', 0 ) > 0, 'profile' : { key : profile[key] for key in profile if key != 'workers' } }
+
+# task_args of the files processed by parallel_files workers. profile['workers'] = 0 would start a thread per CPU core
+# in every worker, so the cores are shared between the workers instead (1 thread if there is a worker per core).
+def get_parallel_task_args( task_args, parallel_files ):
+    profile = task_args.get( 'profile' )
+    if profile is None or profile['workers'] != 0:
+        return task_args
+    return dict( task_args, profile=dict( profile, workers=max( 1, ( os.cpu_count() or 1 ) // max( 1, parallel_files ) ) ) )
+
+### staged processing pipeline
+# Overlaps reading, detection / transformation, encoding and writing of many files.
+# The stages are connected by bounded queues, so several files are in flight at the same time
+# while the memory stays bounded by the queue sizes:
+#   read      (threads)            prefetch the file content into memory
+#   transform (threads)            detect the scaling, remove the metadata, crop and render the scalebar
+#   encode    (processes/threads)  compression of the outputs (see output profiles) and verification
+#   write     (threads)            write the encoded outputs
+# The streaming mode for huge images (buffer_size) is not used in the pipeline.
+
+# encodes the outputs of a single file. Runs in a worker process of the pipeline.
+# Returns the encoded files, the verification result, the checksum and the spans if trace is True.
+def encode_outputs( outputs, scaling, verify='tags', checksum=False, profile=None, trace=False ):
+    if trace: start_trace()
+    encoded = []
+    result, pixel_hash = True, None
+    for output in outputs:
+        img = Image.frombuffer( output['mode'], output['size'], output['pixels'], 'raw', output['mode'], 0, 1 )
+        if output['palette'] != None:
+            img.putpalette( output['palette'] )
+        if output['format'] == 'TIFF':
+            buffer, output_result, output_hash = encode_verified_tiff( img, output['path'], output['tiffinfo'], scaling,
+                                                                       verify if output['verify'] else 'off', checksum and output['verify'], profile=profile )
+            if output['verify']:
+                result, pixel_hash = output_result, output_hash
+        else:
+            with trace_span( 'preview' ):
+                buffer = io.BytesIO()
+                img.save( buffer, format=output['format'], quality=( profile or output_profiles['default'] )['preview_quality'] )
+        encoded.append( ( output['path'], buffer.getvalue() ) )
+    return encoded, result, pixel_hash, stop_trace() if trace else []
+
+def get_encode_payload( pil_img, path, file_format, tiffinfo=None, verify=False ):
+    return { 'mode' : pil_img.mode, 'size' : pil_img.size, 'pixels' : pil_img.tobytes(), 'format' : file_format, 'path' : path,
+             'palette' : pil_img.getpalette() if pil_img.mode in ['P', 'PA'] else None, 'tiffinfo' : tiffinfo, 'verify' : verify }
+
+class processing_pipeline:
+    stage_names = [ 'read', 'transform', 'encode', 'write' ]
+
+    # workers:        number of workers per stage, e.g. { 'read' : 4, 'transform' : 2, 'encode' : 3, 'write' : 2 }
+    # queue_size:     maximum number of files waiting between two stages
+    # encode_backend: 'process' or 'thread'
+    # task_args:      arguments of save_scaling_in_image (save_with_new_scalebar, output_folder_name, contrast, verify, checksum, profile)
+    # trace:          add the spans of the stages of each file to its result
+    def __init__( self, task_args, workers=None, queue_size=4, encode_backend='process', on_result=None, show_progress=True, trace=False ):
+        cpu_count = os.cpu_count() or 1
+        self.workers = { 'read' : 4, 'transform' : max( 1, cpu_count//2 ), 'encode' : max( 1, cpu_count - 1 ), 'write' : 2 }
+        if workers is not None: self.workers.update( workers )
+        self.task_args      = get_parallel_task_args( task_args, self.workers['encode'] )
+        self.queue_size     = queue_size
+        self.encode_backend = encode_backend
+        self.on_result      = on_result
+        self.show_progress  = show_progress
+        self.trace          = trace
+        self.busy           = { name : 0.0 for name in self.stage_names }
+        self.duration       = 0.0
+        self.lock           = threading.Lock()
+
+    def read( self, item ):
+        if metadata_probe( item['filename'], item['directory'], header_only=True ).page_count > 1:
+            # stacks are processed page by page in the transform stage instead of reading the whole file
+            item['stack'] = True
+            item['bytes'] = os.path.getsize( item['file_path'] )
+            return
+        with trace_span( 'read' ) as span, open( item['file_path'], 'rb' ) as file:
+            item['data'] = file.read()
+            span.add_bytes( read=len( item['data'] ) )
+        item['bytes'] = len( item['data'] )
+
+    def transform( self, item ):
+        args = self.task_args
+        item['outputs'] = []
+        if item.get( 'stack' ):
+            keys = [ 'save_with_new_scalebar', 'output_folder_name', 'contrast', 'verify', 'checksum', 'profile' ]
+            result = save_scaling_in_image( item['directory'], item['filename'], verbose=False, **{ key : args[key] for key in keys if key in args } )
+            item['success'], item['scaling'], item['contentHeight'], item['checksum'] = result[0], result[1], result[3], result[4]
+            return
+        data = item.pop( 'data' )
+        probe = metadata_probe( item['filename'], item['directory'], file_handle=io.BytesIO( data ) )
+        scaling = autodetectScaling( probe )
+        item['scaling'] = scaling
+        if scaling['editor'] == None:
+            return
+        output_folder_name = args['output_folder_name']
+        tiffinfo = setImageJScaling( scaling )
+        with trace_span( 'metafree' ), Image.open( io.BytesIO( data ) ) as img:
+            metafree_img = get_metafree_image( img )
+        item['outputs'].append( get_encode_payload( metafree_img, os.path.join( item['directory'], output_folder_name, item['filename'] ), 'TIFF', tiffinfo, True ) )
+
+        if args.get( 'save_with_new_scalebar', True ):
+            # the file content is already in memory, no need to read the file again
+            with trace_span( 'content_height' ):
+                contentHeight = probe.contentHeight or findContentHeight( data, max( 0, len( data ) - content_height_scan_bytes ) )
+            item['contentHeight'] = contentHeight
+            if contentHeight > 0:
+                with trace_span( 'crop' ):
+                    metafree_img = metafree_img.crop( ( 0, 0, metafree_img.size[0], contentHeight ) )
+                item['outputs'].append( get_encode_payload( metafree_img, os.path.join( item['directory'], 'cut_' + output_folder_name, item['filename'] ), 'TIFF', tiffinfo ) )
+            with trace_span( 'scalebar' ):
+                scalebar_img = get_scalebar_renderer( args.get( 'contrast', 'exact' ) ).render( metafree_img, scaling )
+            profile = args.get( 'profile' ) or output_profiles['default']
+            file_format, extension = preview_formats[profile['preview']]
+            item['outputs'].append( get_encode_payload( scalebar_img, os.path.join( item['directory'], 'nsb_' + output_folder_name, item['filename'] + extension ), file_format ) )
+            if profile['thumbnail'] > 0:
+                with trace_span( 'thumbnail' ):
+                    thumbnail_img = get_thumbnail_image( metafree_img, scaling, profile['thumbnail'], args.get( 'contrast', 'exact' ) )
+                item['outputs'].append( get_encode_payload( thumbnail_img, os.path.join( item['directory'], 'thumb_' + output_folder_name, item['filename'] + extension ), file_format ) )
+
+    def encode( self, item ):
+        if len( item['outputs'] ) == 0:
+            return
+        args = ( item['outputs'], item['scaling'], self.task_args.get( 'verify', 'tags' ), self.task_args.get( 'checksum', False ), self.task_args.get( 'profile' ) )
+        if self.executor is not None:
+            # the spans of the worker process are added to the trace of this thread
+            item['encoded'], item['success'], item['checksum'], spans = self.executor.submit( encode_outputs, *args, self.trace ).result()
+            if self.trace: trace_state.spans.extend( spans )
+        else:
+            item['encoded'], item['success'], item['checksum'], _ = encode_outputs( *args )
+        del item['outputs']
+
+    def write( self, item ):
+        for path, data in item.pop( 'encoded', [] ):
+            os.makedirs( os.path.dirname( path ), exist_ok=True )
+            with trace_span( 'write' ) as span, open( path, 'wb' ) as file:
+                span.add_bytes( written=file.write( data ) )
+
+    # worker loop of a stage, the last worker of a stage forwards the end of the queue
+    def run_stage( self, name, in_queue, out_queue, remaining_workers ):
+        stage_function = getattr( self, name )
+        while True:
+            item = in_queue.get()
+            if item is None:
+                in_queue.put( None )
+                with self.lock:
+                    remaining_workers[name] -= 1
+                    last_worker = remaining_workers[name] == 0
+                if last_worker: out_queue.put( None )
+                return
+            if item['error'] == None:
+                start = time.perf_counter()
+                if self.trace: start_trace()
+                try:
+                    stage_function( item )
+                except Exception as e:
+                    item['error'] = '{}: {}'.format( type(e).__name__, e )
+                if self.trace: item['trace'].extend( stop_trace() )
+                with self.lock:
+                    self.busy[name] += time.perf_counter() - start
+            out_queue.put( item )
+
+    # processes a list of ( directory, filename ) and returns a list of structured file results (see process_file)
+    def run( self, file_list ):
+        start = time.perf_counter()
+        queues = [ queue.Queue( self.queue_size ) for _ in range( len( self.stage_names ) ) ] + [ queue.Queue() ]
+        remaining_workers = dict( self.workers )
+        self.executor = None
+        if self.encode_backend == 'process':
+            self.executor = get_process_pool( self.workers['encode'] )
+        threads = []
+        for i, name in enumerate( self.stage_names ):
+            for _ in range( self.workers[name] ):
+                thread = threading.Thread( target=self.run_stage, args=( name, queues[i], queues[i+1], remaining_workers ), daemon=True )
+                thread.start()
+                threads.append( thread )
+
+        def feed():
+            for directory, filename in file_list:
+                item = { 'file_path' : directory + os.sep + filename, 'directory' : directory, 'filename' : filename, 'success' : False,
+                         'scaling' : None, 'contentHeight' : None, 'checksum' : None, 'error' : None, 'seconds' : 0, 'bytes' : 0, 'start' : time.perf_counter() }
+                if self.trace:
+                    item['trace']  = []
+                    item['worker'] = 'pipeline'
+                queues[0].put( item )
+            queues[0].put( None )
+        threading.Thread( target=feed, daemon=True ).start()
+
+        results = []
+        done_bytes = 0
+        while True:
+            item = queues[-1].get()
+            if item is None: break
+            for key in [ 'data', 'outputs', 'encoded' ]: item.pop( key, None )
+            item['seconds'] = time.perf_counter() - item.pop( 'start' )
+            if item['error'] != None:
+                print( "  failed to process '{}': {}".format(item['file_path'], item['error']) )
+            results.append( item )
+            done_bytes += item['bytes']
+            if self.on_result is not None: self.on_result( item )
+            if self.show_progress: print_progress( len(results), len(file_list), done_bytes, start )
+        for thread in threads: thread.join()
+        if self.executor is not None: self.executor.shutdown()
+        self.duration = time.perf_counter() - start
+        return results
+
+    # share of the time the workers of each stage were busy
+    def get_utilization( self ):
+        return { name : self.busy[name] / ( max( self.duration, 1e-9 ) * self.workers[name] ) for name in self.stage_names }
+
+    def print_utilization( self ):
+        print( ' stage utilization:' )
+        for name, utilization in self.get_utilization().items():
+            print( "  {:>9}: {:5.1f} % of {} worker(s), {:.2f} s busy".format(name, utilization*100, self.workers[name], self.busy[name]) )
+
+### watch mode
+# Processes new or changed images as soon as they are completely written, e.g. on the share a SEM saves its images to.
+# Changes are detected using inotify on Linux or by scanning the directories. inotify does not report files written
+# by other computers to a network share, use polling for such shares.
+
+# Reports the paths of created, written or moved TIFFs and directories of the watched directories using the inotify API of Linux.
+# Raises an OSError if inotify is not available.
+class inotify_watcher:
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_Q_OVERFLOW, IN_ISDIR = 0x2, 0x8, 0x80, 0x100, 0x4000, 0x40000000
+    event_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__( self, directories, recursive=False, skipped_folders=[] ):
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL( ctypes.util.find_library( 'c' ) or 'libc.so.6', use_errno=True )
+        if not hasattr( self.libc, 'inotify_init1' ):
+            raise OSError( 'inotify is not available on this system' )
+        self.get_errno       = ctypes.get_errno
+        self.recursive       = recursive
+        self.skipped_folders = skipped_folders
+        self.watches         = {} # watch descriptor : directory
+        self.open_files      = set() # files written but not closed yet
+        self.fd = self.libc.inotify_init1( os.O_NONBLOCK | os.O_CLOEXEC )
+        if self.fd < 0:
+            raise OSError( self.get_errno(), 'inotify_init1 failed' )
+        for directory in directories:
+            self.add_directory( directory )
+
+    def add_directory( self, directory ):
+        wd = self.libc.inotify_add_watch( self.fd, os.fsencode( directory ), self.event_mask )
+        if wd < 0:
+            raise OSError( self.get_errno(), "cannot watch '{}'".format(directory) )
+        self.watches[wd] = directory
+        if self.recursive:
+            for entry in os.scandir( directory ):
+                if entry.is_dir() and not entry.name in self.skipped_folders:
+                    self.add_directory( entry.path )
+
+    # waits up to timeout seconds for changes. Returns a set of changed paths or None if all directories have to be scanned again.
+    def wait( self, timeout ):
+        changed = set()
+        if len( select.select( [ self.fd ], [], [], timeout )[0] ) == 0:
+            return changed
+        while True:
+            try:
+                data = os.read( self.fd, 64*1024 )
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len( data ):
+                wd, mask, _, length = struct.unpack_from( 'iIII', data, offset )
+                name = os.fsdecode( data[offset+16:offset+16+length].rstrip( b'\0' ) )
+                offset += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    changed = None
+                if changed is None or not wd in self.watches:
+                    continue
+                path = os.path.join( self.watches[wd], name )
+                if mask & self.IN_ISDIR:
+                    if self.recursive and not name in self.skipped_folders and os.path.isdir( path ):
+                        self.add_directory( path )
+                        changed.add( path ) # files moved in with the directory
+                elif is_tiff_file( name ):
+                    changed.add( path )
+                    if mask & ( self.IN_CLOSE_WRITE | self.IN_MOVED_TO ):
+                        self.open_files.discard( path )
+                    elif mask & ( self.IN_MODIFY | self.IN_CREATE ):
+                        self.open_files.add( path )
+            if changed is None:
+                return None
+
+    def close( self ):
+        os.close( self.fd )
+
+# False if the file is not a readable TIFF or the pixel data of the first page exceeds the file, e.g. while it is copied
+def is_complete_tiff( file_path ):
+    try:
+        with tifffile.TiffFile( file_path ) as tif:
+            page = tif.pages[0]
+            return max( offset + count for offset, count in zip( page.dataoffsets, page.databytecounts ) ) <= tif.filehandle.size
+    except Exception:
+        return False
+
+# keeps the fonts of the scalebar renderer loaded in every worker of the watch mode
+def warm_up_worker( contrast='exact' ):
+    get_scalebar_renderer( contrast ).render( Image.new( 'L', ( 1024, 768 ) ), { 'x' : 1.0, 'y' : 1.0, 'unit' : 'nm', 'editor' : '-' } )
+
+# initializer of the worker processes, Ctrl+C is handled by the main process which lets the workers finish their files
+def init_watch_worker( contrast='exact' ):
+    import signal
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+    warm_up_worker( contrast )
+
+class folder_watcher:
+    # input_paths: directories or glob patterns of directories to watch
+    # task_args:   arguments of save_scaling_in_image (save_with_new_scalebar, output_folder_name, ...)
+    # settle:      seconds the size and modification time of a file have to stay unchanged before it is processed.
+    #              Files still opened by a local writer (inotify) or incomplete TIFFs are processed after 10*settle of unchanged state.
+    # interval:    seconds between two scans of the directories if polling is used
+    # polling:     scan the directories instead of using inotify
+    # on_result:   called with the structured result of every processed file (see process_file)
+    def __init__( self, input_paths, task_args, recursive=False, process_count=0, backend='process', settle=2.0, interval=2.0,
+                  polling=False, use_index=True, on_result=None, verbose=False, trace=False ):
+        self.input_paths   = input_paths
+        self.recursive     = recursive
+        self.process_count = process_count or max( 1, os.cpu_count() - 1 )
+        self.task_args     = task_args if backend == 'serial' else get_parallel_task_args( task_args, self.process_count )
+        self.backend       = backend
+        self.settle        = settle
+        self.interval      = interval
+        self.polling       = polling
+        self.use_index     = use_index
+        self.on_result     = on_result
+        self.verbose       = verbose
+        self.trace         = trace
+        self.output_folder_name = task_args.get( 'output_folder_name', '' ).rstrip( os.sep )
+        self.skipped_folders    = [ self.output_folder_name ] + [ prefix + self.output_folder_name for prefix in [ 'cut_', 'nsb_', 'thumb_' ] ]
+        self.indices   = {} # directory : scaling_index
+        self.pending   = {} # ( directory, filename ) : ( size, mtime_ns, time the state was first seen )
+        self.done      = {} # ( directory, filename ) : ( size, mtime_ns ) when it was processed
+        self.running   = {} # future : ( directory, filename )
+        self.watcher   = None
+        self.counts    = { 'processed' : 0, 'failed' : 0, 'skipped' : 0 }
+
+    def get_directories( self ):
+        directories = []
+        for input_path in self.input_paths:
+            paths = sorted( glob.glob( input_path, recursive=True ) ) if glob.has_magic( input_path ) else [ input_path ]
+            directories += [ os.path.normpath( path ) for path in paths if os.path.isdir( path ) ]
+        return list( dict.fromkeys( directories ) )
+
+    def get_index( self, directory ):
+        if not self.use_index:
+            return None
+        if not directory in self.indices:
+            self.indices[directory] = scaling_index( directory, verbose=self.verbose )
+        return self.indices[directory]
+
+    # remember a new or changed file, it is processed once its state did not change for settle seconds
+    def update_file( self, directory, filename ):
+        key = ( directory, filename )
+        try:
+            stat = os.stat( directory + os.sep + filename )
+        except OSError:
+            self.pending.pop( key, None )
+            return
+        state = ( stat.st_size, stat.st_mtime_ns )
+        if self.done.get( key ) == state:
+            return
+        if key in self.pending and self.pending[key][:2] == state:
+            return
+        self.pending[key] = state + ( time.monotonic(), )
+
+    def add_paths( self, paths ):
+        for path in paths:
+            if os.path.isdir( path ):
+                for directory, filename in get_tiff_file_list( [ path ], self.recursive, self.output_folder_name ):
+                    self.update_file( directory, filename )
+            else:
+                directory, filename = os.path.split( path )
+                self.update_file( os.path.normpath( directory ), filename )
+
+    def scan( self ):
+        for directory, filename in get_tiff_file_list( self.get_directories(), self.recursive, self.output_folder_name ):
+            self.update_file( directory, filename )
+
+    # True if the file is neither opened by a writer nor an incomplete TIFF
+    def is_written( self, file_path ):
+        if self.watcher is not None and file_path in self.watcher.open_files:
+            return False
+        return is_complete_tiff( file_path )
+
+    # submit the files whose state did not change for settle seconds, skip files whose outputs are up to date
+    def submit_stable_files( self, executor ):
+        now = time.monotonic()
+        for key, ( size, mtime_ns, since ) in list( self.pending.items() ):
+            if key in self.running.values():
+                continue
+            self.update_file( *key )
+            if not key in self.pending or self.pending[key][2] != since or now - since < self.settle:
+                continue
+            if now - since < 10*self.settle and not self.is_written( key[0] + os.sep + key[1] ):
+                continue
+            del self.pending[key]
+            self.done[key] = ( size, mtime_ns )
+            directory, filename = key
+            index = self.get_index( directory )
+            if index is not None and index.is_up_to_date( filename, self.output_folder_name, get_output_settings( self.task_args ) ):
+                self.counts['skipped'] += 1
+                if self.verbose: print( " skipping unchanged '{}'".format(directory + os.sep + filename) )
+                continue
+            if executor is None:
+                self.finish( process_file( directory, filename, 'save', self.task_args, self.trace ) )
+            else:
+                self.running[executor.submit( process_file, directory, filename, 'save', self.task_args, self.trace )] = key
+
+    def collect_results( self ):
+        for future in [ future for future in self.running if future.done() ]:
+            del self.running[future]
+            self.finish( future.result() )
+
+    def finish( self, file_result ):
+        self.counts['failed' if file_result['error'] != None else 'processed'] += 1
+        index = self.get_index( file_result['directory'] )
+        if index is not None and file_result['error'] == None:
+            if file_result['success']:
+                index.update( file_result['filename'], file_result['scaling'], file_result['contentHeight'], self.output_folder_name,
+                              file_result['checksum'], get_output_settings( self.task_args ) )
+            else:
+                index.update( file_result['filename'], file_result['scaling'], file_result['contentHeight'] )
+            index.save()
+        if self.on_result is not None:
+            self.on_result( file_result )
+
+    # watches the directories until KeyboardInterrupt or for max_runtime seconds (0 = unlimited), returns the counts of
+    # processed, failed and skipped files. Existing files which are not up to date are processed first.
+    def run( self, max_runtime=0 ):
+        start = time.monotonic()
+        watcher = self.watcher = None
+        if not self.polling:
+            try:
+                watcher = self.watcher = inotify_watcher( self.get_directories(), self.recursive, self.skipped_folders )
+            except OSError as e:
+                print( '  inotify is not available ({}), polling every {} s'.format(e, self.interval) )
+        executor = None
+        contrast = self.task_args.get( 'contrast', 'exact' )
+        if self.backend == 'process':
+            executor = get_process_pool( self.process_count, initializer=init_watch_worker, initargs=( contrast, ) )
+        elif self.backend == 'thread':
+            executor = concurrent.futures.ThreadPoolExecutor( max_workers=self.process_count )
+            warm_up_worker( contrast )
+        else:
+            warm_up_worker( contrast )
+        print( " watching {} for new images ({}), stop using Ctrl+C".format(', '.join( self.get_directories() ), 'inotify' if watcher is not None else 'polling') )
+
+        self.scan()
+        last_scan = time.monotonic()
+        try:
+            while max_runtime <= 0 or time.monotonic() - start < max_runtime:
+                self.submit_stable_files( executor )
+                self.collect_results()
+                # wake up in time to check the stability of pending files
+                timeout = min( self.interval, self.settle / 2 ) if len( self.pending ) + len( self.running ) > 0 else self.interval
+                if max_runtime > 0: timeout = max( 0, min( timeout, max_runtime - ( time.monotonic() - start ) ) )
+                if watcher is None:
+                    time.sleep( max( 0, last_scan + timeout - time.monotonic() ) )
+                    self.scan()
+                    last_scan = time.monotonic()
+                else:
+                    changed = watcher.wait( timeout )
+                    if changed is None:
+                        self.scan()
+                    else:
+                        self.add_paths( changed )
+        except KeyboardInterrupt:
+            print( ' stopped watching' )
+        finally:
+            if executor is not None:
+                for future in concurrent.futures.as_completed( list( self.running ) ):
+                    self.finish( future.result() )
+                self.running = {}
+                executor.shutdown()
+            if watcher is not None:
+                watcher.close()
+                self.watcher = None
+        return self.counts
+
+### metadata only scan
+scan_fields = [ 'file_path', 'editor', 'x', 'y', 'unit', 'contentHeight', 'error' ]
+
+# detect the scaling of many files without decoding any pixel data
+# returns one row per file containing the scan_fields
+def scan_scaling( file_list, process_count=0, backend='thread', chunk_size=64, show_progress=False ):
+    rows = []
+    for file_result in process_file_list( file_list, 'scan', { 'header_only' : True }, process_count, backend, chunk_size, show_progress=show_progress ):
+        scaling = file_result['scaling'] if file_result['scaling'] != None else getEmptyScaling()
+        rows.append( { 'file_path' : file_result['file_path'], 'editor' : scaling['editor'], 'x' : scaling['x'], 'y' : scaling['y'],
+                       'unit' : scaling['unit'], 'contentHeight' : file_result['contentHeight'], 'error' : file_result['error'] } )
+    return sorted( rows, key=lambda row: row['file_path'] )
+
+# save the scan results as csv, json or parquet (requires pandas and pyarrow). The format is derived from the extension.
+def write_scan_results( rows, output_path, file_format=None ):
+    if file_format is None:
+        file_format = os.path.splitext( output_path )[1].lower().lstrip('.')
+    if file_format == 'csv':
+        with open( output_path, 'w', newline='', encoding='utf-8' ) as file:
+            writer = csv.DictWriter( file, fieldnames=scan_fields )
+            writer.writeheader()
+            writer.writerows( rows )
+    elif file_format == 'json':
+        with open( output_path, 'w', encoding='utf-8' ) as file:
+            json.dump( rows, file, ensure_ascii=False, indent=1 )
+    elif file_format == 'parquet':
+        try:
+            import pandas
+        except ImportError:
+            print( '  pandas and pyarrow are required to save parquet files' )
+            raise
+        pandas.DataFrame( rows, columns=scan_fields ).to_parquet( output_path, index=False )
+    else:
+        raise ValueError( 'unknown scan output format "{}", use csv, json or parquet'.format(file_format) )
 
-### actual program start
-if __name__ == '__main__':
+# show a dialog to select a directory (actionType d) or a single file (actionType f)
+# tkinter is only loaded here to keep headless runs free of any GUI dependency
+def ask_for_input_path( actionType ):
     import tkinter as tk
     from tkinter import filedialog
-    import multiprocessing
 
     #remove root windows
     root = tk.Tk()
     root.withdraw()
+    if actionType == 'd':
+        print( "Please select a working directory", end="\r" )
+        return filedialog.askdirectory(title='Please select the directory containing the images')
+    return filedialog.askopenfilename(title='Please select the image',filetypes=[("Tiff images", "*.tif;*.tiff")])
+
+def is_tiff_file( filename ):
+    return filename.lower().endswith( ('.tif', '.tiff') )
+
+# returns a list of ( directory, filename ) of all TIFFs in the given files, directories or glob patterns.
+# Output folders of previous runs are skipped when searching recursively.
+def get_tiff_file_list( input_paths, recursive=False, output_folder_name='' ):
+    output_folder_name = output_folder_name.rstrip( os.sep )
+    skipped_folders = [ output_folder_name, 'cut_' + output_folder_name, 'nsb_' + output_folder_name, 'thumb_' + output_folder_name ]
+    file_list = []
+    for input_path in input_paths:
+        paths = sorted( glob.glob( input_path, recursive=True ) ) if glob.has_magic( input_path ) else [ input_path ]
+        for path in paths:
+            if os.path.isdir( path ):
+                for directory, folders, filenames in os.walk( path ):
+                    folders[:] = sorted( f for f in folders if not f in skipped_folders ) if recursive else []
+                    for filename in sorted( filenames ):
+                        if is_tiff_file( filename ):
+                            file_list.append( ( directory, filename ) )
+            elif os.path.isfile( path ) and is_tiff_file( path ):
+                file_list.append( ( os.path.dirname( path ) or '.', os.path.basename( path ) ) )
+            elif not os.path.exists( path ):
+                print( "  '{}' does not exist".format(path) )
+    # remove duplicates caused by overlapping paths
+    return list( dict.fromkeys( ( os.path.normpath( d ), f ) for d, f in file_list ) )
 
+### actual program start
+if __name__ == '__main__':
     ### global settings
     programInfo()
 
-    #### directory definitions
-    showDebuggingOutput = False
-
     settings = processArguments()
+    process_start_method = settings['start_method']
+    metadata_backend     = settings['metadata_backend']
 
     ### actual program start
-
     UC = unit()
-    """
-    print( "Extract the scale for a single file (f) or all files in a directory (d), [f]", end=": " )
-    actionType = input()
-
-    output_folder_name_std = 'extracted_scaling'
-    file_prefix = ''
-    print( 'Set the output folder name [{}]'.format(output_folder_name_std), end=": " )
-    output_folder_name = input()
-    if ( output_folder_name == '' ):
-        output_folder_name = output_folder_name_std + os.sep
-    else:
-        output_folder_name = output_folder_name + os.sep
-
-    print( "Save image with simplified scalebar [y/N]", end=": " )
-    save_with_new_scalebar = ( input().upper() in ['Y', 'J'] )
-    """
-    settings['outputDirectory'] += os.sep
-    if ( settings['actionType']  == 'd' ):
-        print( "Please select a working directory", end="\r" )
-        settings["workingDirectory"] = filedialog.askdirectory(title='Please select the directory containing the images')
-
-        coreCount = multiprocessing.cpu_count()
-        processCount = (coreCount - 1) if coreCount > 1 else 1
-
-        if ( settings['showDebuggingOutput'] ) :
-            print( 'Found {} CPU cores. Would use max. {} processes when not in debugging mode.'.format(coreCount, processCount) )
-            print( "I am living in '{}'".format( settings["home_dir"] ) )
-            print( "Selected working directory: {}".format( settings["workingDirectory"] ), end='\n\n' )
-
-        fileList = []
-        for filename in os.listdir( settings["workingDirectory"] ):
-            if ( filename.endswith(".tif") or filename.endswith(".TIF")):
-                fileList.append( filename )
-
-        successfull_files = 0
-        if ( len(fileList) > 0 ):
-            if not settings['showDebuggingOutput']:
-                pool = multiprocessing.Pool(processCount)
-            for position, filename in enumerate(fileList):
-                if ( filename.endswith(".tif") or filename.endswith(".TIF")):
-                    file_path = settings["workingDirectory"] + os.sep + filename
-                    print( " processing '{}' ({} / {})".format(filename, position+1, len(fileList)) )
-                    if settings['showDebuggingOutput']:
-                        result = save_scaling_in_image(  settings["workingDirectory"], filename, settings['save_with_new_scalebar'], settings['outputDirectory'] )
-                        log_result(result)
-                        successfull_files += 1
-                    else:
-                        pool.apply_async(save_scaling_in_image, args=(  settings["workingDirectory"], filename, settings['save_with_new_scalebar'], settings['outputDirectory'],  settings['showDebuggingOutput'] ), callback = log_result)
-
-            if not settings['showDebuggingOutput']:
-                pool.close()
-                pool.join()
-                print('-'*20)
-                for f in result_list:
-                    print(" ./{}: {:.2f} {}/px".format(f, result_list[f]['x'], result_list[f]['unit']))
-                    fileList.remove(f)
-                if len(fileList) > 0:
-                    print()
-                    print(' found {} image(s) without known scale metadata'.format(len(fileList)))
-                    for f in fileList:
-                        print(" ./{}".format(f))
-
-                successfull_files = len(result_list)
+    settings['outputDirectory'] = settings['outputDirectory'].rstrip( os.sep ) + os.sep
+    if len( settings['inputPaths'] ) == 0:
+        input_path = ask_for_input_path( settings['actionType'] )
+        settings['inputPaths'] = [ input_path ] if input_path else []
+
+    if settings['watch'] and len( settings['inputPaths'] ) > 0:
+        task_args = get_task_args( settings )
+        summary    = trace_summary() if settings['timings'] else None
+        trace_file = open( settings['trace_file'], 'w', encoding='utf-8' ) if settings['trace_file'] != '' else None
+        def print_result( file_result ):
+            if summary is not None:
+                summary.add( file_result )
+            if trace_file is not None:
+                write_trace( trace_file, file_result )
+                trace_file.flush()
+            if file_result['error'] != None:
+                print( " failed to process '{}': {}".format(file_result['file_path'], file_result['error']) )
+            elif file_result['success']:
+                print( " {}: {:.2f} {}/px ({:.2f} s)".format(file_result['file_path'], file_result['scaling']['x'], file_result['scaling']['unit'], file_result['seconds']) )
+            else:
+                print( " {}: no known scale metadata".format(file_result['file_path']) )
+        watcher = folder_watcher( settings['inputPaths'], task_args, settings['recursive'], settings['processCount'], settings['backend'],
+                                  settings['watch_settle'], settings['watch_interval'], settings['watch_polling'], settings['use_index'],
+                                  on_result=print_result, verbose=settings['showDebuggingOutput'], trace=settings['timings'] )
+        counts = watcher.run()
+        if trace_file is not None:
+            trace_file.close()
+        if summary is not None:
             print()
-            print( "Detected and set ImageJ scaling in {} of {} images files".format(successfull_files, len(fileList)+len(result_list) ) )
+            summary.print_summary()
+        print( " processed {processed}, skipped {skipped} unchanged and failed to process {failed} image(s)".format(**counts) )
+        print()
+        print( "Script DONE!" )
+        sys.exit()
+
+    fileList = get_tiff_file_list( settings['inputPaths'], settings['recursive'], settings['outputDirectory'] )
+
+    if ( settings['showDebuggingOutput'] ) :
+        print( 'Found {} CPU cores. Using the {} backend.'.format(os.cpu_count(), settings['backend']) )
+        print( "I am living in '{}'".format( settings["home_dir"] ) )
+        print( "Selected paths: {}".format( ', '.join( settings["inputPaths"] ) ), end='\n\n' )
+
+    if ( len(fileList) > 0 and settings['scan_output'] != '' ):
+        # a threaded scan avoids the process start up, since only a few header bytes are read per file
+        backend = 'serial' if settings['backend'] == 'serial' else 'thread'
+        rows = scan_scaling( fileList, settings['processCount'], backend, settings['chunk_size'] or 64, show_progress=True )
+        write_scan_results( rows, settings['scan_output'] )
+        print( "Saved the scaling of {} files ({} detected) to {}".format(len(rows), len([ r for r in rows if r['editor'] != None ]), settings['scan_output']) )
+    elif ( len(fileList) > 0 ):
+        indices = {}
+        if settings['use_index']:
+            for directory in dict.fromkeys( d for d, _ in fileList ):
+                indices[directory] = scaling_index( directory, settings['rebuild_index'], settings['showDebuggingOutput'] )
+
+        result_list = {}
+        processList = []
+        task_args = get_task_args( settings )
+        output_settings = get_output_settings( task_args )
+        for directory, filename in fileList:
+            file_path = directory + os.sep + filename
+            index = indices.get( directory )
+            if index is not None and index.is_up_to_date( filename, settings['outputDirectory'], output_settings ):
+                print( " skipping unchanged '{}'".format(file_path) )
+                scaling = index.entries[filename]['scaling']
+                if scaling['editor'] != None:
+                    result_list[file_path] = scaling
+            else:
+                processList.append( ( directory, filename ) )
+
+        summary    = trace_summary() if settings['timings'] else None
+        trace_file = open( settings['trace_file'], 'w', encoding='utf-8' ) if settings['trace_file'] != '' else None
+        def log_result( file_result ):
+            if summary is not None:
+                summary.add( file_result )
+            if trace_file is not None:
+                write_trace( trace_file, file_result )
+            if file_result['success']:
+                result_list[file_result['file_path']] = file_result['scaling']
+            index = indices.get( file_result['directory'] )
+            if index is not None and file_result['error'] == None:
+                if file_result['success']:
+                    index.update( file_result['filename'], file_result['scaling'], file_result['contentHeight'], settings['outputDirectory'],
+                                  file_result['checksum'], output_settings )
+                else:
+                    index.update( file_result['filename'], file_result['scaling'], file_result['contentHeight'] )
+
+        print( " processing {} of {} files".format(len(processList), len(fileList)) )
+        workers = dict( settings['stage_workers'] )
+        if settings['processCount'] > 0 and not 'encode' in workers: workers['encode'] = settings['processCount']
+        if settings['pipeline'] and len(processList) > 0:
+            pipeline = processing_pipeline( task_args, workers, encode_backend='thread' if settings['backend'] != 'process' else 'process', on_result=log_result, trace=settings['timings'] )
+            results = pipeline.run( processList )
+            pipeline.print_utilization()
         else:
-            print( 'No Tif file found!' )
+            # a single file is processed in this process
+            backend = 'serial' if len(processList) == 1 else settings['backend']
+            results = process_file_list( processList, 'save', task_args, settings['processCount'], backend, settings['chunk_size'] or 4,
+                                         int( settings['max_inflight_mb']*1024**2 ), on_result=log_result, trace=settings['timings'] )
+        for index in indices.values():
+            index.save()
+        if trace_file is not None:
+            trace_file.close()
+
+        print('-'*20)
+        failedFiles  = [ r for r in results if r['error'] != None ]
+        failedPaths  = [ r['file_path'] for r in failedFiles ]
+        unknownFiles = [ d + os.sep + f for d, f in fileList if not d + os.sep + f in result_list and not d + os.sep + f in failedPaths ]
+        for f in result_list:
+            print(" {}: {:.2f} {}/px".format(f, result_list[f]['x'], result_list[f]['unit']))
+        if len(unknownFiles) > 0:
+            print()
+            print(' found {} image(s) without known scale metadata'.format(len(unknownFiles)))
+            for f in unknownFiles:
+                print(" {}".format(f))
+        if len(failedFiles) > 0:
+            print()
+            print(' failed to process {} image(s)'.format(len(failedFiles)))
+            for r in failedFiles:
+                print(" {}: {}".format(r['file_path'], r['error']))
 
-    else:
-        settings["filepath"] = filedialog.askopenfilename(title='Please select the image',filetypes=[("Tiff images", "*.tif;*.tiff")])
-        settings["workingDirectory"] = os.path.dirname( settings["filepath"] )
-        filename = os.path.basename(settings["filepath"])
-        #print( " Processing {}:".format(filename) )
-        scaling = autodetectScaling( filename, settings["workingDirectory"], settings['showDebuggingOutput'] )
+        if summary is not None:
+            print()
+            summary.print_summary()
 
-        save_scaling_in_image( settings["workingDirectory"], filename, settings['save_with_new_scalebar'], settings['outputDirectory'] )
+        print()
+        print( "Detected and set ImageJ scaling in {} of {} images files".format(len(result_list), len(fileList) ) )
+    else:
+        print( 'No Tif file found!' )
 
     print()
-    print( "Script DONE!" )
\ No newline at end of file
+    print( "Script DONE!" )